@@ -11,19 +11,21 @@ import logging
 from logging import handlers
 import os
 import datetime
-import json
 import re
 from PCA9685_pigpio import *
-from door import *
+from coop_door import *
 #from thermostat import Thermostat
 #import candle
 import lights
 import health
 import almanac
+import clock
+import runloop
+import pwmframe
 from sharedclient import SharedClient, topic_join
 from mqtthandler import MQTTHandler
 from candle import Flicker
-import fans
+import fan
 
 DOOR_OPEN_SW     = COOP_OPEN_SW
 DOOR_CLOSED_SW   = COOP_CLOSED_SW
@@ -71,10 +73,13 @@ def InitalizeHardware():
     sun_scheduler.addEvent(hen_door.open,  ('sunrise', datetime.timedelta(0)))
     sun_scheduler.addEvent(hen_door.close, ('dusk',    datetime.timedelta(0)))
     sun_scheduler.addEvent(hen_door.warn,  ('dusk',    datetime.timedelta(seconds=-45)))
+    # Lights write through a frame which the main loop flushes once per step
+    global pwm_frame
+    pwm_frame = pwmframe.PWMFrame(pi)
     # Hen house SAD lamp
     logger.debug("Setting up hen house light")
     global hen_lamp
-    hen_lamp = lights.SlowLinearFader(pi, [HEN_HOUSE_LIGHT], LED_MAX_PWM, LED_MAX_PWM/100, [0], 2.8)
+    hen_lamp = lights.SlowLinearFader(pwm_frame, [HEN_HOUSE_LIGHT], LED_MAX_PWM, LED_MAX_PWM/100, [0], 2.8)
     sun_scheduler.addEvent(lambda: hen_lamp.setTarget(45*60, [HEN_LAMP_MAX*0.80]),
                            after  = ('noon', datetime.timedelta(hours=-7)),
                            before = ('dawn', datetime.timedelta(0)), # Only turn on light if less than 14 hours of daylight
@@ -83,7 +88,7 @@ def InitalizeHardware():
                            after  = ('noon', datetime.timedelta(hours=6, minutes=15)), # Always let hens sleep
                            )
     if ((sun_scheduler.sun['noon'] - sun_scheduler.sun['dawn']) < datetime.timedelta(hours=7)) and \
-       (abs(sun_scheduler.sun['noon'] - datetime.datetime.now(sun_scheduler.location.tz)) < datetime.timedelta(hours=7)):
+       (abs(sun_scheduler.sun['noon'] - clock.now(sun_scheduler.location.tz)) < datetime.timedelta(hours=7)):
         hen_lamp.setTarget(45, [HEN_LAMP_MAX*0.80])
     # Camera IR Illuminator
     #logger.debug("Setting up hen house camera IR illuminator")
@@ -94,48 +99,46 @@ def InitalizeHardware():
     global exterior_lamp
     exterior_lamp = lights.GasLamp(Flicker(),
                                    (255, 128, 64),
-                                   pi, EXTERIOR_LIGHTS, LED_MAX_PWM,
+                                   pwm_frame, EXTERIOR_LIGHTS, LED_MAX_PWM,
                                    LED_MAX_PWM/255, (1000, 2000, 3000), 2.8)
     global hen_cooler
     hen_cooler = fan.DiscreteFan(pi, HEN_HOUSE_COOLER, (0, 4095*8/12, 4095*10/12, 4095), 500)
 
 def CleanupHardware():
     global hen_door
+    hen_door.shutdown()
     del hen_door
     global hen_lamp
     del hen_lamp
     global exterior_lamp
     del exterior_lamp
+    global pwm_frame
+    del pwm_frame
     global hen_cooler
     del hen_cooler
 
-def ParsePayload(msg, lb=None, ub=None, required_type=None, options=None):
-    try:
-        cmd = json.loads(msg.payload.decode())
-    except:
-        logger.warn("Unable to parse payload of message on topic \"{0.topic}\": {0.payload}".format(msg))
-        return None
+def CheckCommand(msg, cmd, lb=None, ub=None, required_type=None, options=None):
+    "Validates a command the client has already decoded from JSON, returns it or None if it is invalid"
+    if options:
+        if not cmd in options:
+            logger.warn("Invalid command of message on topic \"{0.topic}\" (options are {1!r}): {0.payload}".format(msg, options))
+            return None
+        else:
+            return cmd
     else:
-        if options:
-            if not cmd in options:
-                logger.warn("Invalid command of message on topic \"{0.topic}\" (options are {1!r}): {0.payload}".format(msg, options))
-                return None
-            else:
-                return cmd
+        if required_type is not None and type(cmd) is not required_type:
+            logger.warn("Command for topic {}, is type {} not {}".format(msg.topic, type(cmd), required_type))
+        elif lb is not None and cmd < lb:
+            logger.warn("Command for topic {}, {} < lower bound {}".format(msg.topic, cmd, lb))
+            return None
+        elif ub is not None and cmd > ub:
+            logger.warn("Command for topic {}, {} > upper bound {}".format(msg.topic, cmd, ub))
+            return None
         else:
-            if required_type is not None and type(cmd) is not required_type:
-                logger.warn("Command for topic {}, is type {} not {}".format(msg.topic, type(cmd), required_type))
-            elif lb is not None and cmd < lb:
-                logger.warn("Command for topic {}, {} < lower bound {}".format(msg.topic, cmd, lb))
-                return None
-            elif ub is not None and cmd > ub:
-                logger.warn("Command for topic {}, {} > upper bound {}".format(msg.topic, cmd, ub))
-                return None
-            else:
-                return cmd
-
-def DoorCommand(msg):
-    cmd = ParsePayload(msg, options=["OPEN", "CLOSE", "STOP", "WARN", "ENABLE", "DISABLE"])
+            return cmd
+
+def DoorCommand(msg, cmd):
+    cmd = CheckCommand(msg, cmd, options=["OPEN", "CLOSE", "STOP", "WARN", "ENABLE", "DISABLE"])
     if cmd == 'OPEN':
         hen_door.open()
     elif cmd == 'CLOSE':
@@ -149,51 +152,53 @@ def DoorCommand(msg):
     elif cmd == 'DISABLE':
         hen_door.enable(False)
 
-def HenHouseLightCommand(msg):
-    cmd = ParsePayload(msg, 0, 100)
+def HenHouseLightCommand(msg, cmd):
+    cmd = CheckCommand(msg, cmd, 0, 100)
     if cmd is not None:
         hen_lamp.setTarget(5, [cmd]) # 5 second fade
 
-def ExteriorBrightness(msg):
-    try:
-        target = [int(c) for c in RGB_RE.match(msg.payload)]
-    except:
-        logger.warn("Unable to parse RGB command on topic \"{0.topic}\": {0.payload}".format(msg))
-    else:
-        exterior_lamp.setTarget(5, target)
+def ExteriorBrightness(msg, match):
+    exterior_lamp.setTarget(5, [int(c) for c in match.groups()])
 
-def ExteriorFuel(msg):
-    cmd = ParsePayload(msg, 0, 100)
+def ExteriorFuel(msg, cmd):
+    cmd = CheckCommand(msg, cmd, 0, 100)
     if cmd is not None:
         exterior_lamp.setCandle(cmd/50.0)
     else:
         exterior_lamp.setCandle(1.0)
 
-def HenCoolerSpeed(msg):
-    cmd = ParsePayload(msg, 0, 3, int)
+def HenCoolerSpeed(msg, cmd):
+    cmd = CheckCommand(msg, cmd, 0, 3, int)
     if cmd is not None:
         hen_cooler.set(cmd)
 
-def Automate(mqtt_connect_args):
-    "Run the automation main loop"
+def SubscribeCommands():
+    "Subscribe the command callbacks"
+    # A door motion blocks the synchronous loop for up to 30s, so a full door queue drops its oldest command rather
+    # than blocking the network thread
+    mqtt_client.subscribe(topic_join(base_topic, "door", "command"), 1, DoorCommand, overflow="drop_oldest", decoder="json")
+    # Only the most recent setting matters so a backlog of them collapses to the latest
+    mqtt_client.subscribe(topic_join(base_topic, "house_light", "brightness"), 1, HenHouseLightCommand, overflow="latest", decoder="json")
+    mqtt_client.subscribe(topic_join(base_topic, "exterior", "brightness"), 1, ExteriorBrightness, overflow="latest", decoder=RGB_RE)
+    mqtt_client.subscribe(topic_join(base_topic, "exterior", "fuel"), 1, ExteriorFuel, overflow="latest", decoder="json")
+    mqtt_client.subscribe(topic_join(base_topic, "hen_cooler", "speed"), 1, HenCoolerSpeed, overflow="latest", decoder="json")
+
+def Automate(mqtt_connect_args, use_asyncio=False):
+    """Run the automation main loop
+    @param use_asyncio Run on an asyncio event loop, where door motions are tasks which run alongside everything else
+                       and a new door command cancels the motion in progress
+    """
     logger.debug("Starting MQTT client thread")
     mqtt_client.loop_start() # Start MQTT client in its own thread
     mqtt_client.connect(*mqtt_connect_args)
     InitalizeHardware()
-    mqtt_client.subscribe(topic_join(base_topic, "door", "command"), 1, DoorCommand)
-    mqtt_client.subscribe(topic_join(base_topic, "house_light", "brightness"), 1, HenHouseLightCommand)
-    mqtt_client.subscribe(topic_join(base_topic, "exterior", "brightness"), 1, ExteriorBrightness)
-    mqtt_client.subscribe(topic_join(base_topic, "exterior", "fuel"), 1, ExteriorFuel)
-    mqtt_client.subscribe(topic_join(base_topic, "hen_cooler", "speed"), 1, HenCoolerSpeed)
-    mqtt_client.loop_timeout = 0.050
+    SubscribeCommands()
     logger.debug("Entering main loop")
+    # Sleeps until a component's next deadline or until an MQTT callback runs
+    loop_class = runloop.AsyncRunLoop if use_asyncio else runloop.RunLoop
+    main_loop = loop_class([sun_scheduler, hen_lamp, exterior_lamp, pwm_frame, hmon], mqtt_client)
     try:
-        while True:
-            next(sun_scheduler)
-            next(hen_lamp)
-            next(exterior_lamp)
-            next(hmon)
-            next(mqtt_client)
+        main_loop.run()
     except KeyboardInterrupt:
         logger.info("Exiting at sig-exit")
     # Clean up peripherals
@@ -212,6 +217,13 @@ if __name__ == '__main__':
     parser.add_argument('-v', "--verbose", action="store_true", help="More verbose debugging output")
     parser.add_argument('-l', "--log_file", type=str, help="Base file to write logs to, will automatically roll over ever 16 MB")
     parser.add_argument('-m', "--log_mqtt", action="store_true", help="If specified, logged events will be sent to mqtt")
+    parser.add_argument("--callback_workers", type=int, default=0, help="Run MQTT command callbacks on this many worker threads instead of the main loop")
+    parser.add_argument("--callback_timeout", type=float, help="Seconds an MQTT command callback may run before it is logged as an overrun")
+    parser.add_argument("--queue_maxsize", type=int, default=0, help="Maximum MQTT messages queued per subscription, 0 for no limit")
+    parser.add_argument("--block_timeout", type=float, default=1.0, help="Seconds the MQTT network thread waits for room in a full queue before dropping the message")
+    parser.add_argument("--retain_interval", type=float, default=0.0, help="Minimum seconds between retained MQTT publishes to a topic")
+    parser.add_argument("--asyncio", action="store_true", help="Run the main loop on asyncio so door motions don't block lights and MQTT commands")
+    parser.add_argument("--metrics_interval", type=float, help="If specified, publish MQTT dispatch latency histograms to <topic>/metrics this often")
     parser.add_argument("location", type=argparse.FileType('rb'), help="Pickle file containing an Astral location instance for almanac")
 
     if len(sys.argv) == 1 and os.path.isfile('coop.args'):
@@ -220,6 +232,8 @@ if __name__ == '__main__':
         args = parser.parse_args(cached_args.split())
     else:
         args = parser.parse_args()
+    if args.asyncio and args.callback_workers:
+        parser.error("--asyncio runs MQTT callbacks on the event loop so can't be used with --callback_workers")
 
     brokerConnect = [args.brokerHost]
     if args.brokerPort: brokerConnect.append(args.brokerPort)
@@ -227,7 +241,12 @@ if __name__ == '__main__':
     if args.bind: brokerConnect.append(args.bind)
 
     base_topic = args.topic
-    mqtt_client = SharedClient(args.clientID, not args.clientID)
+    mqtt_client = SharedClient(args.clientID, not args.clientID,
+                               workers=args.callback_workers, callback_timeout=args.callback_timeout,
+                               queue_maxsize=args.queue_maxsize, block_timeout=args.block_timeout,
+                               retain_interval=args.retain_interval,
+                               metrics_topic=topic_join(args.topic, "metrics") if args.metrics_interval else None,
+                               metrics_interval=args.metrics_interval or 60.0)
 
     logHandlers = []
     if args.log_file:
@@ -252,4 +271,4 @@ if __name__ == '__main__':
     hmon = health.HealthPublisher(mqtt_client, topic_join(base_topic, "health"))
     sun_scheduler = almanac.SunScheduler(args.location)
 
-    Automate(brokerConnect)
+    Automate(brokerConnect, args.asyncio)
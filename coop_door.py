@@ -6,8 +6,10 @@ Logic for controlling the chicken coop door.
 import pigpio
 import logging
 import json
-import time
+import asyncio
+import threading
 from DRV8871 import Motor
+import clock
 
 COOP_OPEN_SW   = 17
 COOP_CLOSED_SW =  4
@@ -45,11 +47,41 @@ class Door:
         self.logger = logging.getLogger(__name__)
         self.client = client
         self.door_status_topic = door_status_topic
-        time.sleep(0.1)
+        self.task = None # The asyncio task running the current motion
+        self.lock = threading.Lock() # Held by a motion run on a thread, command workers and the sun scheduler share the door
+        self.waiting = {} # Switch -> (motor reaction, wake up) called from the pigpio callback thread when it's reached
+        self.switch_latency_µs = None # From the last switch edge to the motor reacting to it
+        # pigpio applies the glitch filter to edge callbacks too, so a bounce doesn't end a wait early
+        self._callbacks = [pi.callback(sw, pigpio.RISING_EDGE, self._edge) for sw in (closed_sw, open_sw)]
+        clock.sleep(0.1)
     
     def __del__(self):
+        if getattr(self, "_callbacks", None): # Not already shut down, nor failed in __init__
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop the motor and cancel the switch callbacks, call before discarding the door.
+        The callbacks, and anything else holding its methods such as the sun scheduler, keep the door alive so
+        __del__ can't be relied on to do this.
+        """
         self.enabled = False
         self.stop()
+        for cb in self._callbacks:
+            cb.cancel()
+        self._callbacks = []
+
+    def _edge(self, gpio, level, tick):
+        """pigpio callback when a switch is reached.
+        The motor reacts here rather than after the waiting motion wakes, which would add a thread or event loop hand
+        off to the stop latency, and the motion repeats the command when it does wake.
+        """
+        waiting = self.waiting.get(gpio)
+        if level == 1 and waiting is not None:
+            react, wake = waiting
+            if react is not None:
+                react()
+            wake()
+            self.switch_latency_µs = pigpio.tickDiff(tick, self.pi.get_current_tick())
     
     def check_status_and_publish(self):
         if self.pi.read(self.open_sw):
@@ -60,71 +92,168 @@ class Door:
             self.client.publish(self.door_status_topic, self.DOOR_AJAR_TOKEN, qos=1, retain=True)
     
     def stop(self):
+        "Stop the motor, cancelling any motion in progress"
+        self.cancel()
+        self._halt()
+
+    def _halt(self):
+        "Stop the motor at the end of a motion"
         self.motor.stop()
         self.check_status_and_publish()
-    
+
+    def cancel(self):
+        "Cancel the asyncio task running the current motion, if any, the motor is stopped as it finishes"
+        task, self.task = self.task, None
+        if task is not None and not task.done():
+            task.cancel()
+
+    def motion(self, steps):
+        """Run a door motion.
+        With an asyncio event loop running on this thread the motion is started as a task, cancelling any motion in
+        progress, and the task is returned. Otherwise the motion runs to completion before this returns, after any
+        motion another thread is running has finished, so motions from different threads never drive the motor at once.
+        @param steps Generator yielding (switch, timeout, reaction) to wait up to timeout seconds for switch to be
+                     reached, which is sent whether it was, or (None, timeout) just to sleep. reaction, if not None, is
+                     the motor command the motion will make when the switch is reached, made early by the edge callback
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._run(steps)
+            return None
+        previous = self.task
+        self.cancel()
+        self.task = loop.create_task(self._run_async(steps, previous))
+        return self.task
+
+    def _wait(self, switch, timeout, reaction=None):
+        "Wait for a switch on this thread, returns whether it was reached"
+        if switch is None:
+            clock.sleep(timeout)
+            return False
+        reached = threading.Event()
+        self.waiting[switch] = (reaction, reached.set)
+        try:
+            # Read after registering so an edge between the two isn't missed
+            return bool(self.pi.read(switch) or clock.wait(reached, timeout))
+        finally:
+            self.waiting.pop(switch, None)
+
+    async def _wait_async(self, switch, timeout, reaction=None):
+        "Wait for a switch in an asyncio task, returns whether it was reached"
+        if switch is None:
+            await asyncio.sleep(timeout)
+            return False
+        loop = asyncio.get_running_loop()
+        reached = asyncio.Event()
+        self.waiting[switch] = (reaction, lambda: loop.call_soon_threadsafe(reached.set))
+        try:
+            if not self.pi.read(switch):
+                await asyncio.wait_for(reached.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting.pop(switch, None)
+
+    def _run(self, steps):
+        "Run a motion's steps on this thread, holding the door's lock"
+        with self.lock:
+            try:
+                wait = next(steps)
+                while True:
+                    wait = steps.send(self._wait(*wait))
+            except StopIteration:
+                pass
+            finally:
+                steps.close() # Stops the motor if interrupted
+
+    async def _run_async(self, steps, previous=None):
+        "Run a motion's steps, after the motion it replaced, if any, has finished stopping the motor"
+        try:
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            wait = next(steps)
+            while True:
+                wait = steps.send(await self._wait_async(*wait))
+        except StopIteration:
+            pass
+        finally:
+            steps.close() # Stops the motor if cancelled
+            if self.task is asyncio.current_task():
+                self.task = None
+
     def open(self, speed=1.0):
-        "Trigger the door to open, optionally set a multiple of normal speed."
+        "Trigger the door to open, optionally set a multiple of normal speed. See motion()"
+        return self.motion(self._opening(speed))
+
+    def close(self, speed=1.0):
+        "Trigger the door to close, optionally set a multiple of normal speed. See motion()"
+        return self.motion(self._closing(speed))
+
+    def warn(self, count=5, interval=0.5, speed=0.5):
+        """Pulse the door towards closed briefly some number of times to warn that it will actually close soon. See motion()
+        @param count    How many pulses to execute
+        @param interval Time between pulses in seconds, duty cycle is 50%
+        @param speed    Factor applied to close speed
+        """
+        return self.motion(self._warning(count, interval, speed))
+
+    def _opening(self, speed):
         if not self.enabled:
             self.logger.info("Door open not enabled")
             return
         elif self.pi.read(self.open_sw):
             self.logger.info("Door already open")
+            return
+        self.motor.drive(self.OPEN_SPEED * speed)
+        self.logger.debug("Door opening")
+        opened = False
+        try:
+            opened = yield self.open_sw, self.OPEN_TIMEOUT, self.motor.stop
+        finally:
+            self._halt()
+        if opened:
+            self.logger.info("Door now open")
         else:
-            start_time = time.time()
-            self.motor.drive(self.OPEN_SPEED * speed)
-            self.logger.debug("Door opening")
-            while time.time() < start_time + self.OPEN_TIMEOUT:
-                if self.pi.read(self.open_sw):
-                    self.stop()
-                    self.logger.info("Door now open")
-                    break
-            else:
-                self.stop()
-                self.logger.warn("Door did not open in time")
-            
-    
-    def close(self, speed=1.0):
-        "Trigger the door to close, optionally set a multiple of normal speed"
+            self.logger.warn("Door did not open in time")
+
+    def _closing(self, speed):
         if not self.enabled:
             self.logger.info("Door close not enabled")
             return
         elif self.pi.read(self.closed_sw):
             self.logger.info("Door already closed")
+            return
+        self.motor.drive(self.CLOSE_SPEED * speed)
+        self.logger.debug("Door closing")
+        closed = False
+        try:
+            closed = yield self.closed_sw, self.CLOSE_TIMEOUT, lambda: self.motor.drive(self.LATCH_SPEED * speed)
+            if closed:
+                self.motor.drive(self.LATCH_SPEED * speed)
+                self.logger.debug("Latching")
+                yield None, self.LATCH_DURATION
+        finally:
+            self._halt()
+        if closed:
+            self.logger.info("Door now closed")
         else:
-            start_time = time.time()
-            self.motor.drive(self.CLOSE_SPEED * speed)
-            self.logger.debug("Door closing")
-            while time.time() < start_time + self.CLOSE_TIMEOUT:
-                if self.pi.read(self.closed_sw):
-                    self.motor.drive(self.LATCH_SPEED * speed)
-                    self.logger.debug("Latching")
-                    time.sleep(self.LATCH_DURATION)
-                    self.stop()
-                    self.logger.info("Door now closed")
-                    break
-            else:
-                self.stop()
-                self.logger.warn("Door did not close in time")
+            self.logger.warn("Door did not close in time")
 
-    def warn(self, count=5, interval=0.5, speed=0.5):
-        """Pulse the door towards closed briefly some number of times to warn that it will actually close soon
-        @param count    How many pulses to execute
-        @param interval Time between pulses in seconds, duty cycle is 50%
-        @param speed    Factor applied to close speed
-        """
+    def _warning(self, count, interval, speed):
         if not self.enabled:
             self.logger.info("Door warn not enabled")
-        else:
-            self.logger.info("Warning door close, {} {} second pulses".format(count, interval))
-            try:
-                for i in range(count):
-                    self.motor.drive(self.CLOSE_SPEED * speed)
-                    time.sleep(interval/2.0)
-                    self.motor.stop()
-                    time.sleep(interval/2.0)
-            finally:
-                self.stop()
+            return
+        self.logger.info("Warning door close, {} {} second pulses".format(count, interval))
+        try:
+            for i in range(count):
+                self.motor.drive(self.CLOSE_SPEED * speed)
+                yield None, interval/2.0
+                self.motor.stop()
+                yield None, interval/2.0
+        finally:
+            self._halt()
 
     def enable(self, enabled):
         self.enabled = enabled
@@ -150,4 +279,4 @@ if __name__ == '__main__':
         elif sys.argv[1] == "close":
             door.close()
 
-    del door
+    door.shutdown()
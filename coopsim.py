@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Simulated chicken coop for profiling and load testing without hardware.
+Runs coop.py's hardware setup, command callbacks and main loop against the simulated pigpio backend on a virtual
+clock, so a whole day runs in seconds, with MQTT commands arriving at random. Reports how long commands waited for the
+main loop, what each main loop step cost and the pigpio traffic.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import random
+import datetime
+import collections
+import logging
+import clock
+import simpi
+simpi.install() # Before coop imports pigpio
+import paho.mqtt.client as mqtt
+import astral
+import coop
+import almanac
+import health
+import runloop
+from sharedclient import SharedClient, topic_join
+
+class SimClient(SharedClient):
+    "Shared client which counts publishes instead of sending them"
+
+    def __init__(self):
+        SharedClient.__init__(self)
+        self.published = collections.Counter() # topic -> number of publishes
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published[topic] += 1
+
+class ClientDispatcher:
+    "Runs the client's queued callbacks for the main loop, waiting on the virtual clock"
+
+    def __init__(self, client):
+        self.client = client
+
+    def is_set(self):
+        return self.client.queue.qsize() > 0
+
+    def dispatch(self, timeout):
+        return clock.wait(self, timeout) and self.client.dispatch(0)
+
+class SimHealthPublisher(health.HealthPublisher):
+    "Health publisher with a simulated CPU temperature sensor"
+
+    def temperature(self):
+        return 45.0
+
+class TimedComponent:
+    "Wraps a main loop component to record the wall time of each step"
+
+    def __init__(self, component):
+        self.component = component
+        self.costs = []
+
+    def deadline(self):
+        return self.component.deadline()
+
+    def __next__(self):
+        start = time.perf_counter()
+        next(self.component)
+        self.costs.append(time.perf_counter() - start)
+
+class Commands:
+    "Random MQTT commands delivered to the client on the virtual clock, with the time each waited to be run"
+
+    def __init__(self, client, base_topic):
+        self.client = client
+        self.base_topic = base_topic
+        self.latencies = [] # Virtual seconds from arriving to the callback running
+        self.costs = [] # Wall seconds spent in the callback
+        self.generators = [
+            ("door/command",           lambda: random.choice(['"OPEN"', '"CLOSE"', '"STOP"', '"WARN"'])),
+            ("house_light/brightness", lambda: str(random.randrange(101))),
+            ("exterior/brightness",    lambda: "rgb({:d},{:d},{:d})".format(*(random.randrange(256) for i in range(3)))),
+            ("exterior/fuel",          lambda: str(random.randrange(101))),
+            ("hen_cooler/speed",       lambda: str(random.randrange(4))),
+        ]
+
+    def timed(self, callback):
+        "Wraps a command callback to record its latency and cost"
+        def run(msg, *args):
+            self.latencies.append(clock.time() - msg.timestamp)
+            start = time.perf_counter()
+            callback(msg, *args)
+            self.costs.append(time.perf_counter() - start)
+        return run
+
+    def schedule(self, start, end, per_hour):
+        "Schedule commands as a Poisson process between start and end"
+        t = start
+        while per_hour > 0:
+            t += random.expovariate(per_hour / 3600.0)
+            if t >= end:
+                break
+            topic, payload = random.choice(self.generators)
+            clock.call_at(t, lambda topic=topic, payload=payload(): self.deliver(topic, payload))
+
+    def deliver(self, topic, payload):
+        msg = mqtt.MQTTMessage(topic=topic_join(self.base_topic, topic).encode())
+        msg.payload = payload.encode()
+        msg.timestamp = clock.time()
+        self.client.on_message(self.client, None, msg)
+
+def percentiles(values, scale=1.0):
+    "Returns a format of the p50, p99 and max of values times scale"
+    if not values:
+        return "{:>9} {:>9} {:>9}".format("-", "-", "-")
+    values = sorted(values)
+    return "{:9.1f} {:9.1f} {:9.1f}".format(values[len(values) // 2] * scale,
+                                            values[min(len(values) - 1, int(len(values) * 0.99))] * scale,
+                                            values[-1] * scale)
+
+def Simulate(location, start, hours, commands_per_hour, travel_time):
+    "Run the coop for hours of virtual time from start, returns the report"
+    clock.install(clock.VirtualClock(start))
+    client = SimClient()
+    coop.mqtt_client = client
+    coop.base_topic = "coop"
+    coop.sun_scheduler = almanac.SunScheduler(location)
+    coop.hmon = SimHealthPublisher(client, topic_join(coop.base_topic, "health"))
+    commands = Commands(client, coop.base_topic)
+    for name in ("DoorCommand", "HenHouseLightCommand", "ExteriorBrightness", "ExteriorFuel", "HenCoolerSpeed"):
+        setattr(coop, name, commands.timed(getattr(coop, name)))
+    coop.InitalizeHardware()
+    door = simpi.Door(coop.pi, coop.DOOR_MOT_IN1, coop.DOOR_MOT_IN2, coop.DOOR_CLOSED_SW, coop.DOOR_OPEN_SW, travel_time)
+    coop.SubscribeCommands()
+    end = start + hours * 3600
+    commands.schedule(start, end, commands_per_hour)
+    components = collections.OrderedDict((name, TimedComponent(getattr(coop, name)))
+                                         for name in ("sun_scheduler", "hen_lamp", "exterior_lamp", "pwm_frame", "hmon"))
+    main_loop = runloop.RunLoop(components.values(), ClientDispatcher(client))
+    wall = time.perf_counter()
+    while clock.time() < end:
+        main_loop.wait(main_loop.step())
+    wall = time.perf_counter() - wall
+    lines = ["Simulated {:0.1f} hours in {:0.2f} seconds, {:0.0f}x real time".format(hours, wall, hours * 3600 / wall),
+             "Main loop: {steps:d} steps, {wakeups:d} wakeups, {late:0.1f}ms most late".format(
+                 late=main_loop.max_late * 1000, **main_loop.stats()),
+             "{:<22} {:>8} {:>9} {:>9} {:>9}".format("", "count", "p50", "p99", "max")]
+    for name, component in components.items():
+        lines.append("{:<22} {:8d} {} us/step".format(name, len(component.costs), percentiles(component.costs, 1e6)))
+    lines.append("{:<22} {:8d} {} us/call".format("command callbacks", len(commands.costs), percentiles(commands.costs, 1e6)))
+    lines.append("{:<22} {:8d} {} ms".format("command latency", len(commands.latencies),
+                                             percentiles(commands.latencies, 1e3)))
+    lines.append("Door trips {:d}, last switch latency {}us".format(door.trips, coop.hen_door.switch_latency_µs))
+    lines.append("PWM frames {frames:d}, channel writes {writes:d}, unchanged writes skipped {skipped:d}".format(
+        **coop.pwm_frame.stats()))
+    lines.append("pigpio commands: " + ", ".join("{} {:d} ({:0.2f}/s)".format(cmd, n, n / (hours * 3600))
+                                                 for cmd, n in sorted(coop.pi.commands.items())))
+    lines.append("Publishes: " + ", ".join("{} {:d}".format(topic, n) for topic, n in sorted(client.published.items())))
+    coop.CleanupHardware()
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-l", "--location", type=argparse.FileType('rb'), help="Pickle file containing an Astral location instance, by default astral's default location")
+    parser.add_argument("-d", "--date", type=str, help="Day to start the simulation at midnight of, YYYY-MM-DD, by default today")
+    parser.add_argument("--hours", type=float, default=24.0, help="Hours to simulate")
+    parser.add_argument("--commands", type=float, default=60.0, help="Average MQTT commands per hour")
+    parser.add_argument("--travel_time", type=float, default=10.0, help="Seconds for the door to travel all the way at full speed")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for repeatable runs")
+    parser.add_argument('-v', "--verbose", action="store_true", help="Log the coop's debugging output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+    random.seed(args.seed)
+    location = pickle.load(args.location) if args.location else astral.Location()
+    day = datetime.datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else datetime.date.today()
+    midnight = datetime.datetime.combine(day, datetime.time())
+    midnight = location.tz.localize(midnight) if hasattr(location.tz, "localize") else midnight.replace(tzinfo=location.tz)
+    print(Simulate(location, midnight.timestamp(), args.hours, args.commands, args.travel_time))
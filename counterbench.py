@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Ingest benchmark for the counter service.
+Drives CounterService.on_message with synthetic MQTT messages through an in-process fake client, no broker required,
+and reports throughput, publish latency percentiles and database growth.
+With --payload_source it instead copies the events of an existing database into one database per payload encoding
+and reports the bytes per event of each.
+"""
+
+import sys
+import os
+import time
+import random
+import tempfile
+import shutil
+import itertools
+import threading
+import paho.mqtt.client as mqtt
+import counterdb
+
+class FakeClient:
+    "Stands in for the service's MQTT client, records when each publication's count first reaches a value"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.published = 0
+        self.counts = {} # publishTopic -> events counted by the latest publish
+        self.watch = {}  # publishTopic -> (list of send times, baseline count)
+        self.latencies = []
+
+    def track(self, publishTopic, sendTimes, baseline):
+        "Measure latency for publishTopic whose result is COUNT(*) of events with the given send times"
+        self.watch[publishTopic] = (sendTimes, baseline)
+        self.counts[publishTopic] = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        now = time.perf_counter()
+        with self.lock:
+            self.published += 1
+            if topic in self.watch:
+                sendTimes, baseline = self.watch[topic]
+                count = int(counterdb.json.loads(payload)[0][0]) - baseline
+                for sent in sendTimes[self.counts[topic]:count]:
+                    self.latencies.append(now - sent)
+                self.counts[topic] = max(self.counts[topic], count)
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+def databaseBytes(path):
+    "Size of the database and any shards after checkpointing their write ahead logs"
+    paths = [path] + [os.path.join(os.path.dirname(path), f) for f in os.listdir(os.path.dirname(path))
+                      if f.startswith(os.path.basename(path) + ".shard") and not f.endswith(("-wal", "-shm"))]
+    for p in paths:
+        db = counterdb.connect(p)
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.close()
+    return sum(os.path.getsize(p) for p in paths)
+
+def percentile(values, p):
+    "Nearest rank percentile of a sorted list"
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def prefill(counter, topicIDs, events):
+    "Fill the events table with history spread over the last year"
+    now = time.time()
+    rows = [(random.choice(topicIDs), now - random.random() * 365 * 86400, 1.0, "None") for i in range(events)]
+    for shard, path in enumerate(counter.shardPaths):
+        db = counterdb.connect(path)
+        with db:
+            db.executemany(counterdb.EventWriter.INSERT, [r for r in rows if counter.shardOf(r[0]) == shard])
+        db.close()
+
+def runCase(directory, topics, publications, dbSize, events, serviceArgs, payload=None):
+    "Runs one benchmark case, returns a dictionary of results"
+    path = os.path.join(directory, "bench-{}-{}-{}.db".format(topics, publications, dbSize))
+    client = FakeClient()
+    service = counterdb.CounterService("", path, 0, **serviceArgs)
+    service.client = client
+    names = ["bench/{:d}/count".format(i) for i in range(topics)]
+    tids = [service.db.createTopic(name) for name in names]
+    if dbSize:
+        prefill(service.db, tids, dbSize)
+        service.db.updateRollups()
+    sendTimes = {name: [] for name in names}
+    for name, tid in zip(names, tids):
+        baseline = service.db.query("SELECT COUNT(*) FROM events WHERE topic=?", (tid,))[0][0]
+        service.db.createPublication(name, name + "/total", "SELECT COUNT(*) FROM events WHERE topic={:d}".format(tid))
+        client.track(name + "/total", sendTimes[name], baseline)
+        rollups = itertools.cycle([(service.db.DAILY, "events"), (service.db.MONTHLY, "total"), (service.db.HOURLY, "events")])
+        for i, (rollup, column) in zip(range(publications - 1), rollups):
+            service.db.createRollupPublication(name, "{}/rollup{:d}".format(name, i), rollup, column)
+    service.db.flush()
+    startBytes = databaseBytes(path)
+    messages = [mqtt.MQTTMessage(topic=random.choice(names).encode()) for i in range(events)]
+    body = b"1" if payload is None else counterdb.json.dumps([1, payload]).encode()
+    for msg in messages:
+        msg.payload = body
+    start = time.perf_counter()
+    for msg in messages:
+        sendTimes[msg.topic].append(time.perf_counter())
+        service.on_message(client, None, msg)
+    ingested = time.perf_counter() - start
+    service.close()
+    elapsed = time.perf_counter() - start
+    latencies = sorted(client.latencies)
+    return {
+        "topics":       topics,
+        "publications": publications,
+        "dbSize":       dbSize,
+        "ingestRate":   events / ingested,
+        "durableRate":  events / elapsed,
+        "p50":          percentile(latencies, 50),
+        "p90":          percentile(latencies, 90),
+        "p99":          percentile(latencies, 99),
+        "max":          latencies[-1] if latencies else float('nan'),
+        "publishes":    client.published,
+        "bytesPerEvent": (databaseBytes(path) - startBytes) / events,
+    }
+
+def payloadCase(directory, source, sourceShards, compactPayloads):
+    """Copies every event of the source database into a new one, returns the number of events, the bytes per event the
+    database grew by and the bytes per event of payload storage"""
+    src = counterdb.CounterDB(source, shards=sourceShards)
+    path = os.path.join(directory, "payloads-{}.db".format("compact" if compactPayloads else "text"))
+    dst = counterdb.CounterDB(path, compactPayloads=compactPayloads)
+    startBytes = databaseBytes(path)
+    def rows():
+        for topic, in src.topics:
+            for eid, t, count, payload in src.exportEvents(topic):
+                yield topic, t, count, payload
+    try:
+        loaded = dst.importEvents(rows())
+        payloadBytes = dst.query("SELECT TOTAL(length(CAST(payload AS BLOB))) FROM events")[0][0] + \
+                       dst.query("SELECT TOTAL(length(CAST(data AS BLOB))) FROM payloads")[0][0]
+    finally:
+        dst.close()
+        src.close()
+    if not loaded:
+        return 0, float('nan'), float('nan')
+    return loaded, (databaseBytes(path) - startBytes) / loaded, payloadBytes / loaded
+
+def intList(text):
+    return [int(v) for v in text.split(",")]
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("-t", "--topics", type=intList, default=[1, 10, 100], help="Comma separated topic counts to run")
+    parser.add_argument("-p", "--publications", type=intList, default=[1, 4], help="Comma separated publications per topic to run")
+    parser.add_argument("-d", "--db_size", type=intList, default=[0, 100000], help="Comma separated numbers of prefilled events to run")
+    parser.add_argument("-e", "--events", type=int, default=20000, help="Number of increments to send per case")
+    parser.add_argument("--debounce", type=float, default=0.0, help="Service publication debounce window")
+    parser.add_argument("--batch_size", type=int, default=256, help="Writer batch size")
+    parser.add_argument("--flush_interval", type=float, default=0.05, help="Writer flush interval")
+    parser.add_argument("--shards", type=int, default=0, help="Number of database shards")
+    parser.add_argument("--compact_payloads", action="store_true", help="Store payloads in the compact encoding")
+    parser.add_argument("--payload", type=counterdb.json.loads, help="JSON payload to send with every increment")
+    parser.add_argument("--payload_source", type=str, help="Measure payload storage on the events of this database instead")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for repeatable runs")
+    parser.add_argument("--keep", type=str, help="Directory to keep the benchmark databases in")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    serviceArgs = {"debounce": args.debounce, "batchSize": args.batch_size, "flushInterval": args.flush_interval,
+                   "shards": args.shards, "compactPayloads": args.compact_payloads}
+    directory = args.keep if args.keep else tempfile.mkdtemp(prefix="counterbench")
+    if args.payload_source:
+        try:
+            print("{:>8} {:>8} {:>9} {:>9}".format("encoding", "events", "B/event", "payload B"))
+            for compactPayloads in (False, True):
+                loaded, bytesPerEvent, payloadBytes = payloadCase(directory, args.payload_source, args.shards, compactPayloads)
+                print("{:>8} {:>8d} {:>9.1f} {:>9.1f}".format("compact" if compactPayloads else "text", loaded,
+                                                             bytesPerEvent, payloadBytes))
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory)
+        sys.exit(0)
+    header = "{:>6} {:>4} {:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:>8} {:>9} {:>7}".format(
+        "topics", "pubs", "db_size", "ingest/s", "durable/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "publishes", "B/event")
+    print(header)
+    try:
+        for topics, publications, dbSize in itertools.product(args.topics, args.publications, args.db_size):
+            r = runCase(directory, topics, publications, dbSize, args.events, serviceArgs, args.payload)
+            print("{topics:>6d} {publications:>4d} {dbSize:>8d} {ingestRate:>10.0f} {durableRate:>10.0f} "
+                  "{p50ms:>8.2f} {p90ms:>8.2f} {p99ms:>8.2f} {maxms:>8.2f} {publishes:>9d} {bytesPerEvent:>7.1f}".format(
+                      p50ms=r["p50"]*1000, p90ms=r["p90"]*1000, p99ms=r["p99"]*1000, maxms=r["max"]*1000, **r))
+            sys.stdout.flush()
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
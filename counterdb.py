@@ -10,8 +10,14 @@ import time
 import threading
 import json
 import sqlite3
+import queue
+import csv
+import io
+import heapq
 import paho.mqtt.client as mqtt
-import Flask
+import flask
+from countersegments import SegmentStore
+import counterpayloads
 
 def topicJoin(*args):
     return "/".join(args)
@@ -20,6 +26,321 @@ def stripSQLWhitespace(text):
     "Attempt to strip irrelivant differences between SQL statements"
     return re.sub(re.compile('\s+'), '', text) # This needs to be smarter, it strips too much
 
+def nextBoundary(schedule, after):
+    "Returns the first local time boundary of a CounterDB schedule period strictly after the given time"
+    lt = time.localtime(after)
+    if schedule == CounterDB.MINUTELY:
+        fields = (lt.tm_year, lt.tm_mon, lt.tm_mday, lt.tm_hour, lt.tm_min + 1)
+    elif schedule == CounterDB.HOURLY:
+        fields = (lt.tm_year, lt.tm_mon, lt.tm_mday, lt.tm_hour + 1, 0)
+    elif schedule == CounterDB.DAILY:
+        fields = (lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0)
+    elif schedule == CounterDB.WEEKLY: # Weeks start on Monday
+        fields = (lt.tm_year, lt.tm_mon, lt.tm_mday + 7 - lt.tm_wday, 0, 0)
+    elif schedule == CounterDB.MONTHLY:
+        fields = (lt.tm_year, lt.tm_mon + 1, 1, 0, 0)
+    else:
+        raise ValueError("Schedule {!r} has no boundaries".format(schedule))
+    # mktime normalizes the overflowed fields and works out daylight saving
+    boundary = time.mktime(fields + (0, 0, 0, -1))
+    if boundary <= after: # Repeated hour when daylight saving ends
+        return nextBoundary(schedule, after + 3600)
+    return boundary
+
+def connect(database):
+    "Opens a connection to the database in WAL mode which may be shared between threads"
+    db = sqlite3.connect(database, timeout=30.0, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class EventWriter(threading.Thread):
+    """Dedicated writer thread for the events table.
+    Events are fed through a bounded queue and group committed, many events per transaction, when either batchSize
+    events are pending or flushInterval seconds have passed since the first pending event was queued.
+    """
+
+    INSERT = "INSERT INTO events (topic, time, count, payload) VALUES(?, ?, ?, ?)"
+    RETRY_DELAY = 0.05 # Seconds to wait before retrying a batch the database was too busy for, doubling each time
+    MAX_RETRY_DELAY = 5.0
+    ROLLUP_UPSERT = "INSERT INTO {} (topic, bucket, events, total) VALUES(?, ?, ?, ?) " \
+                    "ON CONFLICT(topic, bucket) DO UPDATE SET events=events+excluded.events, total=total+excluded.total"
+
+    def __init__(self, database, batchSize=256, flushInterval=0.05, queueSize=4096, onCommit=None, rollups=(), codec=None):
+        """Set up the writer, call start() to begin committing
+        @param database File path name for the persistant database file, must be the same one CounterDB uses
+        @param batchSize Maximum number of events to commit in one transaction
+        @param flushInterval Maximum time in seconds an event waits for its batch to fill before being committed
+        @param queueSize Maximum number of pending events, update blocks when the queue is full
+        @param onCommit Called from the writer thread with the set of topic IDs in each committed batch
+        @param rollups (table, strftime format) pairs of rollup tables to update in the same transaction as the events
+        @param codec If not None, a counterpayloads.PayloadCodec used to store payloads compactly
+        """
+        threading.Thread.__init__(self, name="CounterDB writer", daemon=True)
+        self.db = connect(database)
+        self.queue = queue.Queue(queueSize)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.onCommit = onCommit
+        self.rollups = tuple(rollups)
+        self.codec = codec
+        if codec is not None:
+            codec.load(self.db)
+        self.statsLock = threading.Lock()
+        self.events = 0
+        self.batches = 0
+        self.errors = 0
+        self.retries = 0 # Number of times a batch was retried because the database was busy
+        self.dropped = 0 # Number of events dropped because the database rejected them
+        self.resetStats()
+
+    def resetStats(self):
+        "Start a new window for the rate and latency statistics"
+        with self.statsLock:
+            self.windowStart = time.time()
+            self.windowEvents = 0
+            self.windowLatency = 0.0
+            self.windowMaxLatency = 0.0
+
+    def stats(self, reset=True):
+        """Returns a dictionary of the events committed per second and how long events waited to become durable since
+        the last reset.
+        """
+        now = time.time()
+        with self.statsLock:
+            elapsed = now - self.windowStart
+            rslt = {
+                "events":         self.events,
+                "batches":        self.batches,
+                "errors":         self.errors,
+                "retries":        self.retries,
+                "dropped":        self.dropped,
+                "pending":        self.queue.qsize(),
+                "eventsPerSecond": self.windowEvents / elapsed if elapsed > 0 else 0.0,
+                "meanLatency":    self.windowLatency / self.windowEvents if self.windowEvents else 0.0,
+                "maxLatency":     self.windowMaxLatency,
+            }
+        if reset:
+            self.resetStats()
+        return rslt
+
+    def put(self, tid, timestamp, count, payload):
+        "Queue an event to be written, blocks if the queue is full"
+        self.queue.put((tid, timestamp, count, payload))
+
+    def flush(self, timeout=None):
+        "Blocks until all events queued before the call have been committed. Returns False on timeout."
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        "Commit all pending events and stop the writer thread"
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        self.db.close()
+
+    def rollup(self, batch):
+        "Aggregates a batch of events into (table, rows) increments for each rollup table"
+        sums = [{} for r in self.rollups]
+        for tid, timestamp, count, payload in batch:
+            local = time.localtime(timestamp)
+            for (table, fmt), acc in zip(self.rollups, sums):
+                key = (tid, time.strftime(fmt, local))
+                n, total = acc.get(key, (0, 0.0))
+                acc[key] = (n + 1, total + count)
+        return [(table, [(tid, bucket, n, total) for (tid, bucket), (n, total) in acc.items()])
+                for (table, fmt), acc in zip(self.rollups, sums)]
+
+    def encode(self, batch):
+        "Returns the batch with payloads in their stored form, must be called inside the transaction which writes it"
+        if self.codec is None:
+            return [(tid, timestamp, count, counterpayloads.encodeText(payload)) for tid, timestamp, count, payload in batch]
+        return [(tid, timestamp, count, self.codec.encode(self.db, payload)) for tid, timestamp, count, payload in batch]
+
+    def write(self, batch):
+        "Write a batch of events and its rollup increments in a single transaction"
+        try:
+            with self.db:
+                self.db.executemany(self.INSERT, self.encode(batch))
+                for table, rows in self.rollup(batch):
+                    self.db.executemany(self.ROLLUP_UPSERT.format(table), rows)
+        except sqlite3.Error:
+            if self.codec is not None:
+                self.codec.load(self.db) # Forget payloads interned by the rolled back transaction
+            raise
+
+    def retry(self, batch):
+        "Write a batch of events, retrying with backoff until it commits while the database is busy or locked"
+        delay = self.RETRY_DELAY
+        while True:
+            try:
+                return self.write(batch)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                self.errors += 1
+                self.retries += 1
+                sys.stderr.write("Retrying {:d} events in {:0.2f}s: {}{}".format(len(batch), delay, e, os.linesep))
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+
+    def commit(self, batch):
+        """Write a batch of events, which have already been acknowledged so must not be lost.
+        While the database is busy or locked, e.g. by a long import, the batch is kept and retried until it commits.
+        If the database rejects the batch it is written an event at a time, dropping only the events it rejects.
+        """
+        try:
+            self.retry(batch)
+        except sqlite3.Error as e:
+            self.errors += 1
+            sys.stderr.write("Failed to commit {:d} events, committing them one at a time: {}{}".format(len(batch), e, os.linesep))
+            accepted = []
+            for event in batch:
+                try:
+                    self.retry([event])
+                    accepted.append(event)
+                except sqlite3.Error as e:
+                    self.errors += 1
+                    self.dropped += 1
+                    sys.stderr.write("Dropped event {!r}: {}{}".format(event, e, os.linesep))
+            batch = accepted
+        if batch:
+            self.committed(batch)
+
+    def committed(self, batch):
+        "Record statistics and report the topics of events which have been committed"
+        now = time.time()
+        latencies = [now - timestamp for tid, timestamp, count, payload in batch]
+        with self.statsLock:
+            self.events += len(batch)
+            self.batches += 1
+            self.windowEvents += len(batch)
+            self.windowLatency += sum(latencies)
+            self.windowMaxLatency = max(self.windowMaxLatency, max(latencies))
+        if self.onCommit is not None:
+            self.onCommit(set(tid for tid, timestamp, count, payload in batch))
+
+    def run(self):
+        "Writer thread main loop"
+        running = True
+        while running:
+            item = self.queue.get()
+            batch = []
+            waiters = []
+            deadline = time.time() + self.flushInterval
+            while True:
+                if item is None:
+                    running = False
+                    break
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batchSize:
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(True, timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                self.commit(batch)
+            for w in waiters:
+                w.set()
+
+class Compactor(threading.Thread):
+    """Background job enforcing the events retention policy.
+    Raw events older than retentionDays are deleted, along with their minutely rollups, leaving the hourly, daily and
+    monthly rollups as the downsampled history. If a SegmentStore is given the events are first moved into columnar
+    segments instead, where only CounterDB.aggregate and aggregateByMonth read them. Deletes run in transactions of at
+    most chunkSize rows with a pause between them so the EventWriter never waits long for the write lock.
+    """
+
+    def __init__(self, database, retentionDays, minutelyTable, topics, chunkSize=1000, interval=3600.0, pause=0.05, segments=None,
+                 onChange=None):
+        """Set up the compactor, call start() to run it periodically or compact() to run it once
+        @param database File path name for the persistant database file holding the events
+        @param retentionDays How many days of raw events to keep, None to keep them all
+        @param minutelyTable Name of the minutely rollup table which is pruned along with the raw events
+        @param topics Callable returning the IDs of the topics whose events are in the database
+        @param chunkSize Maximum number of rows deleted per transaction
+        @param interval Seconds between compaction runs
+        @param pause Seconds to yield the write lock between chunks
+        @param segments If not None, SegmentStore to tier events past the retention period into
+        @param onChange Called from the compactor with the set of topic IDs whose events or rollups it removed
+        """
+        threading.Thread.__init__(self, name="CounterDB compactor", daemon=True)
+        self.db = connect(database)
+        self.retentionDays = retentionDays
+        self.minutelyTable = minutelyTable
+        self.topics = topics
+        self.chunkSize = chunkSize
+        self.interval = interval
+        self.pause = pause
+        self.segments = segments
+        self.onChange = onChange
+        self.exitEvent = threading.Event()
+        self.compacted = 0
+        self.tiered = 0
+
+    def close(self):
+        "Stop the compactor thread"
+        self.exitEvent.set()
+        if self.is_alive():
+            self.join()
+        if self.segments is not None:
+            self.segments.close()
+        self.db.close()
+
+    def deleteChunks(self, sql, params):
+        "Repeatedly runs a bounded DELETE until it removes nothing, returns the number of rows deleted"
+        deleted = 0
+        while not self.exitEvent.is_set():
+            with self.db:
+                rows = self.db.execute(sql, params).rowcount
+            deleted += rows
+            if rows < self.chunkSize:
+                break
+            self.exitEvent.wait(self.pause)
+        return deleted
+
+    def compact(self, now=None):
+        "Tiers or deletes raw events older than the retention period, returns the number of events removed"
+        if now is None:
+            now = time.time()
+        if self.retentionDays is None:
+            return 0
+        cutoff = now - self.retentionDays * 86400
+        tiered = 0 if self.segments is None else self.segments.tier(self.db, cutoff, self.chunkSize,
+                                                                    lambda: self.exitEvent.wait(self.pause))
+        self.tiered += tiered
+        rslt = self.deleteChunks("DELETE FROM events WHERE id IN (SELECT id FROM events WHERE time < ? ORDER BY time LIMIT ?)",
+                                 (cutoff, self.chunkSize))
+        topics = self.topics()
+        changed = set(topics) if tiered or rslt else set() # Which topics lost events isn't known, so all of them
+        bucket = time.strftime(CounterDB.ROLLUPS[CounterDB.MINUTELY][1], time.localtime(cutoff))
+        for tid in topics:
+            if self.deleteChunks("DELETE FROM {0} WHERE topic=? AND bucket IN (SELECT bucket FROM {0} WHERE topic=? AND bucket < ? ORDER BY bucket LIMIT ?)".format(self.minutelyTable),
+                                 (tid, tid, bucket, self.chunkSize)):
+                changed.add(tid)
+        if changed and self.onChange is not None:
+            self.onChange(changed)
+        self.compacted += rslt
+        return rslt
+
+    def run(self):
+        "Compactor thread main loop"
+        while not self.exitEvent.is_set():
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                sys.stderr.write("Compaction failed: {}{}".format(e, os.linesep))
+            self.exitEvent.wait(self.interval)
+
 class CounterDB:
     "Persistant database interface for counter service."
 
@@ -27,6 +348,19 @@ class CounterDB:
         "topics":  "CREATE TABLE topics (id INTEGER PRIMARY KEY, topic TEXT UNIQUE NOT NULL)",
         "events":  "CREATE TABLE events (id INTEGER PRIMARY KEY, topic INTEGER, time REAL, count REAL, payload TEXT, FOREIGN KEY(topic) REFERENCES topics(id))",
         "publish": "CREATE TABLE publish (id INTEGER PRIMARY KEY, queryTopic INTEGER, schedule INTEGER, publishTopic TEXT UNIQUE NOT NULL, query TEXT NOT NULL, FOREIGN KEY(queryTopic) REFERENCES topics(id))",
+        "rollup_minutely": "CREATE TABLE rollup_minutely (topic INTEGER, bucket TEXT, events INTEGER NOT NULL, total REAL NOT NULL, PRIMARY KEY(topic, bucket), FOREIGN KEY(topic) REFERENCES topics(id)) WITHOUT ROWID",
+        "rollup_hourly":   "CREATE TABLE rollup_hourly (topic INTEGER, bucket TEXT, events INTEGER NOT NULL, total REAL NOT NULL, PRIMARY KEY(topic, bucket), FOREIGN KEY(topic) REFERENCES topics(id)) WITHOUT ROWID",
+        "rollup_daily":    "CREATE TABLE rollup_daily (topic INTEGER, bucket TEXT, events INTEGER NOT NULL, total REAL NOT NULL, PRIMARY KEY(topic, bucket), FOREIGN KEY(topic) REFERENCES topics(id)) WITHOUT ROWID",
+        "rollup_monthly":  "CREATE TABLE rollup_monthly (topic INTEGER, bucket TEXT, events INTEGER NOT NULL, total REAL NOT NULL, PRIMARY KEY(topic, bucket), FOREIGN KEY(topic) REFERENCES topics(id)) WITHOUT ROWID",
+        "segments": "CREATE TABLE segments (month TEXT, part INTEGER, rows INTEGER NOT NULL, pending INTEGER NOT NULL, PRIMARY KEY(month, part))",
+        "payloads": "CREATE TABLE payloads (id INTEGER PRIMARY KEY, data BLOB UNIQUE NOT NULL)",
+    }
+
+    # Indexes are created on start up if missing
+    INDEXES = {
+        "events_topic_time": "CREATE INDEX events_topic_time ON events (topic, time, count)", # Covers windowed counts and sums
+        "events_time":       "CREATE INDEX events_time ON events (time)", # Retention scans
+        "events_topic":      "CREATE INDEX events_topic ON events (topic)", # Keyset export, implicitly (topic, id)
     }
     
     # Schedule enumeration used in publish table, do not modify or the schema will break
@@ -36,49 +370,220 @@ class CounterDB:
     DAILY = 3
     WEEKLY = 4
     MONTHLY = 5
-    
 
-    def setupDatabase(self):
+    # Rollup tables for schedules, buckets are local time formatted the same way in python and SQLite's strftime.
+    # Each format must be a prefix of the finer ones, see updateRollups.
+    ROLLUPS = {
+        MINUTELY: ("rollup_minutely", "%Y-%m-%d %H:%M"),
+        HOURLY:   ("rollup_hourly",   "%Y-%m-%d %H"),
+        DAILY:    ("rollup_daily",    "%Y-%m-%d"),
+        MONTHLY:  ("rollup_monthly",  "%Y-%m"),
+    }
+    ROLLUP_COLUMNS = ("events", "total")
+
+    # Tables in the catalog database and those which are split across shard files in sharded mode
+    CATALOG_TABLES = ("topics", "publish")
+    SHARD_TABLES = ("events", "rollup_minutely", "rollup_hourly", "rollup_daily", "rollup_monthly", "segments", "payloads")
+    MAX_SHARDS = 10 # SQLite's default limit on attached databases
+
+    TIME_DEPENDENT_RE = re.compile(r"'now'|\bcurrent_(?:date|time|timestamp)\b", re.IGNORECASE)
+
+    def setupDatabase(self, db, tables):
         "Checks the database tables and schema and updates if nessisary"
-        cursor = self.db.cursor()
+        cursor = db.cursor()
         cursor.execute("SELECT name, sql FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
-        for name, sql in tables:
-            if name not in self.SCHEMA:
-                sys.exit("Database file has unexpected table, {}, aborting".format(t))
+        existing = cursor.fetchall()
+        for name, sql in existing:
+            if name not in tables:
+                sys.exit("Database file has unexpected table, {}, aborting".format(name))
             elif stripSQLWhitespace(sql) != stripSQLWhitespace(self.SCHEMA[name]):
                 sys.exit("Database table {} has differining schema{linesep}\tFile:     {}{linesep}\tExpected: {}{linesep}Aborting.".format(name, sql, self.SCHEMA[name], linesep=os.linesep))
-        existingTableNames = [name for name, sql in tables]
-        for table in ("topics", "events", "publish"): # Explicit to get the right order to happen
+        existingTableNames = [name for name, sql in existing]
+        for table in tables: # Explicit to get the right order to happen
             sql = self.SCHEMA[table]
             if not table in existingTableNames:
                 cursor.execute(sql)
                 print("Created table", table)
+        if "events" not in tables:
+            return
+        newRollups = [s for s, (table, fmt) in self.ROLLUPS.items() if table not in existingTableNames]
+        if "events" in existingTableNames and newRollups:
+            print("Building rollups from existing events")
+            self.updateRollups(schedules=newRollups, cursor=cursor)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")
+        existingIndexNames = [name for name, in cursor.fetchall()]
+        for index, sql in self.INDEXES.items():
+            if index not in existingIndexNames:
+                print("Creating index", index)
+                cursor.execute(sql)
+
+    def updateRollups(self, afterID=0, schedules=None, cursor=None, source="events"):
+        """Adds events with id greater than afterID into the rollup tables.
+        Used to build rollups for events which were not written through the EventWriter. If no cursor is given, all the
+        shards are updated.
+        @param source Table to read the events from, which needs id, topic, time and count columns
+        """
+        if schedules is None:
+            schedules = self.ROLLUPS.keys()
+        if cursor is None:
+            for path in self.shardPaths:
+                db = connect(path)
+                with db:
+                    self.updateRollups(afterID, schedules, db.cursor(), source)
+                db.close()
+            return
+        # Events are grouped by UTC minute with integer math first so strftime only runs once per minute with events,
+        # the coarser buckets are then prefixes of the minutely bucket text.
+        minutely = self.ROLLUPS[self.MINUTELY][1]
+        cursor.execute("CREATE TEMP TABLE rollup_delta AS "
+                       "SELECT topic, strftime(?, minute * 60, 'unixepoch', 'localtime') AS bucket, SUM(n) AS events, SUM(t) AS total FROM "
+                       "(SELECT topic, CAST(time / 60 AS INTEGER) AS minute, COUNT(*) AS n, SUM(count) AS t FROM {} WHERE id > ? GROUP BY 1, 2) "
+                       "GROUP BY 1, 2".format(source), (minutely, afterID))
+        for schedule in schedules:
+            table, fmt = self.ROLLUPS[schedule]
+            cursor.execute("INSERT INTO {} (topic, bucket, events, total) "
+                           "SELECT topic, substr(bucket, 1, ?), SUM(events), SUM(total) FROM temp.rollup_delta WHERE true GROUP BY 1, 2 "
+                           "ON CONFLICT(topic, bucket) DO UPDATE SET events=events+excluded.events, total=total+excluded.total".format(table),
+                           (len(time.strftime(fmt, time.localtime(0))),))
+        cursor.execute("DROP TABLE temp.rollup_delta")
 
-    def __init__(self, database):
-        "Initalizes the persistant database connection, initalizing the database if nessisary"
-        self.db = sqlite3.connect(database)
-        self.setupDatabase()
+    def __init__(self, database, onCommit=None, retentionDays=None, compactChunk=1000, shards=0, tiering=False,
+                 compactPayloads=False, **writerArgs):
+        """Initalizes the persistant database connection, initalizing the database if nessisary
+        @param database File path name for the persistant database file
+        @param onCommit Called from the writer thread with the set of topic IDs which have new events committed
+        @param retentionDays If not None, raw events older than this many days are compacted in the background
+        @param compactChunk Maximum number of rows the compactor deletes per transaction
+        @param shards If not 0, events are stored in this many shard files next to the database, see connectReader
+        @param tiering If True, events past the retention period are moved into columnar segments rather than deleted
+        @param compactPayloads If True, new payloads are stored in the compact encoding of counterpayloads. Either
+                               encoding is decoded by exportEvents but queries on the payload column only understand the
+                               original JSON text.
+        @param writerArgs Batching options passed through to EventWriter
+        """
+        if tiering and retentionDays is None:
+            raise ValueError("Tiering moves events past the retention period into segments, so needs retentionDays")
+        self.lock = threading.RLock()
+        self.database = database
+        self.shards = shards
+        if shards:
+            if shards > self.MAX_SHARDS:
+                raise ValueError("At most {:d} shards are supported".format(self.MAX_SHARDS))
+            self.shardPaths = ["{}.shard{:d}".format(database, i) for i in range(shards)]
+            for path in self.shardPaths:
+                db = connect(path)
+                with db:
+                    self.setupDatabase(db, self.SHARD_TABLES)
+                db.close()
+            db = connect(database)
+            with db:
+                self.setupDatabase(db, self.CATALOG_TABLES)
+            db.close()
+        else:
+            self.shardPaths = [database]
+            db = connect(database)
+            with db:
+                self.setupDatabase(db, self.CATALOG_TABLES + self.SHARD_TABLES)
+            db.close()
+        self.db = self.connectReader()
+        self.topicIDs = dict(self.query("SELECT topic, id FROM topics"))
+        self.schedules = None
+        self.onCommit = onCommit
+        self.cacheLock = threading.Lock()
+        self.topicGenerations = {}
+        self.resultCache = {} # Publication id -> (topic generation, query, result)
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.compactPayloads = compactPayloads
+        self.internedPayloads = [{} for path in self.shardPaths] # Reference id -> stored form, per shard
+        self.writers = [EventWriter(path, onCommit=self.committed, rollups=self.ROLLUPS.values(),
+                                    codec=counterpayloads.PayloadCodec() if compactPayloads else None, **writerArgs)
+                        for path in self.shardPaths]
+        for writer in self.writers:
+            writer.start()
+        # Readers get their own segment stores, the compactors tier through separate ones
+        self.segmentStores = [SegmentStore(path + ".segments") if tiering or os.path.isdir(path + ".segments") else None
+                              for path in self.shardPaths]
+        self.compactors = []
+        if retentionDays is not None or tiering:
+            for i, path in enumerate(self.shardPaths):
+                topics = lambda shard=i: [tid for tid in list(self.topicIDs.values()) if self.shardOf(tid) == shard]
+                segments = SegmentStore(path + ".segments") if tiering else None
+                self.compactors.append(Compactor(path, retentionDays, self.ROLLUPS[self.MINUTELY][0], topics, compactChunk,
+                                                 segments=segments, onChange=self.compactedTopics))
+            for compactor in self.compactors:
+                compactor.start()
+
+    def connectReader(self):
+        """Opens a connection for reading the database.
+        In sharded mode the shard files are attached and each shard table is presented as a temporary view of the same
+        name which is the UNION ALL of that table in every shard, so publication queries written against a single file
+        aggregate across all shards without modification. Event ids are only unique within a shard.
+        """
+        db = connect(self.database)
+        if self.shards:
+            for i, path in enumerate(self.shardPaths):
+                db.execute("ATTACH DATABASE ? AS shard{:d}".format(i), (path,))
+            for table in self.SHARD_TABLES:
+                union = " UNION ALL ".join("SELECT * FROM shard{:d}.{}".format(i, table) for i in range(self.shards))
+                db.execute("CREATE TEMP VIEW {} AS {}".format(table, union))
+        return db
+
+    def shardOf(self, tid):
+        "Returns the index of the shard storing a topic's events"
+        return tid % len(self.writers)
+
+    def writerStats(self, reset=True):
+        "Returns the writer statistics combined across shards, see EventWriter.stats"
+        stats = [w.stats(reset) for w in self.writers]
+        rslt = {}
+        for key in ("events", "batches", "errors", "retries", "dropped", "pending", "eventsPerSecond"):
+            rslt[key] = sum(s[key] for s in stats)
+        rate = rslt["eventsPerSecond"]
+        rslt["meanLatency"] = sum(s["meanLatency"] * s["eventsPerSecond"] for s in stats) / rate if rate else 0.0
+        rslt["maxLatency"] = max(s["maxLatency"] for s in stats)
+        return rslt
 
     def __del__(self):
-        self.db.close()
+        self.close()
 
-    def query(self, query, cursor=None):
-        "Run a query on the database"
-        if cursor is None:
-            cursor = self.db.cursor()
-        cursor.execute(query)
-        return cursor.fetchall()
+    def close(self):
+        "Commits pending events and closes the database"
+        if getattr(self, 'db', None) is not None:
+            for compactor in self.compactors:
+                compactor.close()
+            for writer in self.writers:
+                writer.close()
+            for store in self.segmentStores:
+                if store is not None:
+                    store.close()
+            self.db.close()
+            self.db = None
+
+    def flush(self, timeout=None):
+        "Blocks until all events logged so far are committed"
+        return all([writer.flush(timeout) for writer in self.writers])
 
-    @staticmethod
-    def getTopicID(self, cursor, topic):
+    def query(self, query, params=(), cursor=None):
+        "Run a query on the database, values should be passed in params rather than formatted into the query"
+        with self.lock:
+            if cursor is None:
+                cursor = self.db.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def getTopicID(self, topic):
         "Returns the ID of a given topic name"
-        cursor.execute("SELECT id from topics WHERE name='{}'".format(topic))
-        rslt = cursor.fetchall()[0]
-        if len(result) != 1:
-            raise ValueError("Couldn't retrieve topic ID for \"{}\": {}".format(topic, repr(result)))
+        try:
+            return self.topicIDs[topic]
+        except KeyError:
+            pass
+        rslt = self.query("SELECT id FROM topics WHERE topic=?", (topic,))
+        if len(rslt) != 1:
+            raise ValueError("Couldn't retrieve topic ID for \"{}\": {}".format(topic, repr(rslt)))
         else:
-            return rslt[0]
+            self.topicIDs[topic] = rslt[0][0]
+            return rslt[0][0]
 
     @property
     def topics(self):
@@ -87,44 +592,342 @@ class CounterDB:
 
     def createTopic(self, topic):
         "Create a new count topic."
-        return self.query("INSERT INTO topics (topic) VALUES('{}')".format(topic))
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT INTO topics (topic) VALUES(?)", (topic,))
+            self.topicIDs[topic] = cursor.lastrowid
+            return cursor.lastrowid
 
     def update(self, topic, increment, payload=None):
-        "Logs an event for the specified topic. Returns the toptic id"
-        cursor = self.db.cursor()
-        tid = self.getTopicID(cursor, topic)
-        if payload is not None and type(payload) != str:
-            payload = json.dumps(payload)
-        cursor.execute("INSERT INTO events (topic, time, count, payload) VALUES({topic}, {time}, {count}, '{payload}')".format(topic=tid, time=time.time(), count=increment, payload=payload))
-        return tid;
+        """Logs an event for the specified topic. Returns the toptic id
+        The event is queued for the writer thread, it is durable once the onCommit callback reports its topic.
+        """
+        tid = self.getTopicID(topic)
+        increment = float(increment)
+        self.invalidateTopic(tid)
+        self.writers[self.shardOf(tid)].put(tid, time.time(), increment, payload)
+        return tid
+
+    def decodePayload(self, tid, stored, db=None):
+        "Returns a payload read from a topic's events in either storage encoding"
+        shard = self.shardOf(tid)
+        interned = self.internedPayloads[shard]
+        def lookup(pid):
+            if pid not in interned:
+                table = "shard{:d}.payloads".format(shard) if self.shards else "payloads"
+                sql = "SELECT data FROM {} WHERE id=?".format(table)
+                rslt = db.execute(sql, (pid,)).fetchall() if db is not None else self.query(sql, (pid,))
+                if not rslt:
+                    raise ValueError("Missing interned payload {:d}".format(pid))
+                interned[pid] = rslt[0][0]
+            return interned[pid]
+        return counterpayloads.decode(stored, lookup)
+
+    def importEvents(self, rows, batchSize=100000, deferIndexes=True, progress=None):
+        """Bulk loads (topic, time, count, payload) events, bypassing the writer queue.
+        Topics are created as they are first seen and events are inserted in transactions of batchSize rows. With
+        deferIndexes the events indexes are dropped for the load and rebuilt once at the end, which is much faster than
+        updating them row by row, but slows the service's queries if it is writing to the database during the import.
+        Each transaction also adds its rows to the rollups, from a copy of just those rows so events the service commits
+        meanwhile aren't counted twice. Returns the number of events loaded.
+        @param progress If not None, called with the running total after every transaction
+        """
+        self.flush()
+        dbs = [connect(path) for path in self.shardPaths]
+        codecs = [counterpayloads.PayloadCodec() if self.compactPayloads else None for db in dbs]
+        def write(db, codec, batch):
+            # Payloads are encoded inside the transaction as interning writes to the payloads table
+            with db:
+                if codec is None:
+                    batch = [(tid, t, count, counterpayloads.encodeText(payload)) for tid, t, count, payload in batch]
+                else:
+                    batch = [(tid, t, count, codec.encode(db, payload)) for tid, t, count, payload in batch]
+                db.executemany(EventWriter.INSERT, batch)
+                db.execute("DELETE FROM temp.imported")
+                db.executemany("INSERT INTO temp.imported (topic, time, count) VALUES(?, ?, ?)",
+                               ((tid, t, count) for tid, t, count, payload in batch))
+                self.updateRollups(cursor=db.cursor(), source="temp.imported")
+        try:
+            for db, codec in zip(dbs, codecs):
+                db.execute("CREATE TEMP TABLE imported (id INTEGER PRIMARY KEY, topic INTEGER, time REAL, count REAL)")
+                if codec is not None:
+                    codec.load(db)
+            if deferIndexes:
+                for db in dbs:
+                    with db:
+                        for index in self.INDEXES:
+                            db.execute("DROP INDEX IF EXISTS {}".format(index))
+            loaded = 0
+            batches = [[] for db in dbs]
+            pending = 0
+            for topic, t, count, payload in rows:
+                try:
+                    tid = self.getTopicID(topic)
+                except ValueError:
+                    tid = self.createTopic(topic)
+                batches[self.shardOf(tid)].append((tid, float(t), float(count), payload))
+                pending += 1
+                if pending >= batchSize:
+                    for db, codec, batch in zip(dbs, codecs, batches):
+                        write(db, codec, batch)
+                        batch.clear()
+                    loaded += pending
+                    pending = 0
+                    if progress is not None:
+                        progress(loaded)
+            for db, codec, batch in zip(dbs, codecs, batches):
+                write(db, codec, batch)
+            loaded += pending
+            if progress is not None:
+                progress(loaded)
+        finally:
+            for db in dbs:
+                with db:
+                    for sql in self.INDEXES.values():
+                        db.execute(sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS"))
+                db.close()
+            for tid in self.topicIDs.values():
+                self.invalidateTopic(tid)
+        return loaded
     
     def createPublication(self, queryTopic, publishTopic, query, schedule=NO_SCHEDULE):
         "Adds an entry to the scheduled topics"
-        cursor = self.db.cursor()
-        tid = self.getTopicID(cursor, queryTopic)
-        return self.query("INSERT INTO publish (queryTopic, schedule, publishTopic, query) VALUES({querryTopic}, {schedule}, {publishTopic}, {query})".format(querryTopic=tid, publishTopic=publishTopic, query=query, schedule=schedule), cursor)
+        tid = self.getTopicID(queryTopic)
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT INTO publish (queryTopic, schedule, publishTopic, query) VALUES(?, ?, ?, ?)",
+                                     (tid, schedule, publishTopic, query))
+            self.schedules = None
+            return cursor.lastrowid
         
+    def exportEvents(self, topic, start=None, end=None, after=0, limit=None, pageSize=1000):
+        """Generator yielding (id, time, count, payload) for a topic's events in id order, payloads decoded.
+        Rows are read a page at a time with keyset pagination on the event id over a dedicated connection, so memory use
+        is constant no matter how many events are exported and the shared connection is never held for long.
+        @param topic The topic name or ID to export
+        @param start If not None, only events at or after this time
+        @param end If not None, only events before this time
+        @param after Only events with id greater than this, pass the last id received to resume an export
+        @param limit If not None, maximum number of events to yield
+        """
+        if type(topic) is not int:
+            topic = self.getTopicID(topic)
+        sql = "SELECT id, time, count, payload FROM events WHERE topic=? AND id>? AND time>=? AND time<? ORDER BY id LIMIT ?"
+        start = float('-inf') if start is None else start
+        end = float('inf') if end is None else end
+        db = self.connectReader()
+        try:
+            while limit is None or limit > 0:
+                n = pageSize if limit is None else min(pageSize, limit)
+                page = db.execute(sql, (topic, after, start, end, n)).fetchall()
+                for eid, t, count, payload in page:
+                    yield eid, t, count, self.decodePayload(topic, payload, db)
+                if len(page) < n:
+                    break
+                after = page[-1][0]
+                if limit is not None:
+                    limit -= len(page)
+        finally:
+            db.close()
+
+    def aggregate(self, topic, start=None, end=None):
+        """Returns the (number of events, sum of counts) for a topic between start and end.
+        Tiered segments are aggregated column wise and combined with the live events table, so unlike publication
+        queries and exportEvents this includes events past the retention period when tiering.
+        """
+        if type(topic) is not int:
+            topic = self.getTopicID(topic)
+        with self.lock:
+            store = self.segmentStores[self.shardOf(topic)]
+            events, total = (0, 0.0) if store is None else store.aggregate(topic, start, end)
+            n, t = self.query("SELECT COUNT(*), TOTAL(count) FROM events WHERE topic=? AND time>=? AND time<?",
+                              (topic, float('-inf') if start is None else start, float('inf') if end is None else end))[0]
+        return events + n, total + t
+
+    def aggregateByMonth(self, topic, start=None, end=None):
+        "Returns {month: (number of events, sum of counts)} for a topic between start and end from segments and live events"
+        if type(topic) is not int:
+            topic = self.getTopicID(topic)
+        with self.lock:
+            store = self.segmentStores[self.shardOf(topic)]
+            rslt = {} if store is None else store.aggregateByMonth(topic, start, end)
+            live = self.query("SELECT strftime('%Y-%m', time, 'unixepoch', 'localtime'), COUNT(*), TOTAL(count) FROM events "
+                              "WHERE topic=? AND time>=? AND time<? GROUP BY 1",
+                              (topic, float('-inf') if start is None else start, float('inf') if end is None else end))
+        for month, n, t in live:
+            events, total = rslt.get(month, (0, 0.0))
+            rslt[month] = (events + n, total + t)
+        return rslt
+
+    def rollupQuery(self, topic, rollup, column="events"):
+        """Returns SQL for a publication reading the current period of a rollup, e.g. the count of events today or the sum
+        of increments this month. The lookup is a single primary key read no matter how many events are in the database.
+        @param topic The topic name or ID to read
+        @param rollup The schedule enumeration value of the rollup period, MINUTELY, HOURLY, DAILY or MONTHLY
+        @param column "events" for the number of events or "total" for the sum of their increments
+        """
+        if type(topic) is not int:
+            topic = self.getTopicID(topic)
+        if rollup not in self.ROLLUPS:
+            raise ValueError("No rollup for schedule {!r}".format(rollup))
+        if column not in self.ROLLUP_COLUMNS:
+            raise ValueError("Rollup column must be one of {!r}".format(self.ROLLUP_COLUMNS))
+        table, fmt = self.ROLLUPS[rollup]
+        return "SELECT COALESCE(SUM({column}), 0) FROM {table} WHERE topic={topic:d} AND bucket=strftime('{fmt}', 'now', 'localtime')".format(
+            column=column, table=table, topic=topic, fmt=fmt)
+
+    def createRollupPublication(self, queryTopic, publishTopic, rollup, column="events", schedule=NO_SCHEDULE):
+        "Adds a publication of the current period of a rollup, see rollupQuery"
+        return self.createPublication(queryTopic, publishTopic, self.rollupQuery(queryTopic, rollup, column), schedule)
+
     def deletePublication(self, id):
         "Removes a publication from the list"
-        return self.query("DELETE FROM publish WHERE id={:d}".format(id))
+        with self.cacheLock:
+            self.resultCache.pop(id, None)
+        with self.lock, self.db:
+            self.schedules = None
+            return self.query("DELETE FROM publish WHERE id=?", (id,))
 
     def getTopicPublications(self, topic):
-        "Returns the publications which querry the given topic."
-        cursor = self.db.cursor()
+        "Returns the (id, queryTopic, publishTopic, query) of publications which querry the given topic."
         if type(topic) is not int:
             topic = self.getTopicID(topic)
-        return self.query("SELECT publishTopic, query FROM publish WHERE queryTopic={:d}".format(topic), cursor)
+        return self.query("SELECT id, queryTopic, publishTopic, query FROM publish WHERE queryTopic=?", (topic,))
         
     def getSchedulePublications(self, schedule):
-        "Returns the publications which have the given schedule"
-        return self.query("SELECT queryTopic, publishTopic, query FROM publish WHERE schedule={:d}".format(schedule))
+        """Returns the (id, queryTopic, publishTopic, query) of publications which have the given schedule.
+        Publications are kept in memory by schedule and reloaded after a publication is created or deleted.
+        """
+        with self.lock:
+            if self.schedules is None:
+                self.schedules = {}
+                for row in self.query("SELECT schedule, id, queryTopic, publishTopic, query FROM publish"):
+                    self.schedules.setdefault(row[0], []).append(row[1:])
+            return list(self.schedules.get(schedule, []))
+
+    def invalidateTopic(self, tid):
+        "Marks cached publication results for the topic as stale"
+        with self.cacheLock:
+            self.topicGenerations[tid] = self.topicGenerations.get(tid, 0) + 1
+
+    def committed(self, topicIDs):
+        "Writer callback, invalidates cached results before passing the commit on"
+        for tid in topicIDs:
+            self.invalidateTopic(tid)
+        if self.onCommit is not None:
+            self.onCommit(topicIDs)
+
+    def compactedTopics(self, topicIDs):
+        "Compactor callback, invalidates cached results of topics whose events or rollups were removed"
+        for tid in topicIDs:
+            self.invalidateTopic(tid)
+
+    def publicationResult(self, pid, queryTopic, query):
+        """Returns the result of a publication's query.
+        Results are cached by publication ID until an event for queryTopic is logged or compacted away. Queries which depend on the current
+        time, e.g. rollupQuery, are always run since their result changes without any write.
+        """
+        cacheable = self.TIME_DEPENDENT_RE.search(query) is None
+        if cacheable:
+            with self.cacheLock:
+                generation = self.topicGenerations.get(queryTopic, 0)
+                cached = self.resultCache.get(pid)
+                if cached is not None and cached[0] == generation and cached[1] == query:
+                    self.cacheHits += 1
+                    return cached[2]
+                self.cacheMisses += 1
+        rslt = self.query(query)
+        if cacheable:
+            with self.cacheLock:
+                # Only keep the result if no write landed while the query ran
+                if self.topicGenerations.get(queryTopic, 0) == generation:
+                    self.resultCache[pid] = (generation, query, rslt)
+        return rslt
         
 
+class PublicationDebouncer(threading.Thread):
+    """Coalesces publication updates during bursts of events.
+    Publications are marked dirty when their topic changes and published once no further change has arrived for window
+    seconds, or once they have been dirty for maxStaleness seconds, and never more than once per window. The last
+    publish always happens after the last change so the published value converges to the final count.
+    """
+
+    def __init__(self, publish, window, maxStaleness=None):
+        """Set up the debouncer, call start() to begin publishing
+        @param publish Called from the debouncer thread with the (id, queryTopic, publishTopic, query) of each publication due
+        @param window Seconds of quiet to wait for before publishing
+        @param maxStaleness If not None, maximum seconds a publication may stay dirty during a continuous burst
+        """
+        threading.Thread.__init__(self, name="Publication debouncer", daemon=True)
+        self.publish = publish
+        self.window = window
+        self.maxStaleness = maxStaleness
+        self.cond = threading.Condition()
+        self.pending = {} # Publication id -> [first dirty time, last dirty time, publication]
+        self.lastPublished = {}
+        self.running = True
+        self.marked = 0
+        self.published = 0
+
+    def mark(self, publications):
+        "Marks (id, queryTopic, publishTopic, query) publications dirty"
+        now = time.time()
+        with self.cond:
+            for publication in publications:
+                pid = publication[0]
+                self.marked += 1
+                if pid in self.pending:
+                    entry = self.pending[pid]
+                    entry[1:] = [now, publication]
+                else:
+                    self.pending[pid] = [now, now, publication]
+            self.cond.notify()
+
+    def dueTime(self, pid, entry):
+        "Returns when a pending publication should be published"
+        firstDirty, lastDirty, publication = entry
+        due = lastDirty + self.window
+        if self.maxStaleness is not None:
+            due = min(due, firstDirty + self.maxStaleness)
+        return max(due, self.lastPublished.get(pid, 0.0) + self.window)
+
+    def close(self):
+        "Publish anything pending and stop the debouncer thread"
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        "Debouncer thread main loop"
+        while True:
+            with self.cond:
+                while True:
+                    now = time.time()
+                    if not self.running:
+                        due = list(self.pending.items())
+                        break
+                    due = [(pid, entry) for pid, entry in self.pending.items() if self.dueTime(pid, entry) <= now]
+                    if due:
+                        break
+                    elif self.pending:
+                        self.cond.wait(min(self.dueTime(pid, entry) for pid, entry in self.pending.items()) - now)
+                    else:
+                        self.cond.wait()
+                for pid, entry in due:
+                    del self.pending[pid]
+                    self.lastPublished[pid] = now
+                self.published += len(due)
+                running = self.running
+            for pid, (firstDirty, lastDirty, publication) in due:
+                self.publish(*publication)
+            if not running:
+                break
+
 class CounterService:
     "MQTT sercvice which listens for increment messages and publishes counts"
 
     def vprint(self, level, text, out=sys.stdout):
-        if level > self.verbose:
+        if level <= self.verbose:
             out.write(text)
             out.write(os.linesep)
             
@@ -133,87 +936,254 @@ class CounterService:
         out.write(os.linesep)
         out.flush()
 
+    def publishQuery(self, pid, queryTopic, publishTopic, query):
+        "Runs a publication's query, or uses its cached result, and publishes the result"
+        self.vprint(2, "Publishing update for \"{}\"".format(publishTopic))
+        self.vprint(3, "\tquery = {}".format(query))
+        result = json.dumps(self.db.publicationResult(pid, queryTopic, query))
+        self.vprint(3, "\tresult = {}".format(result))
+        self.client.publish(publishTopic, result, qos=1, retain=True)
+
     def publishTopicUpdates(self, topic):
         "Publishes all updates for a given topic"
-        for publishTopic, query in self.db.getTopicPublications(t):
-            self.vprint(2, "Publishing update for \"{}\"".format(publishTopic))
-            self.vprint(3, "\tquery = {}".format(query))
-            result = json.dumps(self.db.query(query))
-            self.vprint(3, "\tresult = {}".format(result))
-            client.publish(publishTopic, result, qos=1, retain=True)
+        for publication in self.db.getTopicPublications(topic):
+            self.publishQuery(*publication)
+
+    def on_commit(self, topicIDs):
+        "Database writer callback when events for the given topics have become durable"
+        for tid in topicIDs:
+            if self.debouncer is None:
+                self.publishTopicUpdates(tid)
+            else:
+                self.debouncer.mark(self.db.getTopicPublications(tid))
+
+    def publishStats(self):
+        "Reports the database writer throughput and latency"
+        stats = self.db.writerStats()
+        self.vprint(1, "Writer: {eventsPerSecond:0.1f} events/s, latency mean {meanLatency:0.3f}s max {maxLatency:0.3f}s, {pending:d} pending".format(**stats))
+        if self.debouncer is not None:
+            stats["publicationsMarked"] = self.debouncer.marked
+            stats["publicationsPublished"] = self.debouncer.published
+        stats["resultCacheHits"] = self.db.cacheHits
+        stats["resultCacheMisses"] = self.db.cacheMisses
+        lateness, self.lateness = self.lateness, []
+        stats["scheduleMaxLateness"] = max(lateness) if lateness else 0.0
+        stats["scheduleMisfires"] = self.misfires
+        if self.statsTopic:
+            self.client.publish(self.statsTopic, json.dumps(stats), qos=1, retain=True)
 
     def on_connect(self, client, userdata, flags, rc):
         "MQTT client callback on connection to the broker"
         self.vprint(0, "MQTT client connected")
-        for t in self.db.topics:
+        for t, in self.db.topics:
             client.subscribe(t, qos=2)
             self.vprint(1, "Subscribed to topic \"{}\"".format(t))
             self.publishTopicUpdates(t)
 
     def on_message(self, client, userdata, msg):
         "MQTT client callback on received message"
-        self.vprint(1, "RX: {0.topic:s} -> {0.payload:s}".format(msg))
-        tid = None
+        self.vprint(1, "RX: {0.topic:s} -> {0.payload!r}".format(msg))
         try:
             payload = json.loads(msg.payload)
             if type(payload) is list:
-                tid = self.db.update(msg.topic, *payload)
+                self.db.update(msg.topic, *payload)
             elif type(payload) is dict:
-                tid = self.db.update(msg.topic, **payload)
+                self.db.update(msg.topic, **payload)
             elif type(payload) in (int, float):
-                tid = self.db.update(msg.topic, increment=payload)
+                self.db.update(msg.topic, increment=payload)
         except Exception as e:
-            self.eprint(e)
-        else:
-            self.publishTopicUpdates(tid)
+            self.eprint(str(e))
+        # Topic updates are published by on_commit once the writer has committed the event
 
-    def __init__(self, clientID, database, http_port, verbosity=0):
+    def __init__(self, clientID, database, http_port, verbosity=0, statsTopic=None, debounce=0.0, maxStaleness=None,
+                 misfireGrace=30.0, misfirePolicy="coalesce", **dbArgs):
         """Initalize the counter DB service
         @param clientID The MQTT client ID for this node
         @param database File path name for the peristant dabase file
         @param http_port Port to open web interface on
         @param verbosity How much debug printing to do
+        @param statsTopic If not None, topic to publish database writer statistics to every minute
+        @param debounce Seconds to coalesce publication updates over, 0 publishes after every commit
+        @param maxStaleness If not None, maximum seconds a debounced publication may lag its topic
+        @param misfireGrace Seconds late a scheduled publication may run before it is considered misfired
+        @param misfirePolicy "coalesce" to run a misfired schedule once or "skip" to drop it
+        @param dbArgs Retention and batching options for the database
         """
         self.client = mqtt.Client(clientID, not clientID)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.verbose = verbosity
-        self.db = CounterDB(database)
+        self.statsTopic = statsTopic
+        self.misfireGrace = misfireGrace
+        self.misfirePolicy = misfirePolicy
+        self.misfires = 0
+        self.lateness = []
+        if debounce > 0:
+            self.debouncer = PublicationDebouncer(self.publishQuery, debounce, maxStaleness)
+            self.debouncer.start()
+        else:
+            self.debouncer = None
+        self.db = CounterDB(database, onCommit=self.on_commit, **dbArgs)
+
+    def close(self):
+        "Commits pending events, publishes pending updates and closes the database"
+        self.db.flush()
+        if self.debouncer is not None:
+            self.debouncer.close()
+        self.db.close()
         
     def doSchedulePublications(self, schedule):
         "Publishes updates for the given schedule"
         self.vprint(2, "Schedule publications for {}".format(schedule))
-        for queryTopic, publishTopic, query in self.db.getSchedulePublications(schedule):
-            self.vprint(2, "Publishing update for \"{}\"".format(publishTopic))
-            self.vprint(3, "\tquery = {}".format(query))
-            result = json.dumps(self.db.query(query))
-            self.vprint(3, "\tresult = {}".format(result))
-            client.publish(publishTopic, result, qos=1, retain=True)
+        for publication in self.db.getSchedulePublications(schedule):
+            self.publishQuery(*publication)
     
     def timerRun(self, exitEvent):
-        lastTime = time.localtime()
-        while exitEvent.wait(60.0) is False:
-            newTime = time.localtime()
-            if newTime.tm_min != lastTime.tm_min:
-                self.doSchedulePublications(self.db.MINUTELY)
-            if newTime.tm_hour != lastTime.tm_hour:
-                self.doSchedulePublications(self.db.HOURLY)
-            if newTime.tm_yday != lastTime.tm_yday:
-                self.doSchedulePublications(self.db.DAILY)
-            if newTime.tm_wday < lastTime.tm_wday: # Week has rolled over
-                self.doSchedulePublications(self.db.WEEKLY)
-            if newTime.tm_mon != lastTime.tm_mon:
-                self.doSchedulePublications(self.db.MONTHLY)
-            lastTime = newTime
+        """Scheduled publication thread.
+        Sleeps until the earliest upcoming schedule boundary and publishes that schedule. If the thread wakes more than
+        misfireGrace seconds late, e.g. after the system was suspended, misfirePolicy decides whether the missed
+        boundary is published once ("coalesce") or not at all ("skip"). Either way the schedule resumes from the next
+        boundary after the current time rather than catching up on every missed period.
+        """
+        schedules = (self.db.MINUTELY, self.db.HOURLY, self.db.DAILY, self.db.WEEKLY, self.db.MONTHLY)
+        now = time.time()
+        heap = [(nextBoundary(s, now), s) for s in schedules]
+        heapq.heapify(heap)
+        while True:
+            deadline, schedule = heap[0]
+            timeout = deadline - time.time()
+            if timeout > 0:
+                if exitEvent.wait(timeout):
+                    break
+                continue # Check the clock again in case the wall time was stepped while waiting
+            heapq.heappop(heap)
+            now = time.time()
+            lateness = now - deadline
+            if lateness > self.misfireGrace:
+                self.eprint("Schedule {} boundary misfired by {:0.1f}s, {}".format(schedule, lateness, self.misfirePolicy))
+                self.misfires += 1
+                fire = self.misfirePolicy == "coalesce"
+                deadline = now
+            else:
+                self.lateness.append(lateness)
+                fire = True
+            if fire:
+                self.vprint(2, "Schedule {} running {:0.3f}s after boundary".format(schedule, lateness))
+                self.doSchedulePublications(schedule)
+                if schedule == self.db.MINUTELY:
+                    self.publishStats()
+            heapq.heappush(heap, (nextBoundary(schedule, deadline), schedule))
     
-def run(self, service, mqttConnectArgs, app, appRunOptions={}, noMQTT=False, noHTTP=False):
+def createApp(service):
+    "Creates the Flask web application for the service"
+    app = flask.Flask(__name__)
+
+    def floatArg(name):
+        value = flask.request.args.get(name)
+        return None if value is None else float(value)
+
+    @app.route("/topics")
+    def topics():
+        "List count topics"
+        return flask.jsonify([t for t, in service.db.topics])
+
+    @app.route("/events/<path:topic>")
+    def events(topic):
+        """Stream a topic's events as NDJSON (default) or CSV (format=csv).
+        Optional query parameters start and end bound the event time, after resumes from an event id and limit caps the
+        number of events.
+        """
+        try:
+            tid = service.db.getTopicID(topic)
+        except ValueError:
+            flask.abort(404, "No such topic")
+        try:
+            limit = flask.request.args.get("limit")
+            rows = service.db.exportEvents(tid, floatArg("start"), floatArg("end"), int(flask.request.args.get("after", 0)),
+                                           None if limit is None else int(limit))
+        except ValueError as e:
+            flask.abort(400, str(e))
+        if flask.request.args.get("format", "ndjson") == "csv":
+            def generate():
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                writer.writerow(("id", "time", "count", "payload"))
+                for eid, t, count, payload in rows:
+                    writer.writerow((eid, t, count, "" if payload is None else json.dumps(payload)))
+                    if buf.tell() > 0x10000:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+                yield buf.getvalue()
+            mimetype = "text/csv"
+        else:
+            def generate():
+                for eid, t, count, payload in rows:
+                    yield json.dumps({"id": eid, "time": t, "count": count, "payload": payload}) + "\n"
+            mimetype = "application/x-ndjson"
+        return flask.Response(flask.stream_with_context(generate()), mimetype=mimetype)
+
+    return app
+
+def readJSONL(f):
+    "Yields (topic, time, count, payload) from lines of JSON objects with those keys or JSON lists in that order"
+    for n, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if type(row) is dict:
+            yield row["topic"], row["time"], row.get("count", 1), row.get("payload")
+        elif type(row) is list and 2 <= len(row) <= 4:
+            yield tuple(row) + (1, None)[len(row) - 2:]
+        else:
+            raise ValueError("Line {:d} is not an event: {}".format(n, line.strip()))
+
+def readCSV(f):
+    "Yields (topic, time, count, payload) from CSV with a header row naming the columns, payloads are JSON text"
+    for row in csv.DictReader(f):
+        payload = row.get("payload")
+        yield row["topic"], row["time"], row.get("count") or 1, json.loads(payload) if payload else None
+
+def importMain(argv):
+    "Entry point for the import subcommand"
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="counterdb.py import", description="Bulk load events into a counter database")
+    parser.add_argument("database", type=str, help="Database to load events into")
+    parser.add_argument("files", nargs="+", type=str, help="JSONL or CSV files of topic, time, count, payload events, - for stdin")
+    parser.add_argument("-f", "--format", choices=("jsonl", "csv"), help="Input format, by default guessed from the file extension")
+    parser.add_argument("--batch", type=int, default=100000, help="Events per transaction")
+    parser.add_argument("--keep_indexes", action="store_true", help="Update indexes row by row instead of rebuilding them after the load, use when the service is writing to the database")
+    parser.add_argument("--shards", type=int, default=0, help="Number of shards the database was created with")
+    parser.add_argument("--compact_payloads", action="store_true", help="Store payloads in the compact binary and interned encoding")
+    args = parser.parse_args(argv)
+    db = CounterDB(args.database, shards=args.shards, compactPayloads=args.compact_payloads)
+    def rows():
+        for path in args.files:
+            fmt = args.format or ("csv" if path.endswith(".csv") else "jsonl")
+            reader = readCSV if fmt == "csv" else readJSONL
+            if path == "-":
+                yield from reader(sys.stdin)
+            else:
+                with open(path, newline="" if fmt == "csv" else None) as f:
+                    yield from reader(f)
+    start = time.time()
+    def progress(n):
+        sys.stdout.write("\r{:d} events, {:0.0f}/s".format(n, n / max(time.time() - start, 1e-6)))
+        sys.stdout.flush()
+    try:
+        loaded = db.importEvents(rows(), args.batch, not args.keep_indexes, progress)
+    finally:
+        db.close()
+    print("{}Imported {:d} events in {:0.1f}s".format(os.linesep, loaded, time.time() - start))
+
+def run(service, mqttConnectArgs, app, appRunOptions={}, noMQTT=False, noHTTP=False):
     """Lifecycle for all the threads"""
     service.client.loop_start()
     if not noMQTT:
         service.client.connect(*mqttConnectArgs)
     exitEvent = threading.Event()
     timerThread = threading.Thread(target=service.timerRun, args=(exitEvent,))
-    service.timerThread.start()
+    timerThread.start()
     # App.run is the main thread
     if not noHTTP:
         app.run(**appRunOptions)
@@ -225,11 +1195,14 @@ def run(self, service, mqttConnectArgs, app, appRunOptions={}, noMQTT=False, noH
     # After app.run exits, we tear down
     exitEvent.set()
     service.client.loop_stop()
+    service.close()
 
 
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        sys.exit(importMain(sys.argv[2:]))
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument("database",  type=str, help="Where to load/store persistant data")
@@ -239,7 +1212,20 @@ if __name__ == '__main__':
     parser.add_argument('-k', "--brokerKeepAlive", type=int, help="MQTT keep alive seconds")
     parser.add_argument('-n', "--bind", type=str, help="Local interface to bind to for connection to broker")
     parser.add_argument('-w', "--http_port", type=int, default=5000, help="Which port to open web interface on")
-    parser.add_argument('-v', "--verbose", action="count", help="Increase debugging verbosity")
+    parser.add_argument('-v', "--verbose", action="count", default=0, help="Increase debugging verbosity")
+    parser.add_argument('-s', "--stats_topic", type=str, help="Topic to publish database writer statistics to")
+    parser.add_argument("--batch_size", type=int, default=256, help="Maximum number of events committed in one transaction")
+    parser.add_argument("--flush_interval", type=float, default=0.05, help="Maximum seconds an event waits before being committed")
+    parser.add_argument("--queue_size", type=int, default=4096, help="Maximum number of events waiting to be committed")
+    parser.add_argument("--debounce", type=float, default=0.0, help="Seconds to coalesce publication updates over during bursts")
+    parser.add_argument("--max_staleness", type=float, help="Maximum seconds a debounced publication may lag behind its topic")
+    parser.add_argument("--misfire_grace", type=float, default=30.0, help="Seconds late a scheduled publication may run before it is a misfire")
+    parser.add_argument("--misfire_policy", choices=("coalesce", "skip"), default="coalesce", help="Whether to run a misfired schedule once or skip it")
+    parser.add_argument("--shards", type=int, default=0, help="Split events across this many database files, each with its own writer")
+    parser.add_argument("--tier_segments", action="store_true", help="Move events past --retention_days into columnar segment files instead of deleting them")
+    parser.add_argument("--retention_days", type=float, help="Compact raw events older than this many days into the rollups")
+    parser.add_argument("--compact_chunk", type=int, default=1000, help="Maximum number of rows deleted per compaction transaction")
+    parser.add_argument("--compact_payloads", action="store_true", help="Store new event payloads in the compact binary and interned encoding")
     parser.add_argument("--dev_no_mqtt", action="store_true", help="Don't connect to MQTT broker, for testing only.")
     parser.add_argument("--dev_no_http", action="store_true", help="Don't set up HTTP server, for testing only.")
     args = parser.parse_args()
@@ -249,6 +1235,10 @@ if __name__ == '__main__':
     if args.bind: brokerConnect.append(args.bind)
     
     global counter
-    counter = CounterService(args.clientID, args.database, args.http_port, args.verbose)
-    app = flask.Flask(__name__)
-    run(counter, brokerConnect, app, {'port'=args.http_port}, args.dev_no_mqtt, args.dev_no_http)
+    counter = CounterService(args.clientID, args.database, args.http_port, args.verbose, args.stats_topic,
+                             args.debounce, args.max_staleness, args.misfire_grace, args.misfire_policy,
+                             retentionDays=args.retention_days, compactChunk=args.compact_chunk, shards=args.shards,
+                             tiering=args.tier_segments, compactPayloads=args.compact_payloads,
+                             batchSize=args.batch_size, flushInterval=args.flush_interval, queueSize=args.queue_size)
+    app = createApp(counter)
+    run(counter, brokerConnect, app, {'port': args.http_port}, args.dev_no_mqtt, args.dev_no_http)
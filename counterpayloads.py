@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Compact storage for counter event payloads.
+Payloads are stored in the events table's payload column as NULL when there is no payload, otherwise as a BLOB in a
+small tagged binary encoding or, when that would not be shorter, as compact JSON text. Payloads which repeat are
+interned into the payloads table and the event stores a short reference BLOB to the interned row instead. Rows written
+before compact storage, which hold str() of the payload, are still decoded.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import json
+import math
+import struct
+
+# Type tags, one byte ahead of each encoded value. Non-negative integers below 0x80 are their own tag with the high bit set.
+NONE = 0x00
+FALSE = 0x01
+TRUE = 0x02
+INT = 0x03     # Zig-zag varint
+FLOAT16 = 0x04 # Used when the value round trips exactly
+FLOAT32 = 0x05
+FLOAT64 = 0x06
+STR = 0x07     # Varint byte length, UTF-8
+LIST = 0x08    # Varint item count, items
+DICT = 0x09    # Varint item count, (key as varint length and UTF-8, value) pairs
+REF = 0x0a     # Varint id of an interned payload, only at the top level of a stored payload
+DECIMAL = 0x0b # DECIMAL + k for k in 1 to MAX_DECIMALS, zig-zag varint of the value times 10**k, for sensor readings
+MAX_DECIMALS = 4
+SMALL = 0x80
+
+def packVarint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def unpackVarint(data, i):
+    "Returns the varint at index i of data and the index after it"
+    n = shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def packString(s, out):
+    b = s.encode("utf-8")
+    packVarint(len(b), out)
+    out.extend(b)
+
+def packZigzag(n, out):
+    packVarint(n * 2 if n >= 0 else -n * 2 - 1, out)
+
+def unpackZigzag(data, i):
+    n, i = unpackVarint(data, i)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), i
+
+def packValue(value, out):
+    "Appends the encoding of a JSON compatible value to the bytearray out"
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif type(value) is int:
+        if 0 <= value < SMALL:
+            out.append(SMALL | value)
+        else:
+            out.append(INT)
+            packZigzag(value, out)
+    elif type(value) is float:
+        decimals = MAX_DECIMALS if value or math.copysign(1.0, value) > 0 else 0 # -0.0 would lose its sign
+        for k in range(1, decimals + 1):
+            scale = 10 ** k
+            if abs(value) < 2**40 and round(value * scale) / scale == value:
+                out.append(DECIMAL + k)
+                packZigzag(round(value * scale), out)
+                return
+        for tag, fmt in ((FLOAT16, "<e"), (FLOAT32, "<f")):
+            try:
+                b = struct.pack(fmt, value)
+            except (OverflowError, struct.error):
+                continue
+            if struct.unpack(fmt, b)[0] == value or value != value:
+                out.append(tag)
+                out.extend(b)
+                return
+        out.append(FLOAT64)
+        out.extend(struct.pack("<d", value))
+    elif type(value) is str:
+        out.append(STR)
+        packString(value, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        packVarint(len(value), out)
+        for v in value:
+            packValue(v, out)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        packVarint(len(value), out)
+        for k, v in value.items():
+            packString(str(k), out)
+            packValue(v, out)
+    else:
+        raise TypeError("Can't encode payload of type {}".format(type(value).__name__))
+
+def unpackValue(data, i):
+    "Returns the value encoded at index i of data and the index after it"
+    tag = data[i]
+    i += 1
+    if tag & SMALL:
+        return tag & 0x7f, i
+    elif tag == NONE:
+        return None, i
+    elif tag == FALSE:
+        return False, i
+    elif tag == TRUE:
+        return True, i
+    elif tag == INT:
+        return unpackZigzag(data, i)
+    elif DECIMAL < tag <= DECIMAL + MAX_DECIMALS:
+        n, i = unpackZigzag(data, i)
+        return n / 10 ** (tag - DECIMAL), i
+    elif tag == FLOAT16:
+        return struct.unpack_from("<e", data, i)[0], i + 2
+    elif tag == FLOAT32:
+        return struct.unpack_from("<f", data, i)[0], i + 4
+    elif tag == FLOAT64:
+        return struct.unpack_from("<d", data, i)[0], i + 8
+    elif tag == STR:
+        n, i = unpackVarint(data, i)
+        return bytes(data[i:i + n]).decode("utf-8"), i + n
+    elif tag == LIST:
+        n, i = unpackVarint(data, i)
+        items = []
+        for j in range(n):
+            v, i = unpackValue(data, i)
+            items.append(v)
+        return items, i
+    elif tag == DICT:
+        n, i = unpackVarint(data, i)
+        items = {}
+        for j in range(n):
+            k, i = unpackVarint(data, i)
+            key = bytes(data[i:i + k]).decode("utf-8")
+            items[key], i = unpackValue(data, i + k)
+        return items, i
+    raise ValueError("Bad payload tag 0x{:02x}".format(tag))
+
+def pack(value):
+    "Returns the binary encoding of a JSON compatible value"
+    out = bytearray()
+    packValue(value, out)
+    return bytes(out)
+
+def unpack(data):
+    "Returns the value of a binary encoded payload"
+    value, i = unpackValue(data, 0)
+    if i != len(data):
+        raise ValueError("Trailing bytes after payload")
+    return value
+
+def encodeText(payload):
+    "The original payload storage, str() of strings and JSON of anything else, including 'None' for no payload"
+    if payload is not None and type(payload) != str:
+        payload = json.dumps(payload)
+    return str(payload)
+
+def compactJSON(payload):
+    return json.dumps(payload, separators=(",", ":"))
+
+def encodeValue(payload, text=None):
+    "Returns the shorter of the binary and compact JSON text encodings of a payload, text if already known"
+    blob = pack(payload)
+    if text is None:
+        text = compactJSON(payload)
+    return blob if len(blob) <= len(text.encode("utf-8")) else text
+
+def decode(stored, interned=None):
+    """Returns the payload from its stored form in the events table
+    @param interned Called with a reference id to get the stored form of an interned payload
+    """
+    if stored is None:
+        return None
+    if isinstance(stored, bytes):
+        if stored[:1] == bytes((REF,)):
+            if interned is None:
+                raise ValueError("Payload reference without an interned payload table")
+            return decode(interned(unpackVarint(stored, 1)[0]))
+        return unpack(stored)
+    if stored == "None":
+        return None
+    try:
+        return json.loads(stored)
+    except ValueError:
+        return stored # Plain strings stored by encodeText
+
+class PayloadCodec:
+    """Encodes payloads for one database file, interning repeated payloads into its payloads table.
+    A payload is interned the second time it is seen, so one-off payloads are stored inline and do not grow the table.
+    Interned rows are never deleted so references remain valid as events are compacted.
+    """
+
+    SELECT = "SELECT id, data FROM payloads"
+    INSERT = "INSERT INTO payloads (data) VALUES(?)"
+
+    def __init__(self, internLimit=4096, minInternSize=4):
+        """Set up an encoder, call load() with the database before encoding
+        @param internLimit Maximum number of payloads to intern
+        @param minInternSize Payloads whose stored form is shorter than this many bytes are always stored inline
+        """
+        self.internLimit = internLimit
+        self.minInternSize = minInternSize
+        self.refs = {}  # compact JSON -> reference BLOB, JSON is much faster to produce than the binary encoding
+        self.seen = set()
+
+    def load(self, db):
+        "Read the interned payloads, also used to resynchronize after a failed transaction"
+        self.refs = {compactJSON(decode(data)): self.reference(pid) for pid, data in db.execute(self.SELECT)}
+        self.seen = set()
+
+    @staticmethod
+    def reference(pid):
+        out = bytearray((REF,))
+        packVarint(pid, out)
+        return bytes(out)
+
+    def encode(self, db, payload):
+        """Returns the form of a payload to store in the events table.
+        Must be called inside the transaction which writes the event as new interned payloads are inserted with db.
+        """
+        if payload is None:
+            return None
+        text = compactJSON(payload)
+        ref = self.refs.get(text)
+        if ref is not None:
+            return ref
+        stored = encodeValue(payload, text)
+        if len(stored) < self.minInternSize or len(self.refs) >= self.internLimit:
+            return stored
+        if text not in self.seen:
+            if len(self.seen) >= 4 * self.internLimit:
+                self.seen.clear()
+            self.seen.add(text)
+            return stored
+        self.seen.discard(text)
+        ref = self.reference(db.execute(self.INSERT, (stored,)).lastrowid)
+        self.refs[text] = ref
+        return ref
+
+if __name__ == '__main__':
+    # Unit tests
+    import sqlite3
+    values = [None, True, False, 0, 127, 128, -1, -2**40, 2**70, 0.5, 21.37, 1e300, float("inf"), "", "temp", "°C",
+              -3.25, -0.0, 1e-7, 0.1 + 0.2, [], [1, [2.5, "x"]], {}, {"temp": 21.5, "ok": True, "tags": ["a", None]}]
+    for v in values:
+        assert unpack(pack(v)) == v, "FAIL: {!r} did not round trip".format(v)
+        assert type(unpack(pack(v))) is type(v), "FAIL: {!r} changed type".format(v)
+    for legacy, value in (("None", None), ("on", "on"), ('{"a": 1}', {"a": 1}), ("3", 3)):
+        assert decode(legacy) == value, "FAIL: legacy {!r}".format(legacy)
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE payloads (id INTEGER PRIMARY KEY, data BLOB UNIQUE NOT NULL)")
+    codec = PayloadCodec(internLimit=2)
+    payloads = [{"door": "open", "by": "schedule"}] * 3 + [[1, 2, 3]] * 3 + [{"unique": i} for i in range(3)] + ["x", None]
+    stored = [codec.encode(db, p) for p in payloads]
+    interned = dict(db.execute("SELECT id, data FROM payloads"))
+    assert len(interned) == 2, "FAIL: interned {!r}".format(interned)
+    assert [decode(s, interned.get) for s in stored] == payloads, "FAIL: payloads did not round trip"
+    assert stored[2] == stored[1] and len(stored[2]) == 2, "FAIL: repeated payload not referenced"
+    codec.load(db)
+    assert codec.encode(db, payloads[0]) == stored[2], "FAIL: reload lost interned payloads"
+    print("PASS")
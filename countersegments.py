@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Columnar cold storage for counter events.
+Events past the retention period are moved out of the SQLite events table into segment files for each month, instead
+of being deleted. A segment holds events sorted by topic then time with the topic column run length encoded
+into a directory and the time, count and event id columns stored as fixed width typed arrays, followed by the stored
+form of each payload. Segments are read back through mmap so aggregations only touch the rows they need and sum
+contiguous arrays, with numpy when it is available.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import os
+import mmap
+import struct
+import array
+import bisect
+import heapq
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"CSEG"
+VERSION = 2
+# magic, version, rows, topics, count type code, padding to keep the arrays which follow 8 byte aligned
+HEADER = struct.Struct("<4sIQQc7x")
+INT32_MAX = 0x7fffffff
+# Payload kinds, the first byte of a non-NULL payload's entry
+PAYLOAD_TEXT = b"t"
+PAYLOAD_BLOB = b"b"
+
+def monthStart(t):
+    "Returns the local time at which the month containing t started"
+    lt = time.localtime(t)
+    return time.mktime((lt.tm_year, lt.tm_mon, 1, 0, 0, 0, 0, 0, -1))
+
+def nextMonth(t):
+    "Returns the local time at which the month after the one containing t starts"
+    lt = time.localtime(t)
+    return time.mktime((lt.tm_year, lt.tm_mon + 1, 1, 0, 0, 0, 0, 0, -1))
+
+def monthName(t):
+    return time.strftime("%Y-%m", time.localtime(t))
+
+def packPayload(stored):
+    "Returns a payload's stored form, NULL, JSON text or an encoded BLOB, as a segment payload entry"
+    if stored is None:
+        return b""
+    elif type(stored) is str:
+        return PAYLOAD_TEXT + stored.encode("utf-8")
+    return PAYLOAD_BLOB + bytes(stored)
+
+def unpackPayload(entry):
+    if not entry:
+        return None
+    elif entry[:1] == PAYLOAD_TEXT:
+        return entry[1:].decode("utf-8")
+    return bytes(entry[1:])
+
+def writeSegment(path, rows):
+    """Writes (topic, time, count, id, payload) rows, which must be sorted by topic then time, to a segment file and
+    returns the number of rows written.
+    Counts are stored as 32 bit integers when they all are integers, otherwise as doubles. Payloads are kept in their
+    stored form, so interned payload references still resolve through the payloads table.
+    """
+    ids = array.array('q')
+    starts = array.array('q')
+    lengths = array.array('q')
+    times = array.array('d')
+    counts = array.array('d')
+    eventIDs = array.array('q')
+    payloadEnds = array.array('q')
+    payloads = bytearray()
+    for topic, t, count, eid, payload in rows:
+        if not ids or ids[-1] != topic:
+            ids.append(topic)
+            starts.append(len(times))
+            lengths.append(0)
+        lengths[-1] += 1
+        times.append(t)
+        counts.append(count)
+        eventIDs.append(eid)
+        payloads.extend(packPayload(payload))
+        payloadEnds.append(len(payloads))
+    if all(c == int(c) and abs(c) <= INT32_MAX for c in counts):
+        counts = array.array('i', (int(c) for c in counts))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(times), len(ids), counts.typecode.encode()))
+        for column in (ids, starts, lengths, times, eventIDs, counts):
+            column.tofile(f)
+        f.write(bytes(-f.tell() % 8)) # Keep the payload ends aligned after 32 bit counts
+        payloadEnds.tofile(f)
+        f.write(payloads)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(times)
+
+class Segment:
+    "A read only, memory mapped, segment file"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, topics, typecode = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError("{} is not a version {:d} counter segment".format(path, VERSION))
+        self.typecode = typecode.decode()
+        view = memoryview(self.mm)
+        offset = HEADER.size
+        directory = []
+        for i in range(3):
+            directory.append(view[offset:offset + 8 * topics].cast('q'))
+            offset += 8 * topics
+        self.directory = {tid: (start, length) for tid, start, length in zip(*directory)}
+        for column in directory:
+            column.release()
+        self.times = view[offset:offset + 8 * self.rows].cast('d')
+        offset += 8 * self.rows
+        self.eventIDs = view[offset:offset + 8 * self.rows].cast('q')
+        offset += 8 * self.rows
+        self.countsOffset = offset
+        self.counts = view[offset:offset + array.array(self.typecode).itemsize * self.rows].cast(self.typecode)
+        offset += self.counts.nbytes
+        offset += -offset % 8
+        self.payloadEnds = view[offset:offset + 8 * self.rows].cast('q')
+        self.payloadsOffset = offset + 8 * self.rows
+        view.release()
+
+    def close(self):
+        for column in (self.times, self.eventIDs, self.counts, self.payloadEnds):
+            column.release()
+        self.mm.close()
+
+    def __len__(self):
+        return self.rows
+
+    def span(self, topic, start=None, end=None):
+        "Returns the [first, last) row indices of a topic's events with start <= time < end"
+        if topic not in self.directory:
+            return 0, 0
+        first, length = self.directory[topic]
+        last = first + length
+        if start is not None:
+            first = bisect.bisect_left(self.times, start, first, last)
+        if end is not None:
+            last = bisect.bisect_left(self.times, end, first, last)
+        return first, last
+
+    def aggregate(self, topic, start=None, end=None):
+        "Returns the (number of events, sum of counts) for a topic between start and end"
+        first, last = self.span(topic, start, end)
+        if last <= first:
+            return 0, 0.0
+        if numpy is not None:
+            counts = numpy.frombuffer(self.mm, dtype=self.typecode, count=last - first,
+                                      offset=self.countsOffset + first * self.counts.itemsize)
+            total = float(counts.sum(dtype=numpy.float64))
+        else:
+            total = float(sum(self.counts[first:last]))
+        return last - first, total
+
+    def payload(self, i):
+        "Returns the stored form of row i's payload"
+        start = self.payloadEnds[i - 1] if i else 0
+        return unpackPayload(self.mm[self.payloadsOffset + start:self.payloadsOffset + self.payloadEnds[i]])
+
+    def __iter__(self):
+        "Iterates the (topic, time, count, id, payload) rows of the segment"
+        for tid, (first, length) in sorted(self.directory.items()):
+            for i in range(first, first + length):
+                yield tid, self.times[i], self.counts[i], self.eventIDs[i], self.payload(i)
+
+class SegmentStore:
+    """The segment files tiered from one events database file.
+    Each month is stored as one or more parts. Every tiering run appends the events it moves as a new part instead of
+    rewriting the month, the trailing parts are merged once they add up to as many rows as the part before them, so a
+    row is rewritten a logarithmic number of times as the month grows, and a month is merged into a single part once the
+    retention cutoff has passed its end.
+    The SQLite segments table records each part and its number of rows. A new part is recorded as pending before its
+    events are deleted, in transactions of at most chunkSize rows, and only renamed into place once they all are, so a
+    crash part way through tiering neither loses nor duplicates events.
+    """
+
+    SUFFIX = ".seg"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = {} # file name -> (mtime, Segment)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, month, part):
+        return os.path.join(self.directory, "{}.{:d}{}".format(month, part, self.SUFFIX))
+
+    def parts(self):
+        "Returns {month: sorted part numbers} of the segment files in the directory"
+        rslt = {}
+        for f in os.listdir(self.directory):
+            if f.endswith(self.SUFFIX):
+                month, part = f[:-len(self.SUFFIX)].rsplit(".", 1)
+                rslt.setdefault(month, []).append(int(part))
+        for month in rslt:
+            rslt[month].sort()
+        return rslt
+
+    def months(self):
+        "Returns the sorted names of the months which have segments"
+        return sorted(self.parts())
+
+    def open(self, month, part):
+        "Returns the Segment for a part of a month, reopening it if the file has been replaced"
+        path = self.path(month, part)
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.segments.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if cached is not None:
+            cached[1].close()
+        segment = Segment(path)
+        self.segments[path] = (mtime, segment)
+        return segment
+
+    def close(self):
+        for mtime, segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+    def forget(self, path):
+        "Closes a segment which has been merged away"
+        cached = self.segments.pop(path, None)
+        if cached is not None:
+            cached[1].close()
+
+    def recover(self, db, chunkSize=1000, wait=None):
+        """Finishes or discards segment writes interrupted by a crash.
+        Pending parts have the rest of their events deleted and are renamed into place, other recorded parts left
+        behind as temporary files by a merge are renamed into place and anything which isn't recorded is removed.
+        """
+        recorded = {(month, part): pending for month, part, pending in db.execute("SELECT month, part, pending FROM segments")}
+        for (month, part), pending in recorded.items():
+            tmp = self.path(month, part) + ".tmp"
+            if pending and not self.deletePart(db, month, part, tmp, chunkSize, wait):
+                return False
+            if os.path.exists(tmp):
+                os.replace(tmp, self.path(month, part))
+        for f in os.listdir(self.directory):
+            name = f[:-len(".tmp")] if f.endswith(self.SUFFIX + ".tmp") else f
+            if not name.endswith(self.SUFFIX):
+                continue
+            month, part = name[:-len(self.SUFFIX)].rsplit(".", 1)
+            if (month, int(part)) not in recorded:
+                self.forget(os.path.join(self.directory, name))
+                os.remove(os.path.join(self.directory, f))
+        return True
+
+    def deletePart(self, db, month, part, path, chunkSize=1000, wait=None):
+        """Deletes a pending part's events from the database chunkSize at a time, calling wait between chunks.
+        Returns False, leaving the part pending, if wait returns True to stop early.
+        """
+        segment = Segment(path)
+        try:
+            for i in range(0, len(segment), chunkSize):
+                if i and wait is not None and wait():
+                    return False
+                with db:
+                    db.executemany("DELETE FROM events WHERE id=?", ((eid,) for eid in segment.eventIDs[i:i + chunkSize]))
+        finally:
+            segment.close()
+        with db:
+            db.execute("UPDATE segments SET pending=0 WHERE month=? AND part=?", (month, part))
+        return True
+
+    def tier(self, db, before, chunkSize=1000, wait=None):
+        """Moves events from before the given time, normally the retention cutoff, into segments. Returns the number of
+        events moved.
+        @param chunkSize Maximum number of events deleted per transaction
+        @param wait If not None, called between transactions to yield the write lock, returning True stops tiering early
+        """
+        if not self.recover(db, chunkSize, wait):
+            return 0
+        moved = 0
+        t, = db.execute("SELECT MIN(time) FROM events WHERE time < ?", (before,)).fetchone()
+        while t is not None:
+            start = monthStart(t)
+            end = min(nextMonth(t), before)
+            rows, complete = self.tierMonth(db, monthName(start), start, end, chunkSize, wait)
+            moved += rows
+            if not complete:
+                return moved
+            t, = db.execute("SELECT MIN(time) FROM events WHERE time >= ? AND time < ?", (end, before)).fetchone()
+        for month, parts in self.parts().items():
+            if len(parts) > 1 and nextMonth(time.mktime(time.strptime(month, "%Y-%m"))) <= before:
+                self.merge(db, month, parts) # Close the month
+        return moved
+
+    def nextPart(self, db, month):
+        "Returns the number for a new part of a month"
+        last, = db.execute("SELECT MAX(part) FROM segments WHERE month=?", (month,)).fetchone()
+        return 0 if last is None else last + 1
+
+    def tierMonth(self, db, month, start, end, chunkSize=1000, wait=None):
+        """Appends a month's events between start and end to it as a new part, then merges its trailing parts.
+        Returns the number of events moved and whether all of them were deleted before wait stopped tiering.
+        """
+        parts = self.parts().get(month, [])
+        part = self.nextPart(db, month)
+        tmp = self.path(month, part) + ".tmp"
+        cursor = db.execute("SELECT topic, time, count, id, payload FROM events WHERE time >= ? AND time < ? "
+                            "ORDER BY topic, time", (start, end))
+        rows = writeSegment(tmp, cursor)
+        with db:
+            db.execute("INSERT INTO segments (month, part, rows, pending) VALUES(?, ?, ?, 1)", (month, part, rows))
+        if not self.deletePart(db, month, part, tmp, chunkSize, wait):
+            return rows, False
+        os.replace(tmp, self.path(month, part))
+        parts.append(part)
+        sizes = dict(db.execute("SELECT part, rows FROM segments WHERE month=?", (month,)).fetchall())
+        first, total = len(parts) - 1, rows
+        while first > 0 and sizes[parts[first - 1]] <= total:
+            first -= 1
+            total += sizes[parts[first]]
+        if len(parts) - first > 1:
+            self.merge(db, month, parts[first:])
+        return rows, True
+
+    def merge(self, db, month, parts):
+        "Rewrites some parts of a month as one new part"
+        part = self.nextPart(db, month)
+        tmp = self.path(month, part) + ".tmp"
+        segments = [Segment(self.path(month, p)) for p in parts]
+        try:
+            rows = writeSegment(tmp, heapq.merge(*segments, key=lambda r: (r[0], r[1])))
+        finally:
+            for segment in segments:
+                segment.close()
+        with db:
+            db.executemany("DELETE FROM segments WHERE month=? AND part=?", ((month, p) for p in parts))
+            db.execute("INSERT INTO segments (month, part, rows, pending) VALUES(?, ?, ?, 0)", (month, part, rows))
+        os.replace(tmp, self.path(month, part))
+        for p in parts:
+            self.forget(self.path(month, p))
+            os.remove(self.path(month, p))
+
+    def aggregate(self, topic, start=None, end=None):
+        "Returns the (number of events, sum of counts) stored in segments for a topic between start and end"
+        events, total = 0, 0.0
+        for month, (n, t) in self.aggregateByMonth(topic, start, end).items():
+            events += n
+            total += t
+        return events, total
+
+    def aggregateByMonth(self, topic, start=None, end=None):
+        "Returns {month: (number of events, sum of counts)} stored in segments for a topic between start and end"
+        rslt = {}
+        first = None if start is None else monthName(start)
+        last = None if end is None else monthName(end)
+        for month, parts in sorted(self.parts().items()):
+            if (first is not None and month < first) or (last is not None and month > last):
+                continue
+            events, total = 0, 0.0
+            for part in parts:
+                try:
+                    n, t = self.open(month, part).aggregate(topic, start, end)
+                except FileNotFoundError: # Merged away since the directory was listed
+                    continue
+                events += n
+                total += t
+            if events:
+                rslt[month] = (events, total)
+        return rslt
+
+if __name__ == '__main__':
+    # Unit tests
+    import tempfile
+    import random
+    directory = tempfile.mkdtemp()
+    payloads = (None, '{"eggs": 2}', b"\x85", b"")
+    rows = sorted((random.randrange(5), random.random() * 1000, float(random.randrange(10)), i, payloads[i % 4])
+                  for i in range(9999)) # Odd, so 32 bit counts need padding
+    path = os.path.join(directory, "test.seg")
+    writeSegment(path, rows)
+    s = Segment(path)
+    for topic in range(6):
+        expect = [r for r in rows if r[0] == topic and 100 <= r[1] < 900]
+        got = s.aggregate(topic, 100, 900)
+        assert got == (len(expect), sum(r[2] for r in expect)), "FAIL: topic {} got {!r}".format(topic, got)
+    assert list(s) == [(r[0], r[1], int(r[2])) + r[3:] for r in rows], "FAIL: rows did not round trip"
+    s.close()
+    rows[0] = rows[0][:2] + (0.5,) + rows[0][3:] # Doubles
+    writeSegment(path, rows)
+    s = Segment(path)
+    assert list(s) == rows, "FAIL: double counts did not round trip"
+    s.close()
+    print("PASS")
@@ -4,7 +4,7 @@ Classes for PWMing fans
 """
 __author__ = "<Daniel Casner <www.danielcasner.org>"
 
-def DiscreteFan(object):
+class DiscreteFan(object):
     "A simple fan controller with discrete PWM speeds"
 
     def __init__(self, pi, gpio, speeds=(0, 4095), phase=0):
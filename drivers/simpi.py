@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Simulated pigpio and PCA9685Pi backend for running the automation without hardware.
+Models PWM channels, GPIO inputs with edge callbacks and door travel against the clock module, so with a VirtualClock
+installed a whole day runs in seconds. install() puts this module in place of pigpio and PCA9685_pigpio for the modules
+imported after it.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import sys
+import collections
+import clock
+
+__all__ = ["PCA9685Pi"] # What "from PCA9685_pigpio import *" gets
+
+INPUT = 0
+OUTPUT = 1
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+LOW = 0
+HIGH = 1
+
+def tickDiff(t1, t2):
+    "Microseconds from tick t1 to tick t2, allowing for wrap around"
+    return (t2 - t1) & 0xffffffff
+
+class _callback:
+    "Handle for an edge callback, like pigpio's"
+
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+class pi:
+    "Simulated pigpio.pi"
+
+    DEFAULT_RANGE = 255
+
+    def __init__(self, host=None, port=None):
+        self.connected = True
+        self.levels = {} # gpio -> 0 or 1
+        self.modes = {}
+        self.duty = {} # gpio -> PWM duty cycle
+        self.phases = {}
+        self.ranges = {}
+        self.frequencies = {}
+        self.glitch_filters = {}
+        self.callbacks = []
+        self.models = [] # Simulated devices, updated when an output changes
+        self.commands = collections.Counter() # Command name -> number sent, a stand in for daemon and bus traffic
+
+    def stop(self):
+        self.connected = False
+
+    def set_mode(self, gpio, mode):
+        self.commands["set_mode"] += 1
+        self.modes[gpio] = mode
+
+    def get_mode(self, gpio):
+        return self.modes.get(gpio, INPUT)
+
+    def set_pull_up_down(self, gpio, pud):
+        self.commands["set_pull_up_down"] += 1
+        if gpio not in self.levels: # A model driving the input wins over the pull
+            self.levels[gpio] = 1 if pud == PUD_UP else 0
+
+    def set_glitch_filter(self, gpio, steady):
+        self.commands["set_glitch_filter"] += 1
+        self.glitch_filters[gpio] = steady
+
+    def read(self, gpio):
+        self.commands["read"] += 1
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self.commands["write"] += 1
+        self.duty[gpio] = self.get_PWM_range(gpio) if level else 0
+        self._output(gpio)
+
+    def get_PWM_range(self, gpio):
+        return self.ranges.get(gpio, self.DEFAULT_RANGE)
+
+    def set_PWM_range(self, gpio, pwm_range):
+        self.commands["set_PWM_range"] += 1
+        self.ranges[gpio] = pwm_range
+
+    def set_PWM_frequency(self, gpio, frequency):
+        self.commands["set_PWM_frequency"] += 1
+        self.frequencies[gpio] = frequency
+
+    def set_PWM_dutycycle(self, gpio, dutycycle, phase=0):
+        self.commands["set_PWM_dutycycle"] += 1
+        self.duty[gpio] = dutycycle
+        self.phases[gpio] = phase
+        self._output(gpio)
+
+    def set_PWM_dutycycles(self, settings):
+        "Set several duty cycles as one transaction, settings is a sequence of (gpio, dutycycle, phase)"
+        self.commands["set_PWM_dutycycles"] += 1
+        settings = list(settings)
+        for gpio, dutycycle, phase in settings:
+            self.duty[gpio] = dutycycle
+            self.phases[gpio] = phase
+        for gpio, dutycycle, phase in settings:
+            self._output(gpio)
+
+    def get_PWM_dutycycle(self, gpio):
+        return self.duty.get(gpio, 0)
+
+    def output(self, gpio):
+        "Returns the output of a gpio as a fraction of its PWM range"
+        return self.duty.get(gpio, 0) / self.get_PWM_range(gpio)
+
+    def callback(self, gpio, edge=RISING_EDGE, func=None):
+        cb = _callback(self, gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def get_current_tick(self):
+        return int(clock.time() * 1e6) & 0xffffffff
+
+    def set_input(self, gpio, level):
+        "Drive an input, as the outside world or a model, calling the edge callbacks if it changes"
+        if self.levels.get(gpio) == level:
+            return
+        self.levels[gpio] = level
+        tick = self.get_current_tick()
+        for cb in list(self.callbacks):
+            if cb.gpio == gpio and (cb.edge == EITHER_EDGE or cb.edge == (RISING_EDGE if level else FALLING_EDGE)):
+                cb.func(gpio, level, tick)
+
+    def _output(self, gpio):
+        for model in self.models:
+            model.update(gpio)
+
+class PCA9685Pi(pi):
+    "Simulated pigpio.pi with a PCA9685 PWM extender mapped above EXTENDER_OFFSET"
+
+    EXTENDER_OFFSET = 0x100
+    MAX_PWM = 4095
+
+    def get_PWM_range(self, gpio):
+        if gpio >= self.EXTENDER_OFFSET:
+            return self.MAX_PWM
+        return pi.get_PWM_range(self, gpio)
+
+class Door:
+    """A door driven by a DRV8871 with limit switches at either end of its travel.
+    Position runs from 0.0 closed to 1.0 open, in1 driving it closed and in2 open, and a switch reads 1 while the door
+    is at it.
+    """
+
+    def __init__(self, pi, in1, in2, closed_sw, open_sw, travel_time=10.0, position=0.0):
+        """Attach the model to a simulated pi
+        @param travel_time Seconds to travel all the way at full speed
+        @param position Where the door starts
+        """
+        self.pi = pi
+        self.in1 = in1
+        self.in2 = in2
+        self.closed_sw = closed_sw
+        self.open_sw = open_sw
+        self.travel_time = travel_time
+        self.position = position
+        self.velocity = 0.0 # Fraction of travel per second, positive opening
+        self.updated = clock.time()
+        self.timer = None
+        self.trips = 0 # Number of times the door has reached either end
+        pi.models.append(self)
+        self._switches()
+
+    def update(self, gpio=None):
+        "Bring the position up to date and take up the motor's new drive"
+        if gpio is not None and gpio not in (self.in1, self.in2):
+            return
+        now = clock.time()
+        self.position = min(1.0, max(0.0, self.position + self.velocity * (now - self.updated)))
+        self.updated = now
+        self.velocity = (self.pi.output(self.in2) - self.pi.output(self.in1)) / self.travel_time
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.velocity > 0 and self.position < 1.0:
+            self.timer = clock.call_at(now + (1.0 - self.position) / self.velocity, self._arrive)
+        elif self.velocity < 0 and self.position > 0.0:
+            self.timer = clock.call_at(now + self.position / -self.velocity, self._arrive)
+        self._switches() # Last, as the edge callbacks may drive the motor and update again
+
+    def _arrive(self):
+        self.timer = None
+        self.position = 1.0 if self.velocity > 0 else 0.0 # Rounding mustn't leave it a hair short and rescheduling
+        self.updated = clock.time()
+        self.update()
+        self.trips += 1
+
+    def _switches(self):
+        self.pi.set_input(self.open_sw, 1 if self.position >= 1.0 - 1e-9 else 0)
+        self.pi.set_input(self.closed_sw, 1 if self.position <= 1e-9 else 0)
+
+def install():
+    "Import this module in place of pigpio and PCA9685_pigpio, call before importing the modules which use them"
+    module = sys.modules[__name__]
+    sys.modules["pigpio"] = module
+    sys.modules["PCA9685_pigpio"] = module
+
+if __name__ == '__main__':
+    # Unit tests
+    install()
+    import coop_door
+    class DummyClient:
+        def __init__(self):
+            self.published = []
+        def publish(self, topic, payload, qos=0, retain=False):
+            self.published.append(payload)
+    clock.install(clock.VirtualClock(0.0))
+    sim = PCA9685Pi()
+    door_model = Door(sim, 0x10e, 0x10f, 4, 17, travel_time=10.0, position=0.0)
+    client = DummyClient()
+    door = coop_door.Door(sim, 0x10e, 0x10f, 4, 17, client, "door")
+    door.open()
+    assert door_model.position == 1.0 and 10.0 <= clock.time() < 10.2, "FAIL: opened to {!r} at {!r}".format(
+        door_model.position, clock.time())
+    assert client.published[-1] == coop_door.Door.DOOR_OPEN_TOKEN, "FAIL: published {!r}".format(client.published)
+    assert door.switch_latency_µs == 0, "FAIL: switch latency {!r}".format(door.switch_latency_µs)
+    door.close()
+    assert door_model.position == 0.0 and door_model.velocity == 0.0, "FAIL: closed to {!r}".format(door_model.position)
+    assert 30.0 <= clock.time() < 33.5, "FAIL: close took until {!r}".format(clock.time())
+    assert client.published[-1] == coop_door.Door.DOOR_CLOSED_TOKEN, "FAIL: published {!r}".format(client.published)
+    assert sim.commands["read"] < 10, "FAIL: door polled {!r}".format(sim.commands)
+    # Asyncio motions on the system clock, a new motion replacing one in progress must get the motor
+    import asyncio
+    import threading
+    clock.install(clock.SystemClock())
+    sim = PCA9685Pi()
+    door_model = Door(sim, 0x10e, 0x10f, 4, 17, travel_time=1.0, position=1.0)
+    door = coop_door.Door(sim, 0x10e, 0x10f, 4, 17, client, "door")
+    async def reverse():
+        door.close()
+        await asyncio.sleep(0.1)
+        await asyncio.wait_for(door.open(), 2.0)
+    asyncio.run(reverse())
+    assert door_model.position == 1.0, "FAIL: reversed door at {!r}".format(door_model.position)
+    assert client.published[-1] == coop_door.Door.DOOR_OPEN_TOKEN, "FAIL: published {!r}".format(client.published)
+    # Motions from a command worker thread and the scheduler's thread take turns with the door
+    door_model.position = 0.0
+    door_model.update()
+    worker = threading.Thread(target=door.open)
+    worker.start()
+    clock.sleep(0.1)
+    started = clock.time()
+    door.open()
+    worker.join(2.0)
+    assert not worker.is_alive() and clock.time() - started < 2.0, "FAIL: concurrent motions took {!r}s".format(
+        clock.time() - started)
+    assert door_model.position == 1.0 and door_model.trips == 2, "FAIL: door at {!r} after {!r} trips".format(
+        door_model.position, door_model.trips)
+    door.shutdown()
+    assert sim.callbacks == [] and sim.output(0x10e) == sim.output(0x10f) == 1.0, "FAIL: shutdown left {!r}".format(
+        sim.callbacks)
+    print("PASS")
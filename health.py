@@ -8,6 +8,7 @@ import os
 import psutil
 import time
 import json
+import clock
 
 class HealthMonitor(psutil.Process):
     
@@ -39,10 +40,14 @@ class HealthPublisher(HealthMonitor):
         self.topic = topic
         self.interval = interval
         self.last_publish_time = 0.0
+
+    def deadline(self):
+        "Returns the clock.time() of the next publish"
+        return self.last_publish_time + self.interval
         
     def __next__(self):
         "Step the publisher"
-        now = time.time()
+        now = clock.time()
         if now - self.last_publish_time >= self.interval:
             msg = {
                 "cpu_temp": self.temperature(),
@@ -50,6 +55,8 @@ class HealthPublisher(HealthMonitor):
                 "memory":   self.memory(),
                 "uptime":   self.uptime(),
             }
+            if hasattr(self.client, "publish_stats"):
+                msg["mqtt_publishes"] = self.client.publish_stats()
             self.client.publish(self.topic, json.dumps(msg))
             self.last_publish_time = now
 
@@ -1,22 +1,142 @@
 #!/usr/bin/env python3
-"""Logging handler using MQTT Shared Client."""
+"""Logging handler using MQTT Shared Client.
+Records are formatted when they are logged and put in a bounded buffer which a background thread ships as one publish,
+a JSON list of the formatted records, per interval. When the buffer is full the oldest record of the lowest severity
+is dropped to make room, so a flood of DEBUG records can't push out ERRORs.
+"""
 __author__ = "Daniel Casner <www.danielcasner.org>"
 import sharedclient
 import logging
+import threading
+import collections
+import heapq
+import itertools
+import json
 
 class MQTTHandler(logging.Handler):
     """A logging handler which broadcasts records over MQTT"""
-    
-    def __init__(self, client, topic, qos=2):
+
+    def __init__(self, client, topic, qos=1, interval=1.0, capacity=1000):
+        """Set up the handler and start its shipping thread
+        @param client MQTT client to publish with
+        @param topic Topic to publish batches of records to
+        @param qos QoS of the batch publishes
+        @param interval Seconds between batches
+        @param capacity Maximum number of records buffered between batches
+        """
         logging.Handler.__init__(self)
         self.client = client
         self.def_topic = topic
         self.def_qos   = qos
-        
+        self.interval = interval
+        self.capacity = capacity
+        self.dropped = collections.Counter() # Level name -> records dropped since the last batch
+        self._buffer = {} # Level -> deque of (sequence, formatted record)
+        self._size = 0
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._flushed = 0 # Sequence number below which records have been shipped
+        self._flush_to = -1 # Sequence number flush is waiting to be shipped
+        self._closed = False
+        self._thread = threading.Thread(target=self._ship, name="MQTTHandler", daemon=True)
+        self._thread.start()
+
     def emit(self, record):
+        if threading.current_thread() is self._thread:
+            return # Don't feed back records logged while publishing
         try:
             msg = self.format(record)
-            self.client.publish(self.def_topic, msg, qos=self.def_qos, retain=False)
-            self.flush()
         except Exception:
             self.handleError(record)
+            return
+        with self._cond:
+            if self._size >= self.capacity:
+                lowest = min(self._buffer)
+                if lowest > record.levelno:
+                    self.dropped[record.levelname] += 1
+                    return
+                self._buffer[lowest].popleft()
+                self.dropped[logging.getLevelName(lowest)] += 1
+                if not self._buffer[lowest]:
+                    del self._buffer[lowest]
+                self._size -= 1
+            self._buffer.setdefault(record.levelno, collections.deque()).append((next(self._sequence), msg))
+            self._size += 1
+
+    def _take(self):
+        "Removes and returns the buffered records in the order they were logged, lock must be held"
+        batch = [msg for seq, msg in heapq.merge(*self._buffer.values())]
+        if self.dropped:
+            batch.append("MQTTHandler dropped {} records".format(
+                ", ".join("{:d} {}".format(n, level) for level, n in sorted(self.dropped.items()))))
+            self.dropped.clear()
+        self._buffer = {}
+        self._size = 0
+        return batch
+
+    def _ship(self):
+        "Shipping thread main loop"
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._flush_to >= self._flushed, self.interval)
+                closed = self._closed
+                upto = next(self._sequence)
+                batch = self._take()
+            if batch:
+                try:
+                    self.client.publish(self.def_topic, json.dumps(batch), qos=self.def_qos, retain=False)
+                except Exception:
+                    pass # Nowhere to report a failure to ship the log
+            with self._cond:
+                self._flushed = upto
+                self._cond.notify_all()
+            if closed:
+                return
+
+    def flush(self, timeout=None):
+        "Ship the buffered records now and wait until they have been handed to the client"
+        with self._cond:
+            if not self._thread.is_alive():
+                return
+            upto = next(self._sequence)
+            self._flush_to = max(self._flush_to, upto)
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._flushed > upto, timeout)
+
+    def close(self):
+        "Ship any remaining records and stop the shipping thread"
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    # Unit tests
+    import sys
+    class SpyClient:
+        def __init__(self):
+            self.published = []
+        def publish(self, topic, payload, qos, retain):
+            self.published.append((topic, json.loads(payload), qos))
+    client = SpyClient()
+    handler = MQTTHandler(client, "log", qos=0, interval=60, capacity=4)
+    logger = logging.getLogger("mqtthandler_test")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    logger.error("error 1")
+    for i in range(3):
+        logger.debug("debug %d", i)
+    logger.error("error 2")
+    logger.info("info 1")
+    logger.debug("debug 3")
+    handler.flush()
+    expect = [("log", ["error 1", "error 2", "info 1", "debug 3", "MQTTHandler dropped 3 DEBUG records"], 0)]
+    if client.published != expect:
+        sys.exit("FAIL: published {!r}".format(client.published))
+    logger.warning("warning 1")
+    handler.close()
+    if client.published[-1] != ("log", ["warning 1"], 0):
+        sys.exit("FAIL: close didn't ship {!r}".format(client.published))
+    print("PASS")
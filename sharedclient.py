@@ -2,82 +2,953 @@
 """
 A subclass of mqtt client which supports subscriptions going to multiple different callbacks. The purpose is to allow
 a complex program to share one MQTT client among a number of destinct functions or even separate modules.
+Subscriptions may use the MQTT + and # wildcards. Received messages are matched against a trie of the subscribed topic
+filters so dispatch cost depends on the depth of the topic rather than the number of subscriptions, and filters which
+are covered by another subscribed filter are not subscribed to separately at the broker.
+Callbacks run on the thread calling next() on the client unless a pool of callback workers is requested, in which case
+messages for different topics are handled in parallel while those for any one topic are still handled in order.
+Retained publishes are coalesced: a value identical to the one last published on a topic is not sent again and topics
+may be rate limited, in which case only the last value published during the interval is sent at the end of it.
+Optionally the time each message spends queued and in its callbacks is recorded in per topic latency histograms which
+are published periodically to a metrics topic.
+Subscriptions may declare a payload decoder, each message is then decoded once for all the callbacks sharing that
+decoder, the decoded value is passed to them after the message and messages which don't decode are rejected.
 """
 __author__ = "Daniel Casner <www.danielcasner.org>"
 
 import paho.mqtt.client as mqtt
 import logging
 import queue
+import threading
+import asyncio
+import collections
+import time
+import heapq
+import json
+import re
 
 def topic_join(*args):
     "Returns the tokens specified jouint by the MQTT topic namespace separatot"
     return "/".join(args)
 
+def topic_covers(general, specific):
+    "Returns True if every topic matched by the specific topic filter is also matched by the general one"
+    g = general.split("/")
+    s = specific.split("/")
+    for i, level in enumerate(g):
+        if level == "#":
+            return not (i == 0 and s[0].startswith("$"))
+        if i >= len(s) or s[i] == "#":
+            return False
+        if level == "+":
+            if i == 0 and s[0].startswith("$"):
+                return False
+        elif level != s[i]:
+            return False
+    return len(g) == len(s)
+
+class TopicTrie:
+    "Maps MQTT topic filters, which may contain + and # wildcards, to values and finds the values matching a topic"
+
+    class Node(dict):
+        "Children by topic level, with the value of the filter ending at this node if any"
+        __slots__ = ("value",)
+        def __init__(self):
+            dict.__init__(self)
+            self.value = None
+
+    def __init__(self):
+        self.root = self.Node()
+
+    def __setitem__(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split("/"):
+            node = node.setdefault(level, self.Node())
+        node.value = value
+
+    def __delitem__(self, topic_filter):
+        path = [self.root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            path.append(path[-1][level])
+        path[-1].value = None
+        for level, parent, node in reversed(list(zip(levels, path, path[1:]))):
+            if node or node.value is not None:
+                break
+            del parent[level]
+
+    def match(self, topic):
+        "Returns the values of all the filters matching a topic"
+        rslt = []
+        levels = topic.split("/")
+        nodes = [self.root]
+        for i, level in enumerate(levels):
+            nxt = []
+            for node in nodes:
+                if i == 0 and level.startswith("$"): # $SYS etc. topics are not matched by leading wildcards
+                    child = node.get(level)
+                    if child is not None:
+                        nxt.append(child)
+                    continue
+                wild = node.get("#")
+                if wild is not None and wild.value is not None:
+                    rslt.append(wild.value)
+                for key in (level, "+"):
+                    child = node.get(key)
+                    if child is not None:
+                        nxt.append(child)
+            nodes = nxt
+            if not nodes:
+                return rslt
+        for node in nodes:
+            if node.value is not None:
+                rslt.append(node.value)
+            wild = node.get("#") # "a/#" also matches "a"
+            if wild is not None and wild.value is not None:
+                rslt.append(wild.value)
+        return rslt
+
+class TopicQueue:
+    """Queue of work items for topics which hands out at most one item per topic at a time, so items for a topic are
+    processed in the order they were put while different topics may be processed in parallel.
+    Producers may each be given a Limit on the items they have queued with a policy for when it is reached.
+    """
+
+    BLOCK = "block"             # Wait for room, on the putting thread
+    DROP_OLDEST = "drop_oldest" # Drop the producer's oldest queued item
+    DROP_NEWEST = "drop_newest" # Drop the item being put
+    LATEST = "latest"           # Replace the producer's queued item with the same key, dropping the oldest if still full
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST)
+
+    class Limit:
+        "The bound on one producer's queued items, what to do when it is reached and counts of what happened"
+        def __init__(self, maxsize=0, policy="block"):
+            if policy not in TopicQueue.POLICIES:
+                raise ValueError("Unknown overflow policy {!r}".format(policy))
+            self.maxsize = maxsize
+            self.policy = policy
+            self.entries = collections.OrderedDict() # Queued entries oldest first, only kept when bounded
+            self.latest = {} # key -> queued entry, for the latest policy
+            self.pending = 0
+            self.high_water = 0
+            self.dropped = 0
+            self.conflated = 0
+            self.blocked = 0
+
+        def stats(self):
+            return {"pending": self.pending, "high_water": self.high_water, "dropped": self.dropped,
+                    "conflated": self.conflated, "blocked": self.blocked}
+
+    class Entry:
+        __slots__ = ("topic", "item", "limit", "key")
+        def __init__(self, topic, item, limit, key):
+            self.topic = topic
+            self.item = item
+            self.limit = limit
+            self.key = key
+
+    def __init__(self):
+        lock = threading.Lock()
+        self._not_empty = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+        self._pending = {} # topic -> deque of entries, present while the topic has items queued or one in progress
+        self._ready = collections.deque() # Topics with items queued and none in progress
+        self._size = 0
+        self._closed = False
+        self.high_water = 0
+
+    def qsize(self):
+        return self._size
+
+    def put(self, topic, item, limit=None, timeout=None, key=None):
+        """Queue an item for a topic, returns False if it, or an older item, was dropped by the limit's policy
+        @param timeout Maximum seconds to wait for room under the block policy, after which the item is dropped
+        @param key What the latest policy replaces a queued item with the same key of, by default the topic
+        """
+        if key is None:
+            key = topic
+        with self._not_full:
+            rslt = True
+            if limit is not None:
+                if limit.policy == self.LATEST and key in limit.latest:
+                    limit.latest[key].item = item
+                    limit.conflated += 1
+                    return True
+                if limit.maxsize and limit.pending >= limit.maxsize:
+                    if limit.policy == self.BLOCK:
+                        limit.blocked += 1
+                        if not self._not_full.wait_for(lambda: limit.pending < limit.maxsize or self._closed, timeout):
+                            limit.dropped += 1
+                            return False
+                    elif limit.policy == self.DROP_NEWEST:
+                        limit.dropped += 1
+                        return False
+                    else:
+                        self._drop(next(iter(limit.entries)))
+                        rslt = False
+            entry = self.Entry(topic, item, limit, key)
+            items = self._pending.get(topic)
+            if items is None:
+                self._pending[topic] = collections.deque((entry,))
+                self._ready.append(topic)
+                self._not_empty.notify()
+            else:
+                items.append(entry)
+            self._size += 1
+            self.high_water = max(self.high_water, self._size)
+            if limit is not None:
+                limit.pending += 1
+                limit.high_water = max(limit.high_water, limit.pending)
+                if limit.maxsize:
+                    limit.entries[entry] = None
+                if limit.policy == self.LATEST:
+                    limit.latest[key] = entry
+            return rslt
+
+    def _release(self, entry):
+        "Account for an entry leaving the queue, lock must be held"
+        self._size -= 1
+        limit = entry.limit
+        if limit is not None:
+            limit.pending -= 1
+            limit.entries.pop(entry, None)
+            if limit.latest.get(entry.key) is entry:
+                del limit.latest[entry.key]
+            self._not_full.notify_all()
+
+    def _drop(self, entry):
+        "Remove a queued entry, lock must be held"
+        items = self._pending[entry.topic]
+        items.remove(entry)
+        if not items and entry.topic in self._ready: # Not in progress
+            self._ready.remove(entry.topic)
+            del self._pending[entry.topic]
+        entry.limit.dropped += 1
+        self._release(entry)
+
+    def get(self, timeout=None):
+        """Returns the next (topic, item), call done(topic) when finished with it.
+        Raises queue.Empty on timeout and returns (None, None) once the queue is closed.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._ready or self._closed, timeout):
+                raise queue.Empty
+            if self._closed:
+                return None, None
+            topic = self._ready.popleft()
+            entry = self._pending[topic].popleft()
+            self._release(entry)
+            return topic, entry.item
+
+    def done(self, topic):
+        "Release a topic returned by get so its next item can be handed out"
+        with self._not_empty:
+            if self._pending[topic]:
+                self._ready.append(topic)
+                self._not_empty.notify()
+            else:
+                del self._pending[topic]
+
+    def close(self):
+        "Wake up and stop all getters and blocked putters"
+        with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+def decode_text(payload):
+    return payload.decode("utf-8")
+
+# Named payload decoders for SharedClient.subscribe, each raises ValueError for a malformed payload
+DECODERS = {
+    "json":  json.loads,
+    "int":   int,
+    "float": float,
+    "text":  decode_text,
+}
+
+class LatencyHistogram:
+    """Log-linear histogram of durations in microseconds in the style of HdrHistogram.
+    Each power of two is split into 2**(SUB_BITS - 1) equal buckets so values are kept to within about 3% while the
+    number of buckets only grows with the log of the largest value.
+    """
+
+    SUB_BITS = 6
+
+    def __init__(self):
+        self.counts = {} # Bucket index -> count
+        self.count = 0
+        self.max = 0
+
+    @classmethod
+    def index(cls, value):
+        if value < (1 << cls.SUB_BITS):
+            return value
+        shift = value.bit_length() - cls.SUB_BITS
+        return (shift << (cls.SUB_BITS - 1)) + (value >> shift)
+
+    @classmethod
+    def lower_bound(cls, index):
+        "The smallest value which falls in a bucket"
+        if index < (1 << cls.SUB_BITS):
+            return index
+        shift = (index >> (cls.SUB_BITS - 1)) - 1
+        return (index - (shift << (cls.SUB_BITS - 1))) << shift
+
+    def record(self, value):
+        "Add a duration in microseconds"
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        "Returns the lower bound of the bucket holding the p-th percentile value"
+        rank = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return self.lower_bound(i)
+        return self.max
+
+    def summary(self):
+        "Returns a dictionary of the count, percentiles and max as well as the non-empty [lower bound, count] buckets"
+        return {"count": self.count, "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99), "max": self.max,
+                "buckets": [[self.lower_bound(i), self.counts[i]] for i in sorted(self.counts)]}
+
 class SharedClient(mqtt.Client):
     "MQTT client set up for shared use"
     
     class Subscription(list):
-        "A list of callbacks that also has a stored QOS and topic"
-        def __init__(self, topic, qos, callbacks=[]):
+        "A list of callbacks that also has a stored QOS, topic, callback timeouts and decoders and queue limit"
+        def __init__(self, topic, qos, callbacks=[], limit=None):
             list.__init__(self, callbacks)
             self.topic = topic
             self.qos = qos
+            self.timeouts = {} # callback -> seconds it may run before being reported as an overrun
+            self.decoders = {} # callback -> payload decoder
+            self.limit = limit if limit is not None else TopicQueue.Limit()
     
-    def __init__(self, *args, **kwargs):
-        "Initalize client"
+    def __init__(self, *args, workers=0, callback_timeout=None, queue_maxsize=0, queue_timeout=1.0,
+                 overflow=TopicQueue.BLOCK, block_timeout=None, retain_interval=0.0, metrics_topic=None,
+                 metrics_interval=60.0, **kwargs):
+        """Initalize client, other arguments are passed through to the paho client
+        @param workers If not 0, callbacks are run by this many worker threads rather than by next()
+        @param callback_timeout Default seconds a callback may run before being reported as an overrun, None for no limit
+        @param queue_maxsize Default maximum number of queued callbacks per subscription, 0 for no limit
+        @param queue_timeout Seconds next() waits for a message
+        @param overflow Default policy when a subscription's queue is full, one of the TopicQueue policies
+        @param block_timeout Seconds the network thread waits for room under the block policy before dropping the message
+        @param retain_interval Default minimum seconds between retained publishes to a topic, see set_publish_interval
+        @param metrics_topic If not None, record dispatch latencies and publish them to this topic, see latency_stats
+        @param metrics_interval Seconds between publishing dispatch latencies
+        """
         mqtt.Client.__init__(self, *args, **kwargs)
         self.logger = logging.getLogger(__name__)
-        self.queue  = queue.Queue(kwargs.get('queue_maxsize', 0))
-        self.loop_timeout = kwargs.get('queue_timeout', 1.0)
+        self.queue  = TopicQueue()
+        self.loop_timeout = queue_timeout
+        self.queue_maxsize = queue_maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.callback_timeout = callback_timeout
+        self.on_callback_overrun = None # Called with (topic, callback, seconds running) when a callback overruns
+        self.overruns = collections.Counter() # topic -> number of callback overruns
+        self._running = {} # Thread -> [topic, callback, start time, deadline, reported]
+        self._watchdog = None
+        self._dispatched = threading.Event() # Set by the workers after each callback to wake dispatch()
+        self._wake_async = None # While dispatch_async runs, called from the network thread when a message is queued
+        self._workers = [threading.Thread(target=self._work, name="SharedClient worker {:d}".format(i), daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        if callback_timeout is not None:
+            self._start_watchdog()
         self._connected = False
         self._subscriptions = {}
+        self._trie = TopicTrie()
+        self._broker_subscriptions = {} # Topic filter -> qos subscribed at the broker
+        self._lock = threading.RLock()
+        self._decoders = {} # Regular expression -> decoder, so subscriptions with the same pattern share decoding
+        self.rejected = collections.Counter() # topic -> payloads rejected, counted once per decoder
+        self.retain_interval = retain_interval
+        self.publish_counts = collections.Counter() # published, suppressed (unchanged) and coalesced retained publishes
+        self._publish_intervals = TopicTrie() # Topic filter -> (topic filter, seconds)
+        self._retained = {} # Topic -> (payload, qos, time) last published since connecting
+        self._deferred = {} # Topic -> (payload, qos, args, kwargs) waiting for the topic's interval to pass
+        self._deadlines = [] # Heap of (time, topic) for deferred publishes
+        self._publish_cond = threading.Condition()
+        self._flusher = None
+        self.metrics_topic = metrics_topic
+        self.metrics_interval = metrics_interval
+        self._metrics_lock = threading.Lock()
+        self._latencies = {} # Topic -> (queued, callback, total) LatencyHistograms
+        if metrics_topic is not None:
+            threading.Thread(target=self._publish_metrics, name="SharedClient metrics", daemon=True).start()
+    
+    def broker_filters(self):
+        """Returns {topic filter: qos} of the minimal set of subscriptions the broker needs to deliver every subscribed
+        topic, leaving out filters covered by another subscribed filter with at least the same qos.
+        """
+        subs = list(self._subscriptions.values())
+        rslt = {}
+        for sub in subs:
+            if not any(other is not sub and other.qos >= sub.qos and topic_covers(other.topic, sub.topic) for other in subs):
+                rslt[sub.topic] = sub.qos
+        return rslt
+    
+    def _update_broker(self):
+        "Bring the broker's subscriptions in line with broker_filters, subscribing before unsubscribing to avoid gaps"
+        if not self._connected:
+            return
+        wanted = self.broker_filters()
+        add = [(t, q) for t, q in wanted.items() if self._broker_subscriptions.get(t) != q]
+        remove = [t for t in self._broker_subscriptions if t not in wanted]
+        if add:
+            mqtt.Client.subscribe(self, add)
+        if remove:
+            mqtt.Client.unsubscribe(self, remove)
+        self._broker_subscriptions = wanted
     
-    def subscribe(self, topic, qos, callback):
-        "Subscribe to a given topic with callback"
+    def decoder(self, spec):
+        """Returns the payload decoding function for a decoder specification, which is the name of one of DECODERS, a
+        regular expression, string or compiled, which must match the whole UTF-8 payload and decodes to the match object,
+        or a function taking the payload bytes and raising ValueError if they are malformed.
+        """
+        if callable(spec):
+            return spec
+        if spec in DECODERS:
+            return DECODERS[spec]
+        pattern = re.compile(spec)
+        with self._lock:
+            if pattern not in self._decoders:
+                def decode_match(payload):
+                    match = pattern.fullmatch(payload.decode("utf-8"))
+                    if match is None:
+                        raise ValueError("Payload doesn't match {}".format(pattern.pattern))
+                    return match
+                self._decoders[pattern] = decode_match
+            return self._decoders[pattern]
+    
+    def subscribe(self, topic, qos, callback, timeout=None, maxsize=None, overflow=None, decoder=None):
+        """Subscribe to a given topic, which may contain wildcards, with callback
+        @param decoder If not None, payload decoder specification, see decoder(). The callback is called with the message
+                       and the decoded payload.
+        @param timeout Seconds the callback may run before being reported as an overrun, overrides callback_timeout
+        @param maxsize Maximum number of queued callbacks for the subscription, overrides queue_maxsize
+        @param overflow Policy when the subscription's queue is full, overrides overflow
+        """
         self.logger.info("Subscribing to {:s} at qos={:d}".format(topic, qos))
-        needToSubscribe = True
-        if topic in self._subscriptions:
-            sub = self._subscriptions[topic]
-            if qos > sub.qos:
-                mqtt.Client.unsubscribe(self, topic)
-                sub.qos = qos
+        with self._lock:
+            if topic in self._subscriptions:
+                sub = self._subscriptions[topic]
+                sub.qos = max(qos, sub.qos)
+                sub.append(callback)
+                if maxsize is not None:
+                    sub.limit.maxsize = maxsize
+                if overflow is not None:
+                    if overflow not in TopicQueue.POLICIES:
+                        raise ValueError("Unknown overflow policy {!r}".format(overflow))
+                    sub.limit.policy = overflow
             else:
-                needToSubscribe = False
-            sub.append(callback)
-        else:
-            self._subscriptions[topic] = self.Subscription(topic, qos, [callback])
-        if self._connected and needToSubscribe:
-            sub = self._subscriptions[topic]
-            mqtt.Client.subscribe(self, sub.topic, sub.qos)
+                limit = TopicQueue.Limit(self.queue_maxsize if maxsize is None else maxsize,
+                                         self.overflow if overflow is None else overflow)
+                sub = self.Subscription(topic, qos, [callback], limit)
+                self._subscriptions[topic] = sub
+                self._trie[topic] = sub
+            if timeout is not None:
+                sub.timeouts[callback] = timeout
+                self._start_watchdog()
+            if decoder is not None:
+                sub.decoders[callback] = self.decoder(decoder)
+            self._update_broker()
     
     def unsubscribe(self, topic, callback):
         "Unsubscribe a single callback"
         self.logger.info("Unsubscribing from {:s}".format(topic))
-        self._subscriptions[topic].remove(callback)
-        if len(self._subscriptions[topic]) == 0:
-            mqtt.Client.unsubscribe(self, topic)
-            del self._subscriptions[topic]
+        with self._lock:
+            self._subscriptions[topic].remove(callback)
+            if callback not in self._subscriptions[topic]:
+                self._subscriptions[topic].timeouts.pop(callback, None)
+                self._subscriptions[topic].decoders.pop(callback, None)
+            if len(self._subscriptions[topic]) == 0:
+                del self._subscriptions[topic]
+                del self._trie[topic]
+                self._update_broker()
+    
+    def set_publish_interval(self, topic_filter, seconds):
+        "Rate limit retained publishes to topics matching the filter, overrides retain_interval, None to remove"
+        with self._publish_cond:
+            if seconds is None:
+                del self._publish_intervals[topic_filter]
+            else:
+                self._publish_intervals[topic_filter] = (topic_filter, seconds)
+    
+    def _publish_interval(self, topic):
+        "Returns the rate limit for a topic, the longest matching filter wins"
+        matches = self._publish_intervals.match(topic)
+        if not matches:
+            return self.retain_interval
+        return max(matches, key=lambda m: len(m[0]))[1]
+    
+    @staticmethod
+    def _payload_bytes(payload):
+        "The bytes paho sends for a payload"
+        if isinstance(payload, (bytes, bytearray)):
+            return bytes(payload)
+        return b"" if payload is None else str(payload).encode("utf-8")
+    
+    @staticmethod
+    def _placeholder():
+        "MQTTMessageInfo returned for a publish which was suppressed or deferred"
+        info = mqtt.MQTTMessageInfo(0)
+        info._set_as_published()
+        return info
+    
+    def publish(self, topic, payload=None, qos=0, retain=False, *args, **kwargs):
+        """Publish a message. Retained messages which repeat the last value published to the topic since connecting
+        are suppressed, and those arriving within the topic's publish interval are deferred to the end of it with
+        later values replacing earlier ones.
+        """
+        if not retain:
+            return mqtt.Client.publish(self, topic, payload, qos, retain, *args, **kwargs)
+        data = self._payload_bytes(payload)
+        now = time.monotonic()
+        with self._publish_cond:
+            last = self._retained.get(topic)
+            unchanged = last is not None and last[:2] == (data, qos)
+            if topic in self._deferred:
+                if unchanged: # Went back to the published value before the deferred one was sent
+                    del self._deferred[topic]
+                    self.publish_counts["suppressed"] += 1
+                else:
+                    self._deferred[topic] = (payload, qos, args, kwargs)
+                    self.publish_counts["coalesced"] += 1
+                return self._placeholder()
+            if unchanged:
+                self.publish_counts["suppressed"] += 1
+                return self._placeholder()
+            if last is not None:
+                due = last[2] + self._publish_interval(topic)
+                if now < due:
+                    self._deferred[topic] = (payload, qos, args, kwargs)
+                    heapq.heappush(self._deadlines, (due, topic))
+                    self._start_flusher()
+                    self._publish_cond.notify()
+                    return self._placeholder()
+            self._retained[topic] = (data, qos, now)
+            self.publish_counts["published"] += 1
+        return mqtt.Client.publish(self, topic, payload, qos, retain, *args, **kwargs)
+    
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_deferred, name="SharedClient publisher", daemon=True)
+            self._flusher.start()
+    
+    def _flush_deferred(self):
+        "Publisher thread sending deferred retained publishes when their topic's interval has passed"
+        while True:
+            with self._publish_cond:
+                while not self._deadlines or self._deadlines[0][0] > time.monotonic():
+                    self._publish_cond.wait(self._deadlines[0][0] - time.monotonic() if self._deadlines else None)
+                due, topic = heapq.heappop(self._deadlines)
+                if topic not in self._deferred:
+                    continue
+                payload, qos, args, kwargs = self._deferred.pop(topic)
+                self._retained[topic] = (self._payload_bytes(payload), qos, time.monotonic())
+                self.publish_counts["published"] += 1
+            mqtt.Client.publish(self, topic, payload, qos, True, *args, **kwargs)
+    
+    def publish_stats(self):
+        "Returns counts of retained publishes sent and saved by suppression and coalescing"
+        with self._publish_cond:
+            rslt = dict(self.publish_counts)
+            rslt["deferred"] = len(self._deferred)
+        rslt["saved"] = rslt.get("suppressed", 0) + rslt.get("coalesced", 0)
+        return rslt
     
     def on_connect(self, client, userdata, flags, rc):
         "Callback on MQTT connection"
-        self._connected = True
-        if len(self._subscriptions):
-            mqtt.Client.subscribe(self, [(s.topic, s.qos) for s in self._subscriptions.values()])
+        with self._publish_cond:
+            self._retained = {} # The broker may not have kept retained values, send the next ones regardless
+        with self._lock:
+            self._connected = True
+            self._broker_subscriptions = {}
+            self._update_broker()
         
     def on_disconnect(self, client, userdata, rc):
         self._connected = False
         
     def on_message(self, client, userdata, msg):
         "Callback on MQTT message"
+        received = time.monotonic_ns() if self.metrics_topic is not None else None
         self.logger.debug("Received {0.topic:s} -> {0.payload!r}".format(msg))
-        for cb in self._subscriptions[msg.topic]:
-            self.logger.debug("\tCalling {}".format(repr(cb)))
-            self.queue.put((cb, msg), False)
+        with self._lock:
+            subs = self._trie.match(msg.topic)
+        if not subs:
+            self.logger.warning("No subscription for message on {:s}".format(msg.topic))
+        decoded = {} # Decoder -> (decoded value,), or None if the payload was rejected
+        for sub in subs:
+            for cb in sub:
+                decoder = sub.decoders.get(cb)
+                args = ()
+                if decoder is not None:
+                    if decoder not in decoded:
+                        try:
+                            decoded[decoder] = (decoder(msg.payload),)
+                        except (ValueError, TypeError, UnicodeDecodeError) as e:
+                            decoded[decoder] = None
+                            self.rejected[msg.topic] += 1
+                            self.logger.warning("Rejected payload on {0.topic:s}: {0.payload!r}, {1}".format(msg, e))
+                    args = decoded[decoder]
+                    if args is None:
+                        continue
+                self.logger.debug("\tCalling {}".format(repr(cb)))
+                if not self.queue.put(msg.topic, (cb, msg, args, sub.timeouts.get(cb, self.callback_timeout), received),
+                                      sub.limit, self.block_timeout, (msg.topic, cb)): # Each callback gets the latest
+                    self.logger.debug("\tDropped a message for {:s} under the {:s} policy".format(sub.topic, sub.limit.policy))
+        wake = self._wake_async
+        if wake is not None and subs:
+            wake()
     
-    def __next__(self):
+    def _call(self, topic, item):
+        "Run a queued callback, tracking its run time for the watchdog and latency metrics"
+        cb, msg, args, timeout, received = item
+        dequeued = time.monotonic_ns() if received is not None else None
+        me = threading.current_thread()
+        start = time.monotonic()
+        if timeout is not None:
+            self._running[me] = [topic, cb, start, start + timeout, False]
         try:
-            cb, msg = self.queue.get(True, self.loop_timeout)
+            cb(msg, *args)
+        finally:
+            self.queue.done(topic)
+            if received is not None:
+                self._record_latency(topic, received, dequeued, time.monotonic_ns())
+            if timeout is not None:
+                overran = self._running.pop(me)[4]
+                if overran:
+                    self.logger.warning("Callback {!r} for {:s} finished after {:0.3f}s".format(cb, topic, time.monotonic() - start))
+    
+    def _work(self):
+        "Callback worker thread main loop"
+        while True:
+            topic, item = self.queue.get()
+            if topic is None:
+                return
+            try:
+                self._call(topic, item)
+            except Exception:
+                self.logger.exception("Callback for {:s} raised".format(topic))
+            self._dispatched.set()
+    
+    def _start_watchdog(self):
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="SharedClient watchdog", daemon=True)
+            self._watchdog.start()
+    
+    def _watch(self, interval=0.05):
+        "Watchdog thread reporting callbacks which run past their timeout, callbacks can't be interrupted"
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for running in list(self._running.values()):
+                topic, cb, start, deadline, reported = running
+                if not reported and now > deadline:
+                    running[4] = True
+                    self.overruns[topic] += 1
+                    self.logger.warning("Callback {!r} for {:s} overran, running for {:0.3f}s".format(cb, topic, now - start))
+                    if self.on_callback_overrun is not None:
+                        self.on_callback_overrun(topic, cb, now - start)
+    
+    def queue_stats(self):
+        "Returns the queue's size and high-water mark and {topic filter: queue statistics} for each subscription"
+        with self._lock:
+            subs = {topic: sub.limit.stats() for topic, sub in self._subscriptions.items()}
+        return {"pending": self.queue.qsize(), "high_water": self.queue.high_water, "subscriptions": subs}
+    
+    def _record_latency(self, topic, received, dequeued, finished):
+        "Add one message's nanosecond timestamps to the topic's histograms"
+        with self._metrics_lock:
+            histograms = self._latencies.get(topic)
+            if histograms is None:
+                histograms = self._latencies[topic] = (LatencyHistogram(), LatencyHistogram(), LatencyHistogram())
+            histograms[0].record((dequeued - received) // 1000)
+            histograms[1].record((finished - dequeued) // 1000)
+            histograms[2].record((finished - received) // 1000)
+    
+    def latency_stats(self, reset=True):
+        """Returns {topic: {"queued": ..., "callback": ..., "total": ...}} of LatencyHistogram summaries in microseconds
+        for the time messages waited from arriving to being dequeued, spent in the callback and both together.
+        """
+        with self._metrics_lock:
+            latencies = self._latencies
+            if reset:
+                self._latencies = {}
+        return {topic: dict(zip(("queued", "callback", "total"), (h.summary() for h in histograms)))
+                for topic, histograms in latencies.items()}
+    
+    def _publish_metrics(self):
+        "Metrics thread publishing the latency histograms every metrics_interval"
+        while True:
+            time.sleep(self.metrics_interval)
+            stats = self.latency_stats()
+            if stats:
+                self.publish(self.metrics_topic, json.dumps(stats))
+    
+    def stop_workers(self):
+        "Stop the callback worker threads after the callbacks they are running"
+        self.queue.close()
+        wake = self._wake_async
+        if wake is not None:
+            wake()
+        for worker in self._workers:
+            worker.join()
+    
+    def dispatch(self, timeout=None):
+        """Wait up to timeout seconds for a message and run its callback, or with callback workers wait for one of them
+        to finish a callback. Returns True if a callback ran, since it may have changed what the main loop must do next.
+        """
+        if self._workers:
+            ran = self._dispatched.wait(timeout)
+            self._dispatched.clear()
+            return ran
+        try:
+            topic, item = self.queue.get(timeout)
         except queue.Empty:
-            pass
-        else:
-            cb(msg)
+            return False
+        if topic is None:
+            if timeout:
+                time.sleep(timeout) # Queue closed, don't let the main loop spin
+            return False
+        self._call(topic, item)
+        return True
+    
+    async def dispatch_async(self, on_dispatch=None):
+        """Run queued callbacks on the running asyncio event loop as messages arrive, until the queue is closed.
+        Callbacks run on the event loop's thread, so they may start tasks but must not block.
+        @param on_dispatch If not None, called after each callback, e.g. to wake tasks whose deadlines it may have changed
+        """
+        if self._workers:
+            raise RuntimeError("dispatch_async can't be used with callback workers")
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self._wake_async = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            while True:
+                try:
+                    topic, item = self.queue.get(0)
+                except queue.Empty:
+                    await ready.wait()
+                    ready.clear()
+                    continue
+                if topic is None:
+                    return
+                try:
+                    self._call(topic, item)
+                except Exception:
+                    self.logger.exception("Callback for {:s} raised".format(topic))
+                if on_dispatch is not None:
+                    on_dispatch()
+                await asyncio.sleep(0) # Let other tasks run between callbacks
+        finally:
+            self._wake_async = None
+    
+    def __next__(self):
+        "Run the next queued callback, or with callback workers, wait up to loop_timeout for one to finish"
+        self.dispatch(self.loop_timeout)
+
+if __name__ == '__main__':
+    # Unit tests
+    import sys
+    cases = [
+        ("a/b/c", "a/b/c", True), ("a/+/c", "a/b/c", True), ("a/#", "a", True), ("a/#", "a/b/c", True),
+        ("#", "a/b", True), ("+/+", "a/b", True), ("+", "a/b", False), ("a/+", "a", False), ("a/b", "a/b/c", False),
+        ("#", "$SYS/load", False), ("+/load", "$SYS/load", False), ("$SYS/#", "$SYS/load", True), ("a//c", "a//c", True),
+        ("+/+/c", "a//c", True),
+    ]
+    trie = TopicTrie()
+    for topic_filter, topic, expect in cases:
+        trie[topic_filter] = topic_filter
+    for topic_filter, topic, expect in cases:
+        if (topic_filter in trie.match(topic)) != expect:
+            sys.exit("FAIL: {} matching {} should be {}".format(topic_filter, topic, expect))
+        if topic_covers(topic_filter, topic) != expect:
+            sys.exit("FAIL: {} covering {} should be {}".format(topic_filter, topic, expect))
+    for topic_filter in set(c[0] for c in cases):
+        del trie[topic_filter]
+    if trie.root:
+        sys.exit("FAIL: trie not empty after deleting every filter {!r}".format(trie.root))
+    for general, specific, expect in (("a/#", "a/+/c", True), ("a/+/c", "a/#", False), ("+/b", "a/+", False),
+                                      ("#", "+/#", True), ("a/+", "a/+", True)):
+        if topic_covers(general, specific) != expect:
+            sys.exit("FAIL: {} covering {} should be {}".format(general, specific, expect))
+    client = SharedClient()
+    sent = []
+    mqtt.Client.subscribe = lambda self, topics, qos=0: sent.append(("SUBSCRIBE", sorted(topics)))
+    mqtt.Client.unsubscribe = lambda self, topics: sent.append(("UNSUBSCRIBE", sorted(topics)))
+    client.subscribe("coop/door/command", 1, print)
+    client.subscribe("coop/+/command", 1, print)
+    client.on_connect(client, None, {}, 0)
+    client.subscribe("coop/#", 0, print)
+    client.subscribe("coop/#", 1, print)
+    client.unsubscribe("coop/#", print)
+    client.unsubscribe("coop/#", print)
+    expect = [("SUBSCRIBE", [("coop/+/command", 1)]), ("SUBSCRIBE", [("coop/#", 0)]), ("SUBSCRIBE", [("coop/#", 1)]),
+              ("UNSUBSCRIBE", ["coop/+/command"]), ("SUBSCRIBE", [("coop/+/command", 1)]), ("UNSUBSCRIBE", ["coop/#"])]
+    if sent != expect:
+        sys.exit("FAIL: broker subscriptions {!r}".format(sent))
+    msg = mqtt.MQTTMessage(topic=b"coop/door/command")
+    client.on_message(client, None, msg)
+    if client.queue.qsize() != 2:
+        sys.exit("FAIL: expected both subscriptions to be dispatched")
+    # Callback workers keep per topic order and run topics in parallel
+    client = SharedClient(workers=4, callback_timeout=0.1)
+    log = []
+    overruns = []
+    client.on_callback_overrun = lambda topic, cb, t: overruns.append(topic)
+    def slow(msg):
+        time.sleep(0.3)
+        log.append((msg.topic, msg.payload))
+    def fast(msg):
+        log.append((msg.topic, msg.payload))
+    client.subscribe("slow", 1, slow)
+    client.subscribe("fast/+", 1, fast, timeout=1.0)
+    for i in range(3):
+        for topic in ("slow", "fast/a", "fast/b"):
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = i
+            client.on_message(client, None, msg)
+    start = time.monotonic()
+    if not client.dispatch(1.0) or time.monotonic() - start > 0.1:
+        sys.exit("FAIL: dispatch didn't wake when a worker finished a callback")
+    time.sleep(1.2)
+    client.stop_workers()
+    for topic in ("slow", "fast/a", "fast/b"):
+        if [p for t, p in log if t == topic] != [0, 1, 2]:
+            sys.exit("FAIL: {} out of order {!r}".format(topic, log))
+    if [t for t, p in log[:6]].count("slow") != 0:
+        sys.exit("FAIL: fast topics waited behind the slow one {!r}".format(log))
+    if overruns != ["slow"] * 3:
+        sys.exit("FAIL: overruns {!r}".format(overruns))
+    # Overflow policies
+    client = SharedClient(queue_maxsize=3, block_timeout=0.01)
+    for policy in TopicQueue.POLICIES:
+        client.subscribe(policy + "/+", 1, fast, overflow=policy)
+    for i in range(5):
+        for policy in TopicQueue.POLICIES:
+            for topic in ("a", "b"):
+                msg = mqtt.MQTTMessage(topic="{}/{}".format(policy, topic).encode())
+                msg.payload = i
+                client.on_message(client, None, msg)
+    log = []
+    while client.queue.qsize():
+        next(client)
+    expect = {
+        TopicQueue.BLOCK:       [("a", 0), ("b", 0), ("a", 1)],
+        TopicQueue.DROP_NEWEST: [("a", 0), ("b", 0), ("a", 1)],
+        TopicQueue.DROP_OLDEST: [("a", 3), ("b", 3), ("a", 4), ("b", 4)][1:],
+        TopicQueue.LATEST:      [("a", 4), ("b", 4)],
+    }
+    for policy, rows in expect.items():
+        got = [(t.split("/")[1], p) for t, p in log if t.startswith(policy + "/")]
+        if sorted(got) != sorted(rows):
+            sys.exit("FAIL: {} delivered {!r}".format(policy, got))
+    stats = client.queue_stats()
+    if stats["high_water"] != 11 or stats["subscriptions"]["latest/+"]["conflated"] != 8 or \
+       stats["subscriptions"]["drop_oldest/+"]["dropped"] != 7 or stats["subscriptions"]["block/+"]["blocked"] != 7:
+        sys.exit("FAIL: statistics {!r}".format(stats))
+    # The latest policy conflates each callback's messages, not one callback's with another's
+    client = SharedClient()
+    got = []
+    client.subscribe("two/+", 1, lambda msg: got.append("a"), overflow="latest")
+    client.subscribe("two/+", 1, lambda msg: got.append("b"))
+    client.on_message(client, None, mqtt.MQTTMessage(topic=b"two/x"))
+    while client.queue.qsize():
+        next(client)
+    if sorted(got) != ["a", "b"] or client.queue_stats()["subscriptions"]["two/+"]["conflated"] != 0:
+        sys.exit("FAIL: two callbacks conflated to {!r}".format(got))
+    # Payload decoders
+    client = SharedClient()
+    got = []
+    client.subscribe("cmd/+", 1, lambda msg, value: got.append(("json", value)), decoder="json")
+    client.subscribe("cmd/#", 1, lambda msg, value: got.append(("json too", value)), decoder="json")
+    client.subscribe("cmd/rgb", 1, lambda msg, match: got.append(("rgb", match.groups())), decoder=r"rgb\((\d+),(\d+),(\d+)\)")
+    client.subscribe("cmd/rgb", 1, lambda msg: got.append(("raw", msg.payload)))
+    for payload in (b"rgb(1,2,3)", b'"rgb(1,2,3)"', b"{bad"):
+        msg = mqtt.MQTTMessage(topic=b"cmd/rgb")
+        msg.payload = payload
+        client.on_message(client, None, msg)
+    while client.queue.qsize():
+        next(client)
+    expect = [("rgb", ("1", "2", "3")), ("raw", b"rgb(1,2,3)"), ("json", "rgb(1,2,3)"), ("json too", "rgb(1,2,3)"),
+              ("raw", b'"rgb(1,2,3)"'), ("raw", b"{bad")]
+    if sorted(got) != sorted(expect) or client.rejected["cmd/rgb"] != 4:
+        sys.exit("FAIL: decoded {!r} {!r}".format(got, client.rejected))
+    # Latency histograms
+    for v in (0, 1, 63, 64, 65, 1000, 123456, 10**9):
+        i = LatencyHistogram.index(v)
+        lower, upper = LatencyHistogram.lower_bound(i), LatencyHistogram.lower_bound(i + 1)
+        if not lower <= v < upper or (upper - lower) > max(1, v / 30):
+            sys.exit("FAIL: {} in bucket [{}, {})".format(v, lower, upper))
+    h = LatencyHistogram()
+    for v in range(1, 10001):
+        h.record(v)
+    if any(not p - p / 32 <= h.percentile(p / 100) <= p for p in (5000, 9000, 9900)) or h.max != 10000:
+        sys.exit("FAIL: percentiles {!r}".format(h.summary()))
+    client = SharedClient(metrics_topic="metrics")
+    client.subscribe("slow", 1, lambda msg: time.sleep(0.01))
+    client.on_message(client, None, mqtt.MQTTMessage(topic=b"slow"))
+    time.sleep(0.02)
+    next(client)
+    stats = client.latency_stats()["slow"]
+    if not 20000 <= stats["queued"]["max"] < 40000 or not 10000 <= stats["callback"]["max"] < 20000:
+        sys.exit("FAIL: latency {!r}".format(stats))
+    n = 100000
+    start = time.perf_counter()
+    for i in range(n):
+        client._record_latency("slow", 0, 500000, 1500000)
+    print("Recording a latency takes {:0.2f}us".format((time.perf_counter() - start) / n * 1e6))
+    # Dispatching on an asyncio event loop
+    client = SharedClient()
+    got = []
+    dispatched = []
+    client.subscribe("cmd/+", 1, lambda msg, value: got.append((msg.topic, value)), decoder="json")
+    def feed():
+        for i in range(3):
+            time.sleep(0.01)
+            msg = mqtt.MQTTMessage(topic="cmd/{:d}".format(i).encode())
+            msg.payload = str(i).encode()
+            client.on_message(client, None, msg)
+        time.sleep(0.01)
+        client.stop_workers()
+    async def dispatch_test():
+        threading.Thread(target=feed).start()
+        await asyncio.wait_for(client.dispatch_async(lambda: dispatched.append(len(got))), 1.0)
+    asyncio.run(dispatch_test())
+    if got != [("cmd/0", 0), ("cmd/1", 1), ("cmd/2", 2)] or dispatched != [1, 2, 3]:
+        sys.exit("FAIL: async dispatch {!r} {!r}".format(got, dispatched))
+    # Retained publish coalescing
+    sent = []
+    mqtt.Client.publish = lambda self, topic, payload=None, qos=0, retain=False: sent.append((topic, payload, retain))
+    client = SharedClient()
+    client.set_publish_interval("door/#", 0.2)
+    for payload in ("OPEN", "OPEN", "AJAR", "CLOSED", "AJAR", "CLOSED"):
+        client.publish("door/status", payload, qos=1, retain=True)
+    client.publish("health", "{}")
+    client.publish("health", "{}")
+    client.publish("temp", 21, retain=True)
+    client.publish("temp", 21, retain=True)
+    time.sleep(0.3)
+    client.on_connect(client, None, {}, 0)
+    client.publish("temp", 21, retain=True)
+    expect = [("door/status", "OPEN", True), ("health", "{}", False), ("health", "{}", False), ("temp", 21, True),
+              ("door/status", "CLOSED", True), ("temp", 21, True)]
+    if sent != expect:
+        sys.exit("FAIL: published {!r}".format(sent))
+    stats = client.publish_stats()
+    if stats != {"published": 4, "suppressed": 2, "coalesced": 3, "deferred": 0, "saved": 5}:
+        sys.exit("FAIL: publish statistics {!r}".format(stats))
+    print("PASS")
@@ -4,6 +4,7 @@ Helper classes for scheduling actions around time of day etc.
 """
 import datetime
 import astral
+import clock
 import pickle
 import logging
 
@@ -37,6 +38,7 @@ class SunScheduler:
     
     def __init__(self, location, today=None):
         self.callbacks = []
+        self.next_check = None # clock.time() the callbacks next need checking, None once one has been added
         if hasattr(location, "read"): # Location is a file like object
             self.location = pickle.load(location)
         elif type(location) is astral.Location:
@@ -51,7 +53,7 @@ class SunScheduler:
     
     def updateDay(self, today=None):
         if today is None:
-            today = datetime.datetime.now(self.location.tz).date()
+            today = clock.now(self.location.tz).date()
         self.today = today
         self.logger.info("Update day, today is now {0!s}".format(self.today))
         self.sun = self.location.sun(self.today)
@@ -61,17 +63,40 @@ class SunScheduler:
         acb = AlmanacCallback(after, before, callback)
         self.logger.debug("Regisered event: {0!r}".format(acb))
         self.callbacks.append(acb)
+        self.next_check = None
     
     def checkCallbacks(self, now=None):
         "Checks the callbacks to be run"
         if now is None:
-            now = datetime.datetime.now(self.location.tz)
+            now = clock.now(self.location.tz)
         if now.date() != self.today: # Rollover at midnight
             self.updateDay()
             for cb in self.callbacks:
                 cb.reset()
         for cb in self.callbacks:
             cb.run(self.sun, now)
+        self.next_check = self.nextCheck(now)
+
+    def nextMidnight(self):
+        "Returns the start of tomorrow in the location's time zone"
+        midnight = datetime.datetime.combine(self.today + datetime.timedelta(days=1), datetime.time())
+        tz = self.location.tz
+        return tz.localize(midnight) if hasattr(tz, "localize") else midnight.replace(tzinfo=tz)
+
+    def nextCheck(self, now):
+        "Returns the clock.time() after now at which a callback may next become due, at the latest the next midnight"
+        soonest = self.nextMidnight()
+        for cb in self.callbacks:
+            if cb.done or cb.after is None:
+                continue # Callbacks without an after time run as soon as they are checked
+            after = self.sun[cb.after[0]] + cb.after[1]
+            if now <= after < soonest:
+                soonest = after
+        return soonest.timestamp() + 0.001 # Callbacks only run once the time is strictly after theirs
+
+    def deadline(self):
+        "Returns the clock.time() the callbacks next need checking"
+        return clock.time() if self.next_check is None else self.next_check
     
     def __next__(self):
         self.checkCallbacks()
@@ -98,3 +123,14 @@ if __name__ == '__main__':
     s.addEvent(before = ('sunrise', datetime.timedelta(0)), after = ('sunset', datetime.timedelta(0)), callback = badCallback)
     s.addEvent(before = ('sunset', datetime.timedelta(0)), after = ('sunrise', datetime.timedelta(0)), callback = dummyCallback)
     s.checkCallbacks(noon)
+    if abs(s.deadline() - s.sun['sunset'].timestamp() - 0.001) > 1e-6: # The after sunset callback is next
+        sys.exit("FAIL: deadline {!r} is not sunset".format(s.deadline()))
+    s.callbacks = []
+    if abs(s.nextCheck(noon) - s.nextMidnight().timestamp() - 0.001) > 1e-6:
+        sys.exit("FAIL: next check {!r} is not midnight".format(s.nextCheck(noon)))
+    now = datetime.datetime.now(s.location.tz)
+    soon = min(now + datetime.timedelta(minutes=1), s.nextMidnight())
+    s.callbacks = [AlmanacCallback(('noon', soon - noon), None, badCallback)]
+    if abs(s.nextCheck(now) - soon.timestamp() - 0.001) > 1e-6:
+        sys.exit("FAIL: next check {!r} is not the callback's after time".format(s.nextCheck(now)))
+    print("PASS")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Time source for the automation modules.
+The modules read the time with clock.time() and clock.now() and wait with clock.sleep() and clock.wait() instead of
+using the time and datetime modules directly, so that a simulation can install a VirtualClock and run a whole day in
+seconds.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time as systime
+import datetime
+import threading
+import heapq
+import itertools
+
+class SystemClock:
+    "The real time"
+
+    virtual = False
+
+    def time(self):
+        return systime.time()
+
+    def now(self, tz=None):
+        return datetime.datetime.now(tz)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            systime.sleep(seconds)
+
+    def wait(self, event, timeout=None):
+        "Wait for a threading.Event, returns whether it is set"
+        return event.wait(timeout)
+
+    def call_at(self, t, func):
+        "Call func from another thread at time t, returns a timer with a cancel() method"
+        timer = threading.Timer(max(0.0, t - self.time()), func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+class VirtualClock:
+    """Simulated time which only moves when something sleeps or waits on it, jumping straight to the next timer.
+    Timers are called on the thread which is sleeping, so everything using the clock must run on one thread.
+    """
+
+    virtual = True
+
+    class Timer:
+        def __init__(self, func):
+            self.func = func
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, start=None):
+        """Set up the clock
+        @param start The time.time() to start at, by default the current time
+        """
+        self.t = systime.time() if start is None else start
+        self._timers = [] # Heap of (time, sequence, Timer)
+        self._sequence = itertools.count()
+
+    def time(self):
+        return self.t
+
+    def now(self, tz=None):
+        return datetime.datetime.fromtimestamp(self.t, tz)
+
+    def call_at(self, t, func):
+        "Call func once the clock reaches time t, returns a timer with a cancel() method"
+        timer = self.Timer(func)
+        heapq.heappush(self._timers, (t, next(self._sequence), timer))
+        return timer
+
+    def advance(self, until, event=None):
+        "Move time forward to until, calling the timers due on the way and stopping early once event is set"
+        while event is None or not event.is_set():
+            if not self._timers or self._timers[0][0] > until:
+                if until != float('inf'):
+                    self.t = max(self.t, until)
+                break
+            t, seq, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self.t = max(self.t, t)
+                timer.func()
+        return event is not None and event.is_set()
+
+    def sleep(self, seconds):
+        self.advance(self.t + max(0.0, seconds))
+
+    def wait(self, event, timeout=None):
+        """Wait for an object with an is_set() method, returns whether it is set.
+        With no timeout, waits no longer than the last timer since nothing else can set it.
+        """
+        return self.advance(float('inf') if timeout is None else self.t + max(0.0, timeout), event)
+
+_clock = SystemClock()
+
+def install(clock):
+    "Make clock the time source for every module, returns the clock it replaces"
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+def current():
+    return _clock
+
+def time():
+    "The current time.time()"
+    return _clock.time()
+
+def now(tz=None):
+    "The current datetime.datetime.now(tz)"
+    return _clock.now(tz)
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+def wait(event, timeout=None):
+    "Wait for a threading.Event, returns whether it is set"
+    return _clock.wait(event, timeout)
+
+def call_at(t, func):
+    "Call func at time t, returns a timer with a cancel() method"
+    return _clock.call_at(t, func)
+
+if __name__ == '__main__':
+    # Unit tests
+    import sys
+    vc = VirtualClock(1000.0)
+    previous = install(vc)
+    calls = []
+    call_at(1010.0, lambda: calls.append(("b", time())))
+    call_at(1005.0, lambda: calls.append(("a", time())))
+    call_at(1020.0, lambda: calls.append(("cancelled", time()))).cancel()
+    started = systime.time()
+    sleep(30)
+    if calls != [("a", 1005.0), ("b", 1010.0)] or time() != 1030.0:
+        sys.exit("FAIL: timers {!r} at {!r}".format(calls, time()))
+    event = threading.Event()
+    call_at(1040.0, event.set)
+    if not wait(event, 60) or time() != 1040.0:
+        sys.exit("FAIL: wait returned at {!r}".format(time()))
+    if wait(threading.Event(), 5) or time() != 1045.0:
+        sys.exit("FAIL: wait timed out at {!r}".format(time()))
+    if now(datetime.timezone.utc) != datetime.datetime(1970, 1, 1, 0, 17, 25, tzinfo=datetime.timezone.utc):
+        sys.exit("FAIL: now {!r}".format(now(datetime.timezone.utc)))
+    if systime.time() - started > 0.1:
+        sys.exit("FAIL: virtual clock slept for real")
+    install(previous)
+    event = threading.Event()
+    call_at(time() + 0.05, event.set)
+    if not wait(event, 1.0):
+        sys.exit("FAIL: system clock timer didn't fire")
+    print("PASS")
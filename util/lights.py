@@ -6,6 +6,7 @@ Based on pgpio
 
 import time
 import logging
+import clock
 
 class Light(object):
     "One or more channel driver"
@@ -49,25 +50,45 @@ class Light(object):
 class SlowLinearFader(Light):
     "A light object that supports slow fading"
 
+    MIN_STEP = 0.01 # Shortest seconds between fade steps
+
     def __init__(self, *a, **kw):
         Light.__init__(self, *a, **kw)
         self.start_val = [0]
         self.end_val = [0]
         self.start_time = 0
         self.end_time = 0
+        self.last_step = 0
+        self.step_interval = self.MIN_STEP
         self.done = False
 
     def setTarget(self, duration, targets):
         "Start linearly fading from current value to target over duration seconds"
-        self.logger.info("Fading to % over % seconds", targets, duration)
+        self.logger.info("Fading to %s over %s seconds", targets, duration)
         self.done = False
         self.start_val = self.get()
         self.end_val = targets
-        self.start_time = time.time()
+        self.start_time = clock.time()
         self.end_time = self.start_time + duration
+        self.last_step = 0
+        self.step_interval = self.stepInterval(duration)
+
+    def stepInterval(self, duration):
+        "Seconds between fade steps so that each step moves the output by about one PWM count"
+        counts = max([abs(ev - sv) * self.scale * max(1, self.gamma) for sv, ev in zip(self.start_val, self.end_val)] + [0])
+        if counts < 1:
+            return max(self.MIN_STEP, duration)
+        return max(self.MIN_STEP, duration / counts)
+
+    def deadline(self):
+        "Returns the clock.time() the fade next needs stepping, None once it is done"
+        if self.done:
+            return None
+        return min(self.last_step + self.step_interval, self.end_time)
 
     def __next__(self):
-        now = time.time()
+        now = clock.time()
+        self.last_step = now
         if now < self.end_time:
             delta = now - self.start_time
             progress = delta / (self.end_time - self.start_time)
@@ -83,12 +104,15 @@ class SlowLinearFader(Light):
 class GasLamp(SlowLinearFader):
     "A slow linear fater which can also be driven by candle flicker algorithm"
 
+    FRAME_INTERVAL = 0.05 # Seconds between flicker frames, the rate the flicker generator is tuned for
+
     def __init__(self, flicker, color_scaling, *light_args, **light_kw_args):
         SlowLinearFader.__init__(self, *light_args, **light_kw_args)
         self.flicker = flicker
         next(self.flicker) # Initalize candle
         self.fuel = None # If not none, do candle, if none do slow linear fade
         self.candle_scaling = color_scaling
+        self.next_frame = 0
 
     def setTarget(self, *args):
         "Sets explicit target"
@@ -97,13 +121,24 @@ class GasLamp(SlowLinearFader):
 
     def setCandle(self, fuel):
         "Sets the light to fuel mode"
+        if self.fuel is None:
+            self.next_frame = clock.time()
         self.fuel = fuel
 
+    def deadline(self):
+        "Returns the clock.time() of the next flicker frame or fade step"
+        if self.fuel is None:
+            return SlowLinearFader.deadline(self)
+        return self.next_frame
+
     def __next__(self):
         if self.fuel is None:
             SlowLinearFader.__next__(self)
         else:
-            flame = self.flicker.send(self.fuel)
+            now = clock.time()
+            # Keep frames on their cadence unless a whole frame was missed
+            self.next_frame = self.next_frame + self.FRAME_INTERVAL if now - self.next_frame < self.FRAME_INTERVAL else now + self.FRAME_INTERVAL
+            flame = self.flicker.send({"fuel": self.fuel})
             self.set(*(scale * flame for scale in self.candle_scaling))
             return flame
 
@@ -177,5 +212,12 @@ if __name__ == '__main__':
         l = Light(pi, [0], 100, 100, [1])
         pi.expect_pwm_cmd(0, 100, 1)
         l.set(1)
+        f = SlowLinearFader(DummyPi(False), [0], 4095, 4095/100)
+        next(f)
+        assert f.deadline() is None, "FAIL: finished fader has a deadline"
+        f.setTarget(100, [50])
+        assert abs(f.step_interval - 100 / (50 * 4095/100)) < 1e-9, "FAIL: step interval {!r}".format(f.step_interval)
+        next(f)
+        assert f.start_time < f.deadline() <= f.last_step + f.step_interval, "FAIL: fade deadline {!r}".format(f.deadline())
 
         print("PASS")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Frame based PWM output between the lights and the PWM driver.
+Lights set duty cycles on a PWMFrame as if it were the pigpio.pi. The frame quantizes each to the driver's resolution,
+drops those which don't change the channel's output and writes the rest together when it is flushed, as one
+set_PWM_dutycycles() transaction if the driver supports it. As a main loop component it is due whenever a channel is
+dirty, so listed after the lights it flushes everything they set in a step as one frame.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import threading
+import collections
+import clock
+
+class PWMFrame:
+    "Batches and deduplicates PWM duty cycle writes to a pigpio.pi like driver"
+
+    def __init__(self, pi):
+        """Set up the frame
+        @param pi Driver to write to, needs set_PWM_dutycycle() and get_PWM_range()
+        """
+        self.pi = pi
+        self.batched = hasattr(pi, "set_PWM_dutycycles")
+        self.written = {} # gpio -> (dutycycle, phase) last written to the driver
+        self.dirty = collections.OrderedDict() # gpio -> (dutycycle, phase) to write in the next frame
+        self.ranges = {} # gpio -> PWM range, cached as the driver may have to be asked over the bus
+        self.dirtied = None # clock.time() the first channel of the next frame was set, None while none are
+        self.frames = 0 # Number of frames flushed
+        self.writes = 0 # Number of channel writes sent to the driver
+        self.skipped = 0 # Number of channel writes dropped because they didn't change the output
+        self._lock = threading.Lock() # Callbacks may set channels from worker threads
+
+    def get_PWM_range(self, gpio):
+        if gpio not in self.ranges:
+            self.ranges[gpio] = self.pi.get_PWM_range(gpio)
+        return self.ranges[gpio]
+
+    def quantize(self, gpio, dutycycle):
+        "Returns dutycycle as the nearest count the driver can output on gpio"
+        return max(0, min(int(round(dutycycle)), self.get_PWM_range(gpio)))
+
+    def set_PWM_dutycycle(self, gpio, dutycycle, phase=0):
+        "Set a channel's duty cycle in the next frame"
+        setting = (self.quantize(gpio, dutycycle), phase)
+        with self._lock:
+            if setting == self.dirty.get(gpio, self.written.get(gpio)):
+                self.skipped += 1
+            elif setting == self.written.get(gpio):
+                del self.dirty[gpio] # Set back to what is already output before the frame was flushed
+                self.skipped += 1
+                if not self.dirty:
+                    self.dirtied = None
+            else:
+                self.dirty[gpio] = setting
+                if self.dirtied is None:
+                    self.dirtied = clock.time()
+
+    def get_PWM_dutycycle(self, gpio):
+        setting = self.dirty.get(gpio, self.written.get(gpio))
+        return self.pi.get_PWM_dutycycle(gpio) if setting is None else setting[0]
+
+    def flush(self):
+        "Write the channels set since the last flush to the driver"
+        with self._lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, collections.OrderedDict()
+            self.dirtied = None
+            self.written.update(dirty)
+        if self.batched:
+            self.pi.set_PWM_dutycycles([(gpio, dutycycle, phase) for gpio, (dutycycle, phase) in dirty.items()])
+        else:
+            for gpio, (dutycycle, phase) in dirty.items():
+                self.pi.set_PWM_dutycycle(gpio, dutycycle, phase)
+        self.frames += 1
+        self.writes += len(dirty)
+
+    def deadline(self):
+        "Due from when a channel was first set, None while no channels are dirty"
+        return self.dirtied
+
+    def __next__(self):
+        self.flush()
+
+    def stats(self):
+        return {"frames": self.frames, "writes": self.writes, "skipped": self.skipped}
+
+if __name__ == '__main__':
+    # Unit tests
+    import sys
+    class SpyPi:
+        def __init__(self, batched):
+            self.calls = []
+            if batched:
+                self.set_PWM_dutycycles = lambda settings: self.calls.append(list(settings))
+        def get_PWM_range(self, gpio):
+            return 4095
+        def set_PWM_dutycycle(self, gpio, dutycycle, phase=0):
+            self.calls.append((gpio, dutycycle, phase))
+    pi = SpyPi(True)
+    frame = PWMFrame(pi)
+    frame.set_PWM_dutycycle(1, 100.4, 10)
+    frame.set_PWM_dutycycle(2, 5000)
+    frame.set_PWM_dutycycle(3, -2)
+    if frame.deadline() is None:
+        sys.exit("FAIL: dirty frame isn't due")
+    next(frame)
+    if pi.calls != [[(1, 100, 10), (2, 4095, 0), (3, 0, 0)]] or frame.deadline() is not None:
+        sys.exit("FAIL: flushed {!r}".format(pi.calls))
+    frame.set_PWM_dutycycle(1, 99.6, 10) # Same count
+    frame.set_PWM_dutycycle(2, 4000)
+    frame.set_PWM_dutycycle(2, 4095) # Back to what is output
+    frame.set_PWM_dutycycle(3, 7)
+    frame.set_PWM_dutycycle(3, 8) # Last setting in a frame wins
+    next(frame)
+    next(frame)
+    if pi.calls[1:] != [[(3, 8, 0)]] or frame.stats() != {"frames": 2, "writes": 4, "skipped": 2}:
+        sys.exit("FAIL: flushed {!r} with {!r}".format(pi.calls, frame.stats()))
+    pi = SpyPi(False)
+    frame = PWMFrame(pi)
+    frame.set_PWM_dutycycle(4, 1.0)
+    frame.set_PWM_dutycycle(5, 2.0, 3)
+    frame.flush()
+    if pi.calls != [(4, 1, 0), (5, 2, 3)]:
+        sys.exit("FAIL: unbatched driver got {!r}".format(pi.calls))
+    print("PASS")
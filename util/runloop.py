@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Deadline driven main loops.
+Each component reports from deadline() the clock.time() at which it next needs to be stepped with next(), or None if it
+is idle until something else changes it. The loop steps the components which are due then sleeps until the earliest
+deadline, or until the dispatcher runs an MQTT callback, which may have given a component a new deadline.
+AsyncRunLoop does the same on an asyncio event loop with a task per component, so that components and callbacks can
+start long running tasks, such as a door motion, which run alongside everything else.
+"""
+__author__ = "Daniel Casner <www.danielcasner.org>"
+
+import time
+import logging
+import asyncio
+import clock
+
+class RunLoop:
+    "Steps components when their deadlines come due"
+
+    def __init__(self, components, dispatcher=None, max_sleep=60.0, poll_interval=0.05):
+        """Set up the loop
+        @param components Objects stepped with next(), those without a deadline() method are stepped every poll_interval
+        @param dispatcher If not None, an object whose dispatch(timeout) waits for and runs a callback, e.g. SharedClient
+        @param max_sleep Maximum seconds to sleep at once, so a change to the system clock is noticed
+        @param poll_interval Seconds between steps of components without a deadline() method
+        """
+        self.components = list(components)
+        self.dispatcher = dispatcher
+        self.max_sleep = max_sleep
+        self.poll_interval = poll_interval
+        self.running = False
+        self.steps = 0 # Number of component steps
+        self.wakeups = 0 # Number of times the loop has woken
+        self.max_late = 0.0 # Most seconds a component has been stepped after its deadline
+        self._polls = {} # Component without deadline() -> time it is next due
+        self._last_step = None
+        self.logger = logging.getLogger(__name__)
+
+    def deadline(self, component, now):
+        "Returns the component's next deadline"
+        if hasattr(component, "deadline"):
+            return component.deadline()
+        return self._polls.get(component, now)
+
+    def step(self):
+        """Step the components which are due, returns the earliest of their next deadlines or None if all are idle.
+        Components are stepped in order, so one made due by an earlier one, such as a PWMFrame, is stepped in the
+        same step.
+        """
+        now = clock.time()
+        since = now if self._last_step is None else self._last_step # Deadlines set between steps are due from then
+        self._last_step = now
+        soonest = None
+        for component in self.components:
+            now = clock.time()
+            deadline = self.deadline(component, now)
+            if deadline is not None and deadline <= now:
+                self.max_late = max(self.max_late, now - max(deadline, since))
+                next(component)
+                self.steps += 1
+                if not hasattr(component, "deadline"):
+                    self._polls[component] = now + self.poll_interval
+                deadline = self.deadline(component, now)
+            if deadline is not None and (soonest is None or deadline < soonest):
+                soonest = deadline
+        return soonest
+
+    def wait(self, deadline):
+        "Sleep until the deadline, or until the dispatcher runs a callback"
+        timeout = self.max_sleep if deadline is None else min(max(0.0, deadline - clock.time()), self.max_sleep)
+        if self.dispatcher is not None:
+            self.dispatcher.dispatch(timeout)
+        else:
+            clock.sleep(timeout)
+        self.wakeups += 1
+
+    def run(self):
+        "Run the loop until stop() is called"
+        self.running = True
+        self.logger.debug("Entering run loop with {:d} components".format(len(self.components)))
+        while self.running:
+            self.wait(self.step())
+
+    def stop(self):
+        "Stop the loop after its current step, from a component or callback"
+        self.running = False
+
+    def stats(self):
+        return {"steps": self.steps, "wakeups": self.wakeups, "max_late": self.max_late}
+
+class AsyncRunLoop(RunLoop):
+    "Runs each component as an asyncio task which sleeps until its deadline, the dispatcher needs dispatch_async()"
+
+    def __init__(self, *args, **kwargs):
+        RunLoop.__init__(self, *args, **kwargs)
+        self._wakes = []
+        self._tasks = []
+
+    def wake(self):
+        "Wake the component tasks to recompute their deadlines, called after each dispatched callback"
+        for event in self._wakes:
+            event.set()
+
+    async def drive(self, component):
+        "Task stepping one component at its deadlines"
+        wake = asyncio.Event()
+        self._wakes.append(wake)
+        since = clock.time()
+        while True:
+            now = clock.time()
+            deadline = self.deadline(component, now)
+            if deadline is not None and deadline <= now:
+                self.max_late = max(self.max_late, now - max(deadline, since))
+                since = now
+                next(component)
+                self.steps += 1
+                if not hasattr(component, "deadline"):
+                    self._polls[component] = now + self.poll_interval
+                for event in self._wakes: # Stepping may have changed other components, e.g. a sun event starting a fade
+                    if event is not wake:
+                        event.set()
+                await asyncio.sleep(0)
+                continue
+            timeout = self.max_sleep if deadline is None else min(deadline - now, self.max_sleep)
+            since = now
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+            self.wakeups += 1
+
+    async def run_async(self):
+        "Run the component tasks and the dispatcher until stop() is called or the dispatcher finishes"
+        self.running = True
+        self.logger.debug("Entering asyncio run loop with {:d} components".format(len(self.components)))
+        self._tasks = [asyncio.create_task(self.drive(component)) for component in self.components]
+        if self.dispatcher is not None:
+            self._tasks.append(asyncio.create_task(self.dispatcher.dispatch_async(self.wake)))
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            if self.running:
+                raise
+        finally:
+            self.running = False
+            for task in self._tasks:
+                task.cancel()
+            self._wakes = []
+
+    def run(self):
+        "Run the loop on a new asyncio event loop until stop() is called"
+        asyncio.run(self.run_async())
+
+    def stop(self):
+        "Stop the loop, from a component or callback on the event loop's thread"
+        self.running = False
+        for task in self._tasks:
+            task.cancel()
+
+if __name__ == '__main__':
+    # Unit tests
+    import sys
+    class Ticker:
+        "Component due every period seconds, stops the loop after count steps"
+        def __init__(self, period, count, loop=None):
+            self.period = period
+            self.count = count
+            self.loop = loop
+            self.times = []
+            self.next_time = time.time()
+        def deadline(self):
+            return self.next_time if len(self.times) < self.count else None
+        def __next__(self):
+            self.times.append(time.time())
+            self.next_time += self.period
+            if len(self.times) == self.count and self.loop is not None:
+                self.loop.stop()
+    class Polled:
+        def __init__(self):
+            self.steps = 0
+        def __next__(self):
+            self.steps += 1
+    fast = Ticker(0.008, 50)
+    slow = Ticker(0.1, 6)
+    polled = Polled()
+    loop = RunLoop([fast, slow, polled], poll_interval=0.02)
+    slow.loop = loop
+    start = time.time()
+    loop.run()
+    elapsed = time.time() - start
+    assert len(fast.times) == 50, "FAIL: fast ticker stepped {:d} times".format(len(fast.times))
+    assert 0.45 < elapsed < 0.7, "FAIL: loop ran for {:0.3f}s".format(elapsed)
+    assert 20 <= polled.steps <= 30, "FAIL: polled component stepped {:d} times".format(polled.steps)
+    assert loop.wakeups < 100, "FAIL: loop woke {:d} times".format(loop.wakeups)
+    class Dispatcher:
+        def __init__(self):
+            self.timeouts = []
+        def dispatch(self, timeout):
+            self.timeouts.append(timeout)
+            return False
+    dispatcher = Dispatcher()
+    idle = RunLoop([Ticker(1, 0)], dispatcher, max_sleep=5.0)
+    idle.wait(idle.step())
+    assert dispatcher.timeouts == [5.0], "FAIL: idle loop waited {!r}".format(dispatcher.timeouts)
+    # Asyncio loop, a dispatched callback makes an idle component due
+    class AsyncDispatcher:
+        def __init__(self, ticker):
+            self.ticker = ticker
+        async def dispatch_async(self, on_dispatch):
+            await asyncio.sleep(0.05)
+            self.ticker.count = 5
+            self.ticker.next_time = time.time()
+            on_dispatch()
+    fast = Ticker(0.008, 50)
+    idle = Ticker(0.01, 0)
+    loop = AsyncRunLoop([fast, idle, Polled()], AsyncDispatcher(idle))
+    fast.loop = loop
+    start = time.time()
+    loop.run()
+    elapsed = time.time() - start
+    assert len(fast.times) == 50 and 0.35 < elapsed < 0.6, "FAIL: async loop ran {:0.3f}s".format(elapsed)
+    assert len(idle.times) == 5 and idle.times[0] - start < 0.07, "FAIL: woken component ran at {!r}".format(idle.times)
+    assert loop.max_late < 0.02, "FAIL: components ran {:0.3f}s late".format(loop.max_late)
+    print("PASS")